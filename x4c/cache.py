@@ -0,0 +1,176 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import numpy as np
+import xarray as xr
+
+from . import utils
+
+class DiagCache:
+    ''' A persistent, content-addressed cache of the calculated diagnostics
+
+    A diagnostic is identified by its spell and calculation options, which map to the list of (vn, comp)
+    it was calculated from. The cache key adds the (path, mtime, size) of the input files, so a result
+    is never reused after the input files change. The results are stored as compressed netCDF files and
+    the least recently used ones are evicted once the total size exceeds `max_size`.
+
+    The inputs of each spell are stored in a small file of their own under `inputs/`, written atomically,
+    so that the processes sharing `cache_dir` (e.g., the workers of a pool) never overwrite each other's records.
+
+    Args:
+        cache_dir (str): the directory of the cache; if None, only the inputs are tracked in memory
+        max_size (int): the maximum total size of the cached files in bytes
+        max_item_size (int): the results larger than this (in memory) are not cached; defaults to `max_size` // 10
+    '''
+    def __init__(self, cache_dir=None, max_size=8*2**30, max_item_size=None):
+        self.cache_dir = None if cache_dir is None else os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.max_item_size = max_size // 10 if max_item_size is None else max_item_size
+        self.inputs = {}
+        self.lock = threading.Lock()
+        if self.cache_dir is not None:
+            self.inputs_dir = os.path.join(self.cache_dir, 'inputs')
+            os.makedirs(self.inputs_dir, exist_ok=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('lock')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_spell_key(spell, **kws):
+        return json.dumps([spell, kws], sort_keys=True, default=str)
+
+    @staticmethod
+    def get_key(spell_key, fingerprints):
+        return hashlib.sha1(json.dumps([spell_key, fingerprints], default=str).encode()).hexdigest()
+
+    def get_inputs_path(self, spell_key):
+        return os.path.join(self.inputs_dir, f'{hashlib.sha1(spell_key.encode()).hexdigest()}.json')
+
+    def get_inputs(self, spell_key):
+        with self.lock:
+            if spell_key in self.inputs or self.cache_dir is None: return self.inputs.get(spell_key)
+
+        # recorded by another process or session; an unreadable record is treated as missing
+        try:
+            with open(self.get_inputs_path(spell_key), 'r') as f:
+                inputs = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        with self.lock:
+            self.inputs[spell_key] = inputs
+        return inputs
+
+    def set_inputs(self, spell_key, inputs):
+        inputs = sorted([list(i) for i in inputs])
+        with self.lock:
+            self.inputs[spell_key] = inputs
+
+        if self.cache_dir is not None:
+            path = self.get_inputs_path(spell_key)
+            fd, tmp_path = tempfile.mkstemp(dir=self.inputs_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(inputs, f)
+                os.replace(tmp_path, path)
+            except OSError as err:
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+                utils.p_warning(f'>>> Failed to record the inputs of the diagnostic: {err}')
+
+    def fits(self, da):
+        ''' Check if `da` is small enough to be cached '''
+        return self.cache_dir is not None and da.nbytes <= self.max_item_size
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.nc')
+
+    def get(self, key):
+        ''' Return the cached `xarray.DataArray` of `key`; None if not cached '''
+        if self.cache_dir is None: return None
+        path = self.get_path(key)
+        try:
+            ds = xr.load_dataset(path)
+            # mark as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        return self.from_dataset(ds)
+
+    def put(self, key, da):
+        ''' Store `da` under `key` and evict the least recently used files beyond `max_size` '''
+        if self.cache_dir is None: return
+        ds = self.to_dataset(da)
+        encoding = {v: {'zlib': True, 'complevel': 4} for v in ds.data_vars if np.issubdtype(ds[v].dtype, np.number)}
+        path = self.get_path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            ds.to_netcdf(tmp_path, format='NETCDF4', encoding=encoding)
+            os.replace(tmp_path, path)
+        except Exception as err:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            utils.p_warning(f'>>> Failed to cache the diagnostic: {err}')
+            return
+
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.name.endswith('.nc') and entry.is_file():
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(e[1] for e in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size: break
+                os.remove(path)
+                total -= size
+
+    def clear(self):
+        with self.lock:
+            if self.cache_dir is not None:
+                for fname in os.listdir(self.cache_dir):
+                    if fname.endswith('.nc'): os.remove(os.path.join(self.cache_dir, fname))
+                for fname in os.listdir(self.inputs_dir):
+                    if fname.endswith('.json'): os.remove(os.path.join(self.inputs_dir, fname))
+            self.inputs = {}
+
+    @staticmethod
+    def to_dataset(da):
+        ''' Pack a diagnostic into a `xarray.Dataset`, keeping the attributes that are DataArrays (e.g., `gw`) as variables '''
+        ds = xr.Dataset()
+        attrs, array_attrs = {}, []
+        for k, v in da.attrs.items():
+            if isinstance(v, xr.DataArray):
+                ds[f'attr_{k}'] = v.drop_vars([c for c in v.coords if c not in v.dims])
+                array_attrs.append(k)
+            else:
+                attrs[k] = v
+
+        ds['diag'] = da.copy(deep=False)
+        ds['diag'].attrs = {}
+        ds.attrs['name'] = '' if da.name is None else str(da.name)
+        ds.attrs['attrs'] = json.dumps(attrs, default=lambda o: o.tolist() if hasattr(o, 'tolist') else str(o))
+        ds.attrs['array_attrs'] = json.dumps(array_attrs)
+        return ds
+
+    @staticmethod
+    def from_dataset(ds):
+        da = ds['diag']
+        da.attrs = json.loads(ds.attrs['attrs'])
+        for k in json.loads(ds.attrs['array_attrs']):
+            da.attrs[k] = ds[f'attr_{k}']
+        da.name = ds.attrs['name'] if ds.attrs['name'] != '' else None
+        return da
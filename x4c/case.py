@@ -1,7 +1,7 @@
 import os
 import glob
 import pandas as pd
-import gzip
+import json
 from tqdm import tqdm
 import xarray as xr
 import multiprocessing as mp
@@ -10,16 +10,54 @@ import textwrap
 import shutil
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import threading
+import dask
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import gridspec
 import cftime
 from . import visual
 import subprocess
-from copy import deepcopy
+import collections
+from copy import copy, deepcopy
 
 from . import core, utils, diags
 from .spell import Spell
+from .catalog import Catalog
+from .cache import DiagCache
+from .refs import RefStore
+
+class CaseHandle(collections.namedtuple('CaseHandle', ['kind', 'kws'])):
+    ''' A compact and immutable descriptor of a case, from which each worker process of a pool rebuilds the case once
+
+    Only the small attributes the tasks need are kept (e.g., the directories and the variable names), rather than
+    the loaded datasets and diagnostics, so that the tasks carry only their own arguments; see `run_case_task`.
+
+    Args:
+        kind (str): the class of the case, i.e., "History", "Timeseries", or "Means"
+        kws (tuple): the (name, value) pairs passed to the `from_handle` of the class
+    '''
+    __slots__ = ()
+
+    def rebuild(self):
+        kinds = {'History': History, 'Timeseries': Timeseries, 'Means': Means}
+        return kinds[self.kind].from_handle(**dict(self.kws))
+
+    def pool(self, nproc):
+        ''' Return a `multiprocessing.Pool` whose workers rebuild the case once at startup '''
+        return mp.Pool(processes=nproc, initializer=init_worker, initargs=(self,))
+
+# the case rebuilt in a worker process of a pool; see `init_worker`
+worker_case = None
+
+def init_worker(handle):
+    ''' The initializer of a worker process, which rebuilds the case from its `CaseHandle` '''
+    global worker_case
+    utils.reset_dask_pool()
+    worker_case = handle.rebuild()
+
+def run_case_task(method, *args):
+    ''' Call a method of the case of the worker process with the arguments of a work unit '''
+    return getattr(worker_case, method)(*args)
 
 class History:
     def __init__(self, root_dir, comps=['atm', 'ocn', 'lnd', 'ice', 'rof'], mdl_hstr_dict=None, casename=None):
@@ -43,12 +81,14 @@ class History:
         utils.p_header(f'>>> case.comps_info: {self.comps_info}')
 
         self.paths = {}
+        self.time_index = {}
         for comp in comps:
             mdl, h_str = _mdl_hstr_dict[comp]
             self.paths[comp] = utils.find_paths(
                 self.root_dir, self.path_pattern, comp=comp, mdl=mdl, h_str=h_str,
                 avoid_list=['nday1', 'once'],
             )
+            self.time_index[comp] = utils.TimeIndex(self.paths[comp])
             utils.p_success(f'>>> case.paths["{comp}"] created')
 
         self.vns = {}
@@ -56,6 +96,29 @@ class History:
             self.vns[comp] = self.get_ts_vns(comp)
             utils.p_success(f'>>> case.vns["{comp}"] created')
 
+    @property
+    def handle(self):
+        ''' the `CaseHandle` to rebuild the case in a worker process '''
+        return CaseHandle('History', (
+            ('root_dir', self.root_dir),
+            ('casename', self.casename),
+            ('comps_info', tuple(self.comps_info.items())),
+            ('vns', tuple((comp, tuple(vns)) for comp, vns in self.vns.items())),
+        ))
+
+    @classmethod
+    def from_handle(cls, root_dir, casename, comps_info, vns):
+        ''' Rebuild the case without scanning the history files, which the tasks of a worker do not need '''
+        case = cls.__new__(cls)
+        case.path_pattern = 'comp/hist/casename.mdl.h_str.date.nc'
+        case.root_dir = root_dir
+        case.casename = casename
+        case.comps_info = dict(comps_info)
+        case.paths = {}
+        case.time_index = {}
+        case.vns = {comp: list(v) for comp, v in vns}
+        return case
+
     def get_ts_vns(self, comp):
         vns_ts = []
         ds0 = xr.open_dataset(self.paths[comp][0])
@@ -72,22 +135,9 @@ class History:
         return vns_ts
 
     def get_paths(self, comp, timespan=None):
-        paths = self.paths[comp]
-
-        if timespan is None:
-            paths_sub = paths
-        else:
-            syr, eyr = timespan
-            paths_sub = []
-            for path in paths:
-                syr_tmp = int(path.split('.')[-2].split('-')[0][:4])
-                eyr_tmp = int(path.split('.')[-2].split('-')[1][:4])
-                if (syr_tmp >= syr and syr_tmp <= eyr) or (eyr_tmp >= syr and eyr_tmp <= eyr):
-                    paths_sub.append(path)
-
-        return paths_sub
+        return self.time_index[comp].query(timespan)
 
-    def isolate_vn(self, vn, comp, in_path, output_dirpath, overwrite=True):
+    def get_isolated_fname(self, vn, in_path):
         bn_elements = os.path.basename(in_path).split('.')
         bn_elements.insert(-2, vn)
 
@@ -97,7 +147,10 @@ class History:
         else:
             fname = '.'.join(bn_elements)
 
-        out_path = os.path.join(output_dirpath, fname)
+        return fname
+
+    def isolate_vn(self, vn, comp, in_path, output_dirpath, overwrite=True):
+        out_path = os.path.join(output_dirpath, self.get_isolated_fname(vn, in_path))
         if overwrite or not os.path.exists(out_path):
             if os.path.exists(out_path): os.remove(out_path)
             vns = self.vns[comp].copy()
@@ -105,41 +158,105 @@ class History:
             cmd = f'ncks -h -C -x -v {",".join(vns)} {in_path} -o {out_path}'
             subprocess.run(cmd, shell=True)
 
-    def bigbang(self, comp, output_dirpath, timespan=None, overwrite=True, nproc=1, vns=None):
+    def split_hist(self, comp, in_path, output_dirpath, overwrite=True, vns=None):
+        ''' Split a history file into per-variable files in a single pass with `netCDF4`
+
+        Unlike `isolate_vn`, which launches one `ncks` process per variable,
+        the history file is opened only once and all the variables are written out from it.
+        '''
+        if vns is None: vns = self.vns[comp]
+        out_paths = {}
+        for vn in vns:
+            out_path = os.path.join(output_dirpath, self.get_isolated_fname(vn, in_path))
+            if overwrite or not os.path.exists(out_path):
+                out_paths[vn] = out_path
+
+        if len(out_paths) > 0:
+            utils.split_nc(in_path, out_paths, exclude_vns=self.vns[comp])
+
+    def bigbang(self, comp, output_dirpath, timespan=None, overwrite=True, nproc=1, vns=None, splitter='ncks'):
+        ''' Split the history files into per-variable files
+
+        Args:
+            splitter (str): "ncks" to call `ncks` once for each (history file, variable) pair;
+                "netCDF4" to read each history file only once and write out all the variables in a single pass
+        '''
+        output_dirpath = pathlib.Path(output_dirpath)
+        output_dirpath.mkdir(parents=True, exist_ok=True)
+
+        paths = self.get_paths(comp, timespan=timespan)
+        if vns is None: vns = self.vns[comp]
+        if splitter == 'netCDF4':
+            if nproc == 1:
+                for path in tqdm(paths, desc='Spliting history files'):
+                    self.split_hist(comp, in_path=path, output_dirpath=output_dirpath, overwrite=overwrite, vns=vns)
+            else:
+                utils.p_hint(f'>>> nproc: {nproc}')
+                with self.handle.pool(nproc) as p:
+                    arg_list = [('split_hist', comp, path, output_dirpath, overwrite, vns) for path in paths]
+                    p.starmap(run_case_task, tqdm(arg_list, total=len(arg_list), desc=f'Spliting {len(paths)} history files for {len(vns)} variables'))
+        elif splitter == 'ncks':
+            if nproc == 1:
+                for path in tqdm(paths, desc='Spliting history files'):
+                    for vn in vns:
+                        self.isolate_vn(vn, comp, in_path=path, output_dirpath=output_dirpath, overwrite=overwrite)
+            else:
+                utils.p_hint(f'>>> nproc: {nproc}')
+                with self.handle.pool(nproc) as p:
+                    arg_list = []
+                    for path in paths:
+                        for vn in vns:
+                            arg_list.append(('isolate_vn', vn, comp, path, output_dirpath, overwrite))
+                    p.starmap(run_case_task, tqdm(arg_list, total=len(arg_list), desc=f'Spliting {len(paths)} history files for {len(vns)} variables'))
+        else:
+            raise ValueError('`splitter` options: {"ncks", "netCDF4"}')
+
+    def get_ts_fname(self, vn, paths):
+        date_start = ''.join(paths[0].split('.')[-2].split('-'))
+        date_end = ''.join(paths[-1].split('.')[-2].split('-'))
+
+        bn_elements = self.get_isolated_fname(vn, paths[0]).split('.')
+        bn_elements[-2] = f'{date_start}-{date_end}'
+        return '.'.join(bn_elements)
+
+    def transpose(self, comp, output_dirpath, timespan=None, overwrite=True, nproc=1, vns=None, compression=1):
+        ''' Generate timeseries files directly from the history files
+
+        Each history file within `timespan` is opened only once and the slab of each variable is appended
+        straight into its timeseries file, skipping the intermediate files of `bigbang`.
+        With `nproc` > 1, the variables are divided into `nproc` groups processed in parallel.
+        '''
         output_dirpath = pathlib.Path(output_dirpath)
         output_dirpath.mkdir(parents=True, exist_ok=True)
 
         paths = self.get_paths(comp, timespan=timespan)
         if vns is None: vns = self.vns[comp]
+
+        out_paths = {}
+        for vn in vns:
+            out_path = os.path.join(output_dirpath, self.get_ts_fname(vn, paths))
+            if overwrite or not os.path.exists(out_path):
+                out_paths[vn] = out_path
+
+        if len(out_paths) == 0: return
+
         if nproc == 1:
-            for path in tqdm(paths, desc='Spliting history files'):
-                for vn in vns:
-                    self.isolate_vn(vn, comp, in_path=path, output_dirpath=output_dirpath, overwrite=overwrite)
+            utils.transpose_nc(paths, out_paths, exclude_vns=self.vns[comp], compression=compression)
         else:
             utils.p_hint(f'>>> nproc: {nproc}')
+            vn_groups = np.array_split(list(out_paths), min(nproc, len(out_paths)))
             with mp.Pool(processes=nproc) as p:
-                arg_list = []
-                for path in paths:
-                    for vn in vns:
-                        arg_list.append((vn, comp, path, output_dirpath, overwrite))
-                p.starmap(self.isolate_vn, tqdm(arg_list, total=len(arg_list), desc=f'Spliting {len(paths)} history files for {len(vns)} variables'))
+                arg_list = [(paths, {vn: out_paths[vn] for vn in group}, self.vns[comp], 'time', compression) for group in vn_groups]
+                p.starmap(utils.transpose_nc, tqdm(arg_list, total=len(arg_list), desc=f'Transposing {len(paths)} history files for {len(out_paths)} variables'))
 
     def merge_vn(self, vn, input_dirpath, output_dirpath, timespan=None, overwrite=True, compression=1):
         paths = sorted(glob.glob(os.path.join(input_dirpath, f'*.{vn}.*.nc')))
-        if timespan is None:
-            paths_sub = paths
-        else:
-            syr, eyr = timespan
-            paths_sub = []
-            for path in paths:
-                year = int(path.split('.')[-2].split('-')[0])
-                if (year >= syr and year <= eyr) or (year >= syr and year <= eyr):
-                    paths_sub.append(path)
+        paths_sub = utils.TimeIndex(paths).query(timespan)
 
-        date_start = ''.join(paths[0].split('.')[-2].split('-'))
-        date_end = ''.join(paths[-1].split('.')[-2].split('-'))
+        date_start = ''.join(paths_sub[0].split('.')[-2].split('-'))
+        date_end = ''.join(paths_sub[-1].split('.')[-2].split('-'))
 
-        bn_elements = os.path.basename(paths[0]).split('.')
+        bn_elements = os.path.basename(paths_sub[0]).split('.')
         bn_elements[-2] = f'{date_start}-{date_end}'
 
         if self.casename is not None:
@@ -151,8 +268,15 @@ class History:
 
         if overwrite or not os.path.exists(out_path):
             if os.path.exists(out_path): os.remove(out_path)
-            cmd = f'ncrcat -O -4 -h --no_cll_mth -L {compression} {" ".join(paths_sub)} -o {out_path}'
-            subprocess.run(cmd, shell=True)
+            # write to a temporary file first so that an interrupted run never leaves a truncated output
+            cmd = f'ncrcat -O -4 -h --no_cll_mth -L {compression} {" ".join(paths_sub)} -o {out_path}.tmp'
+            try:
+                subprocess.run(cmd, shell=True, check=True)
+            except subprocess.CalledProcessError:
+                if os.path.exists(f'{out_path}.tmp'): os.remove(f'{out_path}.tmp')
+                raise
+
+            os.replace(f'{out_path}.tmp', out_path)
 
     def bigcrunch(self, comp, input_dirpath, output_dirpath, timespan=None, overwrite=True, nproc=1, compression=1, vns=None):
         output_dirpath = pathlib.Path(output_dirpath)
@@ -165,17 +289,44 @@ class History:
                 self.merge_vn(vn, input_dirpath=input_dirpath, output_dirpath=output_dirpath, timespan=timespan, overwrite=overwrite, compression=compression)
         else:
             utils.p_hint(f'>>> nproc: {nproc}')
-            with mp.Pool(processes=nproc) as p:
+            with self.handle.pool(nproc) as p:
                 arg_list = []
                 for vn in vns:
-                    arg_list.append((vn, input_dirpath, output_dirpath, timespan, overwrite, compression))
-                p.starmap(self.merge_vn, tqdm(arg_list, total=len(arg_list), desc=desc))
+                    arg_list.append(('merge_vn', vn, input_dirpath, output_dirpath, timespan, overwrite, compression))
+                p.starmap(run_case_task, tqdm(arg_list, total=len(arg_list), desc=desc))
 
     def gen_ts(self, output_dirpath, scratch_dirpath=None, comps=['atm', 'ocn', 'lnd', 'ice', 'rof'], timestep=50, timespan=None,
-               dir_structure='comp/proc/tseries/month_1' , overwrite=True, nproc=1, compression=1):
+               dir_structure='comp/proc/tseries/month_1' , overwrite=True, nproc=1, compression=1, splitter='ncks', engine='bigbang',
+               resume=True, verify=False, max_io=None, max_chunks=2, output_format='nc', zarr_chunks=None):
+        ''' Generate timeseries files from the history files
+
+        The work is scheduled as a task graph over (component, sub-timespan, variable) units on a single pool of `nproc` workers,
+        so that all components and sub-timespans share the workers, and a chunk of (component, sub-timespan) is split
+        while the previous chunks are merged.
+
+        Each completed unit is recorded in the manifest file `.gen_ts_manifest.json` under `output_dirpath`,
+        along with the size and the MD5 checksum of its output file.
+
+        Args:
+            engine (str): "bigbang" to split the history files into per-variable files in a scratch directory and then merge them;
+                "direct" to append the slabs of the history files straight into the timeseries files via `transpose`
+            splitter (str): the splitter used by the "bigbang" engine; see `bigbang`
+            resume (bool): if True, skip the units recorded in the manifest and regenerate the rest;
+                if False, start over with an empty manifest
+            verify (bool): if True, verify the checksums of the recorded output files when resuming
+            max_io (int): the maximum number of I/O tasks running concurrently; None means `nproc`
+            max_chunks (int): the maximum number of chunks whose split files coexist in the scratch directory for the "bigbang" engine
+            output_format (str): "nc" for a netCDF file per sub-timespan; "zarr" for a Zarr store per variable over the whole `timespan`,
+                to which the sub-timespans are appended in order as soon as they are merged, while the stores of different variables
+                are written concurrently by the workers
+            zarr_chunks (dict): the chunk sizes of the Zarr stores; see `utils.get_zarr_chunks`
+        '''
 
         if scratch_dirpath is None: scratch_dirpath = output_dirpath
         if timespan is None: raise ValueError('Please specify `timespan`.')
+        if engine not in ['bigbang', 'direct']: raise ValueError('`engine` options: {"bigbang", "direct"}')
+        if splitter not in ['ncks', 'netCDF4']: raise ValueError('`splitter` options: {"ncks", "netCDF4"}')
+        if output_format not in utils.output_exts: raise ValueError('`output_format` options: {"nc", "zarr"}')
 
         syr = timespan[0]
         nt = (timespan[-1] - timespan[0] + 1) // timestep
@@ -187,48 +338,153 @@ class History:
         if type(comps) is not dict:
             comps = {comp: None for comp in comps}
 
-        for comp, vns in comps.items():
-            # generate timeseries files for each component and each sub-timespan
-            utils.p_header(f'>>> Processing component: {comp}')
-            for timespan_tmp in timespan_list:
-                utils.p_header(f'>>> Processing timespan: {timespan_tmp}')
-                bigbang_dir = os.path.join(scratch_dirpath, f'.bigbang_{comp}.{timespan_tmp[0]}-{timespan_tmp[1]}')
-                if os.path.exists(bigbang_dir): shutil.rmtree(bigbang_dir)
-                self.bigbang(comp=comp, output_dirpath=bigbang_dir, timespan=timespan_tmp, overwrite=overwrite, nproc=nproc, vns=vns)
-
-                bigcrunch_dir = os.path.join(scratch_dirpath, dir_structure.replace('comp', comp))
-                self.bigcrunch(comp=comp, input_dirpath=bigbang_dir, output_dirpath=bigcrunch_dir, timespan=timespan_tmp, overwrite=overwrite, nproc=nproc, compression=compression, vns=vns)
+        manifest = utils.Manifest(os.path.join(output_dirpath, '.gen_ts_manifest.json'), reset=not resume)
+
+        # the manifest is saved once all the units of a chunk of (component, sub-timespan) are completed
+        pending = collections.Counter()
+        def record(comp, vn, timespan):
+            chunk = (comp, timespan)
+            pending[chunk] += 1
+            def callback(res):
+                if res is not None:
+                    path, md5 = res
+                    manifest.add(comp, vn, timespan, path, md5=md5)
+                pending[chunk] -= 1
+                if pending[chunk] == 0: manifest.save()
+            return callback
+
+        # the methods of the case are called by name on the case rebuilt in each worker
+        if nproc == 1:
+            case_task = lambda method, *args: getattr(self, method)(*args)
+        else:
+            case_task = run_case_task
+
+        graph = utils.TaskGraph()
+        cleanup_keys = []
+        store_paths = {}
+        append_keys = {}
+        for timespan_tmp in timespan_list:
+            for comp, vns in comps.items():
+                if vns is None: vns = self.vns[comp]
+                chunk = (comp, timespan_tmp)
+                paths = self.get_paths(comp, timespan=timespan_tmp)
+                if len(paths) == 0:
+                    utils.p_warning(f'>>> {comp} {timespan_tmp}: no history files found')
+                    continue
 
-        for comp, vns in comps.items():
-            # delete the temporary files
-            utils.p_header(f'>>> Postprocessing component: {comp}')
-            for timespan_tmp in timespan_list:
-                utils.p_header(f'>>> Postprocessing timespan: {timespan_tmp}')
                 bigbang_dir = os.path.join(scratch_dirpath, f'.bigbang_{comp}.{timespan_tmp[0]}-{timespan_tmp[1]}')
                 bigcrunch_dir = os.path.join(scratch_dirpath, dir_structure.replace('comp', comp))
-                if os.path.exists(bigbang_dir): shutil.rmtree(bigbang_dir)
-                if scratch_dirpath != output_dirpath:
-                    # move files from scratch to destination
-                    dest_dirpath = os.path.join(output_dirpath, dir_structure.replace('comp', comp))
-                    dest_dirpath = pathlib.Path(dest_dirpath)
-                    dest_dirpath.mkdir(parents=True, exist_ok=True)
-                    src_paths = glob.glob(os.path.join(bigcrunch_dir, f'*.{timespan_tmp[0]}01-{timespan_tmp[1]}12.nc'))
-                    # [shutil.move(src_path, dest_dirpath) for src_path in src_paths]
-                    # print(f'{src_paths =}')
-                    # print(f'{dest_dirpath =}')
-                    # for src_path in src_paths:
-                    #     dst_path = os.path.join(dest_dirpath, os.path.basename(src_path))
-                    #     if os.path.exists(dst_path):
-                    #         os.remove(dst_path)
-                            
-                    # with mp.Pool(processes=nproc) as p:
-                    #     arg_list = [(src_path, dest_dirpath) for src_path in src_paths]
-                    #     p.starmap(shutil.move, tqdm(arg_list, total=len(arg_list), desc=f'Moving generated files\nfrom: {scratch_dirpath}\nto: {output_dirpath}\n'))
-
-                    with mp.Pool(processes=nproc) as p:
-                        arg_list = [(src_path, dest_dirpath) for src_path in src_paths]
-                        p.starmap(utils.move_with_overwrite, tqdm(arg_list, total=len(arg_list), desc=f'Moving generated files\nfrom: {scratch_dirpath}\nto: {output_dirpath}\n'))
-
+                dest_dirpath = os.path.join(output_dirpath, dir_structure.replace('comp', comp))
+                if output_format == 'zarr':
+                    if comp not in store_paths:
+                        # the stores are named after the whole timespan
+                        paths_all = self.get_paths(comp, timespan=timespan)
+                        store_paths[comp] = {vn: os.path.join(dest_dirpath, f'{self.get_ts_fname(vn, paths_all)[:-3]}.zarr') for vn in vns}
+                        if not resume and overwrite:
+                            for vn in vns: utils.remove_path(store_paths[comp][vn])
+                    dest_paths = store_paths[comp]
+                else:
+                    dest_paths = {vn: os.path.join(dest_dirpath, self.get_ts_fname(vn, paths)) for vn in vns}
+
+                if resume:
+                    # a sub-timespan appended to a store has to be regenerated once an earlier one is
+                    vns_todo = [
+                        vn for vn in vns
+                        if (comp, vn) in append_keys or not manifest.is_done(comp, vn, timespan_tmp, dest_paths[vn], verify=verify)
+                    ]
+                    if len(vns_todo) < len(vns):
+                        utils.p_hint(f'>>> {comp} {timespan_tmp}: {len(vns)-len(vns_todo)} variables already completed according to the manifest')
+                    if not overwrite and output_format == 'nc':
+                        # the outputs are written through temporary files, so an existing one is complete even if not recorded
+                        n_todo = len(vns_todo)
+                        vns_todo = [vn for vn in vns_todo if not os.path.exists(dest_paths[vn])]
+                        if len(vns_todo) < n_todo:
+                            utils.p_hint(f'>>> {comp} {timespan_tmp}: {n_todo-len(vns_todo)} variables skipped as the output files exist')
+                else:
+                    vns_todo = vns
+
+                _overwrite = overwrite
+
+                if len(vns_todo) == 0: continue
+                pathlib.Path(bigcrunch_dir).mkdir(parents=True, exist_ok=True)
+                pathlib.Path(dest_dirpath).mkdir(parents=True, exist_ok=True)
+                scratch_paths = {vn: os.path.join(bigcrunch_dir, self.get_ts_fname(vn, paths)) for vn in vns_todo}
+                idx = len(cleanup_keys)
+
+                if engine == 'direct':
+                    out_paths = {vn: scratch_paths[vn] for vn in vns_todo if _overwrite or not os.path.exists(scratch_paths[vn])}
+                    vn_groups = np.array_split(list(out_paths), min(nproc, len(out_paths))) if len(out_paths) > 0 else []
+                    merge_keys = {}
+                    for i, group in enumerate(vn_groups):
+                        key = graph.add(
+                            ('transpose', chunk, i), utils.transpose_nc,
+                            args=(paths, {vn: out_paths[vn] for vn in group}, self.vns[comp], 'time', compression),
+                            priority=(idx, 0),
+                        )
+                        merge_keys.update({vn: key for vn in group})
+
+                    cleanup_keys.append(None)
+                else:
+                    if os.path.exists(bigbang_dir): shutil.rmtree(bigbang_dir)
+                    pathlib.Path(bigbang_dir).mkdir(parents=True, exist_ok=True)
+                    # limit the number of chunks with split files in the scratch directory
+                    deps = [] if idx < max_chunks or cleanup_keys[idx-max_chunks] is None else [cleanup_keys[idx-max_chunks]]
+                    split_keys = {vn: [] for vn in vns_todo}
+                    for path in paths:
+                        if splitter == 'netCDF4':
+                            key = graph.add(
+                                ('split', chunk, path), case_task,
+                                args=('split_hist', comp, path, bigbang_dir, _overwrite, vns_todo),
+                                deps=deps, priority=(idx, 0),
+                            )
+                            for vn in vns_todo: split_keys[vn].append(key)
+                        else:
+                            for vn in vns_todo:
+                                key = graph.add(
+                                    ('split', chunk, path, vn), case_task,
+                                    args=('isolate_vn', vn, comp, path, bigbang_dir, _overwrite),
+                                    deps=deps, priority=(idx, 0),
+                                )
+                                split_keys[vn].append(key)
+
+                    merge_keys = {}
+                    for vn in vns_todo:
+                        merge_keys[vn] = graph.add(
+                            ('merge', chunk, vn), case_task,
+                            args=('merge_vn', vn, bigbang_dir, bigcrunch_dir, timespan_tmp, _overwrite, compression),
+                            deps=split_keys[vn], priority=(idx, 1),
+                        )
+
+                    cleanup_keys.append(graph.add(
+                        ('cleanup', chunk), shutil.rmtree, args=(bigbang_dir, True),
+                        deps=list(merge_keys.values()), priority=(idx, 2), io=False,
+                    ))
+
+                for vn in vns_todo:
+                    if output_format == 'zarr':
+                        # the sub-timespans of a variable are appended in order
+                        deps = [merge_keys[vn]] if vn in merge_keys else []
+                        if (comp, vn) in append_keys: deps.append(append_keys[(comp, vn)])
+                        append_keys[(comp, vn)] = graph.add(
+                            ('append', chunk, vn), utils.append_zarr,
+                            args=(scratch_paths[vn], dest_paths[vn], 'time', zarr_chunks),
+                            deps=deps, priority=(idx, 3), callback=record(comp, vn, timespan_tmp),
+                        )
+                    else:
+                        graph.add(
+                            ('finalize', chunk, vn), utils.finalize_output,
+                            args=(scratch_paths[vn], dest_dirpath),
+                            deps=[merge_keys[vn]] if vn in merge_keys else None,
+                            priority=(idx, 3), callback=record(comp, vn, timespan_tmp),
+                        )
+
+        utils.p_header(f'>>> Generating timeseries files for {len(cleanup_keys)} chunks of (component, timespan)')
+        if nproc > 1: utils.p_hint(f'>>> nproc: {nproc}')
+        try:
+            graph.run(nproc=nproc, max_io=max_io, desc='Running tasks', initializer=init_worker, initargs=(self.handle,))
+        finally:
+            # the units completed before a failure are kept for resuming
+            manifest.save()
 
     # def split_ds(self, comp, in_path, output_dirpath, overwrite=False, nco=True):
     #     if not nco: ds = xr.load_dataset(in_path)
@@ -512,11 +768,20 @@ class Timeseries:
         root_dir (str): the root directory of the CESM Timeseries output
         grid_dict (dict): the grid dictionary for different components
         timestep (int): the number of years stored in a single timeseries file
+        catalog_path (str): the path to the file catalog; see `x4c.catalog.Catalog`
+        cache_dir (str): the directory to cache the calculated diagnostics across sessions; see `x4c.cache.DiagCache`
+        cache_max_size (int): the maximum total size of the cached diagnostics in bytes
+        ref_dir (str): the directory to store the references that open the multi-file record of a variable as one dataset;
+            see `x4c.refs.RefStore`; None to open the files directly
+        mem_budget (int): the memory budget per dask worker in bytes, under which the chunks of the loaded files are planned;
+            see `x4c.utils.plan_chunks`
     '''
-    def __init__(self, root_dir, grid_dict=None, casename=None):
+    def __init__(self, root_dir, grid_dict=None, casename=None, catalog_path=None, cache_dir=None, cache_max_size=8*2**30, ref_dir=None,
+                 mem_budget=2**30):
         self.path_pattern='comp/proc/tseries/month_1/casename.mdl.h_str.vn.timespan.nc'
         self.root_dir = os.path.abspath(root_dir)
         self.casename = casename
+        self.mem_budget = mem_budget
 
         self.grid_dict = {'atm': 'ne30pg3', 'ocn': 'g16'}
         if grid_dict is not None:
@@ -532,37 +797,76 @@ class Timeseries:
         if self.casename is not None:
             utils.p_header(f'>>> case.casename: {self.casename}')
 
-        self.paths = utils.find_paths(self.root_dir, self.path_pattern)
+        self.catalog = Catalog(self.root_dir, path=catalog_path)
+        self.catalog.refresh()
+        utils.p_header(f'>>> case.catalog: {self.catalog.path}')
+
+        self.paths = self.catalog.get_all_paths()
 
         self.ds = {}
         self.diags = {}
-        self.vars_info = {}
-        for path in self.paths:
-            comp = path.split('/')[-5]
-            mdl = path.split('.')[-5]
-            h_str = path.split('.')[-4]
-            vn = path.split('.')[-3]
-            if (vn, comp) not in self.vars_info:
-                self.vars_info[(vn, comp)] = (comp, mdl, h_str)
+        self.diags_info = {}
+        self.loaded_vns = None
+        self.vars_info = self.catalog.get_vars_info()
+
+        self.diag_cache = DiagCache(cache_dir, max_size=cache_max_size)
+        if cache_dir is not None:
+            utils.p_header(f'>>> case.diag_cache: {self.diag_cache.cache_dir}')
+
+        self.ref_store = None if ref_dir is None else RefStore(ref_dir)
+        if ref_dir is not None:
+            utils.p_header(f'>>> case.ref_store: {self.ref_store.ref_dir}')
 
         utils.p_success(f'>>> case.vars_info created')
 
+    @property
+    def handle(self):
+        ''' the `CaseHandle` to rebuild the case in a worker process, without the loaded datasets and diagnostics '''
+        return CaseHandle('Timeseries', (
+            ('root_dir', self.root_dir),
+            ('casename', self.casename),
+            ('grid_dict', tuple(self.grid_dict.items())),
+            ('catalog_path', self.catalog.path),
+            ('catalog_subdir', self.catalog.subdir),
+            ('cache_dir', self.diag_cache.cache_dir),
+            ('cache_max_size', self.diag_cache.max_size),
+            ('ref_dir', None if self.ref_store is None else self.ref_store.ref_dir),
+            ('mem_budget', self.mem_budget),
+        ))
+
+    @classmethod
+    def from_handle(cls, root_dir, casename, grid_dict, catalog_path, catalog_subdir, cache_dir, cache_max_size, ref_dir, mem_budget):
+        ''' Rebuild the case from its catalog on the disk, without the messages of `__init__` '''
+        case = cls.__new__(cls)
+        case.path_pattern = 'comp/proc/tseries/month_1/casename.mdl.h_str.vn.timespan.nc'
+        case.root_dir = root_dir
+        case.casename = casename
+        case.mem_budget = mem_budget
+        case.grid_dict = dict(grid_dict)
+        case.catalog = Catalog(root_dir, path=catalog_path, subdir=catalog_subdir)
+        if case.catalog.path == ':memory:': case.catalog.refresh()
+        case.paths = case.catalog.get_all_paths()
+        case.ds = {}
+        case.diags = {}
+        case.diags_info = {}
+        case.loaded_vns = None
+        case.vars_info = case.catalog.get_vars_info()
+        case.diag_cache = DiagCache(cache_dir, max_size=cache_max_size)
+        case.ref_store = None if ref_dir is None else RefStore(ref_dir)
+        return case
+
+    def refresh(self):
+        ''' Update the file catalog and `.vars_info` for the files added or removed since the last refresh
+        '''
+        self.catalog.refresh()
+        self.paths = self.catalog.get_all_paths()
+        self.vars_info = self.catalog.get_vars_info()
+
     def get_paths(self, vn, comp=None, timespan=None):
+        ''' Return the paths of a variable from the catalog; call `refresh` to pick up the files changed since then '''
         if comp is None: comp = self.get_vn_comp(vn)
         comp, mdl, h_str = self.vars_info[(vn, comp)]
-        paths = utils.find_paths(self.root_dir, self.path_pattern, vn=vn, comp=comp, mdl=mdl, h_str=h_str)
-        if timespan is None:
-            paths_sub = paths
-        else:
-            syr, eyr = timespan
-            paths_sub = []
-            for path in paths:
-                syr_tmp = int(path.split('.')[-2].split('-')[0][:4])
-                eyr_tmp = int(path.split('.')[-2].split('-')[1][:4])
-                if (syr_tmp >= syr and syr_tmp <= eyr) or (eyr_tmp >= syr and eyr_tmp <= eyr):
-                    paths_sub.append(path)
-
-        return paths_sub
+        return self.catalog.get_paths(comp, mdl, h_str, vn, timespan=timespan)
 
     def get_vn_comp(self, vn):
         comps = []
@@ -573,7 +877,7 @@ class Timeseries:
         if len(comps) == 1:
             return comps[0]
         elif len(comps) == 0:
-            if f'get_{vn}' in diags.DiagCalc.__dict__:
+            if vn in diags.derived_vars:
                 utils.p_warning(f'>>> {vn} is a supported derived variable.')
             else:
                 raise ValueError('The input variable name is unknown.')
@@ -582,11 +886,30 @@ class Timeseries:
             raise ValueError('The input variable name belongs to multiple components. Please specify via the argument `comp`.')
 
     
-    def load(self, vn, comp=None, timespan=None, load_idx=-1, adjust_month=True, verbose=True, **kws):
+    def load(self, vn, comp=None, timespan=None, load_idx=-1, adjust_month=True, verbose=True, nworkers=None, **kws):
+        ''' Load variables into `.ds`
+
+        Args:
+            vn (str or list): a variable name, or a list of variable names (e.g., the inputs of a derived diagnostic),
+                whose paths are resolved and datasets opened concurrently in a thread pool
+            nworkers (int): the number of threads for a list of variables; defaults to the number of variables
+        '''
+        if isinstance(vn, (list, tuple)):
+            vns = list(dict.fromkeys(vn))
+            if nworkers is None: nworkers = len(vns)
+            with ThreadPoolExecutor(max(nworkers, 1)) as exe:
+                futures = [
+                    exe.submit(self.load, v, comp=comp, timespan=timespan, load_idx=load_idx, adjust_month=adjust_month, verbose=verbose, **kws)
+                    for v in vns
+                ]
+                for future in futures: future.result()
+            return
+
         if comp is None:
             comp = self.get_vn_comp(vn)
 
         if (vn, comp) in self.vars_info:
+            if self.loaded_vns is not None: self.loaded_vns.add((vn, comp))
             if timespan is None:
                 paths = self.get_paths(vn, comp=comp)[load_idx]
             else:
@@ -608,9 +931,16 @@ class Timeseries:
                 }
                 _kws.update(kws)
                 if not isinstance(paths, (list, tuple)):
-                    ds =  core.open_dataset(paths, **_kws)
+                    ds =  core.open_dataset(paths, mem_budget=self.mem_budget, **_kws)
+                elif self.ref_store is not None and len(kws) == 0 and not any(utils.is_zarr(p) for p in paths):
+                    try:
+                        chunks = utils.plan_file_chunks(paths[0], vn=vn, mem_budget=self.mem_budget)
+                        ds = self.ref_store.open(paths, chunks=chunks, **_kws)
+                    except Exception as err:
+                        if verbose: utils.p_warning(f'>>> Failed to open {vn} from the references ({err}); opening the files directly')
+                        ds =  core.open_mfdataset(paths, mem_budget=self.mem_budget, **_kws)
                 else:
-                    ds =  core.open_mfdataset(paths, **_kws)
+                    ds =  core.open_mfdataset(paths, mem_budget=self.mem_budget, **_kws)
 
                 self.ds[vn] = ds
                 self.ds[vn].attrs['vn'] = vn
@@ -621,40 +951,48 @@ class Timeseries:
         else:
             if verbose: utils.p_warning(f'>>> Variable {vn} not existing')
 
-    def calc(self, spell:str, comp=None, timespan=None, load_idx=-1, adjust_month=True, verbose=True):
-        ''' Calculate a diagnostic spell
+    def calc_vn(self, vn, comp=None, timespan=None, load_idx=-1, adjust_month=True, verbose=True):
+        ''' Load a variable or calculate a derived one; the "load" step of a spell
         '''
-        S = Spell(spell)
-        if S.slicing is None:
-            vn = S.vn
-        else:
-            vn = S.vn.split('.')[0]
-
-        if vn in self.diags:
+        info = self.diags_info.get(vn)
+        if info is not None and info['spell'] != vn:
+            # a diagnostic named by an alias; recalculated only if its inputs have changed
+            da = self.calc(info['spell'], comp=info['comp'], timespan=timespan, load_idx=load_idx, adjust_month=adjust_month, verbose=verbose)
+        elif vn in self.diags and info is None:
             da = self.diags[vn]
             utils.p_warning(f'>>> Variable `{vn}` is already calculated and the calculation is skipped.')
         else:
             if comp is None: comp = self.get_vn_comp(vn)
-            if f'get_{vn}' in diags.DiagCalc.__dict__:
-                da = diags.DiagCalc.__dict__[f'get_{vn}'](self, timespan=timespan, load_idx=load_idx, adjust_month=adjust_month, verbose=verbose)
+            if vn in diags.derived_vars:
+                da = diags.calc_derived(self, [vn], timespan=timespan, load_idx=load_idx, adjust_month=adjust_month, verbose=verbose)[vn]
             elif (vn, comp) in self.vars_info:
                 self.load(vn, comp=comp, timespan=timespan, load_idx=load_idx, adjust_month=adjust_month, verbose=verbose)
                 da = self.ds[vn].x.da
             else:
                 raise ValueError(f'Unknown diagnostic variable: {vn}')
 
-        if S.slicing is not None:
-            cmd = f'da.{S.slicing}'
-            da = eval(cmd)
+        return da
+
+    def calc_op(self, da, op, arg, vn=None):
+        ''' Apply a single step other than "load" of a spell
 
-        if S.plev is not None:
+        Args:
+            da (xarray.DataArray): the result of the previous step
+            op (str): the name of the step, see `Spell.ops`
+            arg (str): the argument of the step
+            vn (str): the variable name of the spell
+        '''
+        if op == 'slice':
+            da = eval(f'da.{arg}')
+
+        elif op == 'plev':
             self.load('PS')
             PS = self.ds['PS']['PS']
             hyam = self.ds[vn]['hyam']
             hybm = self.ds[vn]['hybm']
             _kws = {'lev_dim': 'lev'}
-            if '(' in S.plev and ')' in S.plev:
-                new_levels = eval(S.plev.split('plev')[-1])
+            if '(' in arg and ')' in arg:
+                new_levels = eval(arg.split('plev')[-1])
                 if type(new_levels) not in (list, tuple):
                     new_levels = [new_levels]
 
@@ -662,39 +1000,219 @@ class Timeseries:
 
             da = da.x.get_plev(ps=PS, hyam=hyam, hybm=hybm, **_kws)
 
-        if S.ann_method is not None:
-            da = utils.ann_modifier(da, ann_method=S.ann_method, long_name=da.long_name)
+        elif op == 'ann':
+            da = utils.ann_modifier(da, ann_method=arg, long_name=da.long_name)
 
-        if S.sa_method is not None:
-            if S.sa_method in ['gm', 'nhm', 'shm', 'zm', 'gs', 'nhs', 'shs', 'somin']:
-                da = getattr(da.x, S.sa_method)
-            elif S.sa_method == 'yz':
+        elif op == 'sa':
+            if arg in ['gm', 'nhm', 'shm', 'zm', 'gs', 'nhs', 'shs', 'somin']:
+                da = getattr(da.x, arg)
+            elif arg == 'yz':
                 if da.name == 'MOC':
                     da = da
                 else:
                     da = da.x.zm
             else:
-                raise ValueError(f'Unknown spatial average method: {S.sa_method}')
+                raise ValueError(f'Unknown spatial average method: {arg}')
 
-        if S.regrid is not None:
-            da = eval(f'da.x.{S.regrid}')
+        elif op in ['regrid', 'zavg']:
+            da = eval(f'da.x.{arg}')
 
-        if S.zavg is not None:
-            da = eval(f'da.x.{S.zavg}')
+        else:
+            raise ValueError(f'Unknown spell operation: {op}')
 
+        return da
+
+    def finalize_diag(self, da, alias=None):
+        ''' Convert the temperature units and rename by the alias of a spell '''
+        da = da.copy(deep=False)
         if da.units == 'degC':
             da.attrs['units'] = '°C'
         elif da.units == 'K':
-            da -= 273.15
+            da = da - 273.15
             da.attrs['units'] = '°C'
 
-        if S.alias is not None:
-            spell = S.alias
-            da.name = S.alias
+        if alias is not None:
+            da.name = alias
+
+        return da.squeeze()
+
+    def get_diag_key(self, spell, comp=None, timespan=None, load_idx=-1, adjust_month=True):
+        ''' Return the cache key of a spell from the fingerprints of its input files; None if the inputs are unknown
+        '''
+        spell_key = DiagCache.get_spell_key(spell, comp=comp, timespan=timespan, load_idx=load_idx, adjust_month=adjust_month)
+        inputs = self.diag_cache.get_inputs(spell_key)
+        if inputs is None: return None
+
+        fingerprints = []
+        try:
+            for vn, c in inputs:
+                if timespan is None:
+                    paths = [self.get_paths(vn, comp=c)[load_idx]]
+                else:
+                    paths = self.get_paths(vn, comp=c, timespan=timespan)
+
+                for path in paths:
+                    stat = os.stat(path)
+                    fingerprints.append((path, stat.st_mtime_ns, stat.st_size))
+        except (KeyError, IndexError, OSError):
+            return None
+
+        return DiagCache.get_key(spell_key, fingerprints)
+
+    def get_cached_diag(self, spell, name, **kws):
+        ''' Return the diagnostic of a spell if calculated from the current input files, from `.diags` or the disk cache; None otherwise
+        '''
+        key = self.get_diag_key(spell, **kws)
+        if key is None: return None
+
+        if self.loaded_vns is not None:
+            # the inputs of a diagnostic reused in another spell are also inputs of that spell
+            inputs = self.diag_cache.get_inputs(DiagCache.get_spell_key(spell, **kws))
+            self.loaded_vns.update(tuple(i) for i in inputs)
+
+        if name in self.diags and self.diags_info.get(name, {}).get('key') == key:
+            return self.diags[name]
+
+        da = self.diag_cache.get(key)
+        if da is not None:
+            self.diags[name] = da
+            self.diags_info[name] = {'spell': spell, 'comp': kws.get('comp'), 'key': key}
+        return da
+
+    def cache_diag(self, spell, name, da, inputs, compute=True, **kws):
+        ''' Record the inputs of a calculated diagnostic and store it in the cache if small enough
+
+        The diagnostic in `.diags` is kept as is, i.e., lazy unless computed by the caller.
+
+        Args:
+            compute (bool): if False, the diagnostic is not stored in the cache, which would compute it
+        '''
+        spell_key = DiagCache.get_spell_key(spell, **kws)
+        self.diag_cache.set_inputs(spell_key, inputs)
+        key = self.get_diag_key(spell, **kws)
+        if key is not None and compute and self.diag_cache.fits(da):
+            self.diag_cache.put(key, da)
+
+        self.diags[name] = da
+        self.diags_info[name] = {'spell': spell, 'comp': kws.get('comp'), 'key': key}
+        return da
+
+    def calc(self, spell:str, comp=None, timespan=None, load_idx=-1, adjust_month=True, verbose=True):
+        ''' Calculate a diagnostic spell
+
+        The result is reused if the spell has been calculated with the same options from the same input files,
+        either in the current session or, if `cache_dir` is set, in a previous one.
+        '''
+        S = Spell(spell)
+        name = spell if S.alias is None else S.alias
+        kws = {'comp': comp, 'timespan': timespan, 'load_idx': load_idx, 'adjust_month': adjust_month}
+        da = self.get_cached_diag(spell, name, **kws)
+        if da is not None:
+            if verbose: utils.p_success(f'>>> case.diags["{name}"] loaded from the cache')
+            return da
+
+        vn = S.ops[0][1]
+        outer_vns, self.loaded_vns = self.loaded_vns, set()
+        try:
+            for op, arg in S.ops:
+                if op == 'load':
+                    da = self.calc_vn(vn, comp=comp, timespan=timespan, load_idx=load_idx, adjust_month=adjust_month, verbose=verbose)
+                else:
+                    da = self.calc_op(da, op, arg, vn=vn)
+        finally:
+            inputs, self.loaded_vns = self.loaded_vns, outer_vns
+            if outer_vns is not None: outer_vns.update(inputs)
 
-        self.diags[spell] = da.squeeze()
-        if verbose: utils.p_success(f'>>> case.diags["{spell}"] created')
-        return self.diags[spell]
+        self.cache_diag(spell, name, self.finalize_diag(da, alias=S.alias), inputs, **kws)
+        if verbose: utils.p_success(f'>>> case.diags["{name}"] created')
+        return self.diags[name]
+
+    def calc_batch(self, spells, comp=None, timespan=None, load_idx=-1, adjust_month=True, verbose=True, compute=True):
+        ''' Calculate multiple diagnostic spells at once
+
+        The spells are merged into a single plan, where the steps shared by several spells (e.g., the same load
+        or the same annualization) are evaluated only once, and all the results are computed in a single `dask.compute` call.
+        The spatial averages of the same field (e.g., "TS:ann:gm" and "TS:ann:nhm") are reduced together via `XDataArray.multi_sa`.
+        The spells calculated from the current input files already are reused as in `calc`.
+
+        Args:
+            spells (list): the list of spells
+            compute (bool): if False, the results are left lazy
+
+        Returns:
+            dict: the results keyed by the spells (or their aliases), also stored in `.diags`
+        '''
+        kws = {'comp': comp, 'timespan': timespan, 'load_idx': load_idx, 'adjust_month': adjust_month}
+        memo = {}
+        res = {}
+        todo = {}
+        outer_vns, self.loaded_vns = self.loaded_vns, set()
+        try:
+            todo_spells = []
+            for spell in spells:
+                S = Spell(spell)
+                name = spell if S.alias is None else S.alias
+                da = self.get_cached_diag(spell, name, **kws)
+                if da is not None:
+                    res[name] = da
+                else:
+                    todo_spells.append((spell, name, S))
+
+            # the inputs of all the spells are loaded at once, and the derived variables are calculated with their shared inputs
+            load_kws = {'timespan': timespan, 'load_idx': load_idx, 'adjust_month': adjust_month, 'verbose': verbose}
+            vns = []
+            for _, _, S in todo_spells:
+                vn = S.ops[0][1]
+                info = self.diags_info.get(vn)
+                if (info is not None and info['spell'] != vn) or (vn in self.diags and info is None): continue
+                if vn not in vns: vns.append(vn)
+
+            derived_vns = [vn for vn in vns if vn in diags.derived_vars]
+            self.load([vn for vn in vns if vn not in diags.derived_vars], comp=comp, **load_kws)
+            if derived_vns:
+                derived = diags.calc_derived(self, derived_vns, **load_kws)
+                for vn in derived_vns: memo[(('load', vn),)] = derived[vn]
+
+            # the spatial averages of the same field are calculated together in one pass
+            sa_groups = {}
+            for _, _, S in todo_spells:
+                for key in S.plan:
+                    op, arg = key[-1]
+                    if op == 'sa' and arg in utils.sa_methods and arg not in sa_groups.setdefault(key[:-1], []):
+                        sa_groups[key[:-1]].append(arg)
+
+            for spell, name, S in todo_spells:
+                vn = S.ops[0][1]
+                for key in S.plan:
+                    if key in memo: continue
+                    op, arg = key[-1]
+                    if op == 'load':
+                        memo[key] = self.calc_vn(vn, comp=comp, timespan=timespan, load_idx=load_idx, adjust_month=adjust_month, verbose=verbose)
+                    elif op == 'sa' and len(sa_groups.get(key[:-1], [])) > 1:
+                        parent = memo[key[:-1]]
+                        multi_key = key[:-1] + (('multi_sa', tuple(sa_groups[key[:-1]])),)
+                        if multi_key not in memo:
+                            memo[multi_key] = parent.x.multi_sa(sa_groups[key[:-1]])
+                        da = memo[multi_key].sel(region=arg, drop=True)
+                        da.attrs = dict(parent.attrs)
+                        if 'long_name' in da.attrs: da.attrs['long_name'] = f'{utils.sa_methods[arg][-1]} {da.attrs["long_name"]}'
+                        memo[key] = da
+                    else:
+                        memo[key] = self.calc_op(memo[key[:-1]], op, arg, vn=vn)
+
+                todo[name] = (spell, self.finalize_diag(memo[S.plan[-1]], alias=S.alias))
+        finally:
+            inputs, self.loaded_vns = self.loaded_vns, outer_vns
+            if outer_vns is not None: outer_vns.update(inputs)
+
+        das = [da for _, da in todo.values()]
+        if compute: das = dask.compute(*das)
+        for (name, (spell, _)), da in zip(todo.items(), das):
+            # the inputs of the whole batch are recorded for each spell, which is conservative for invalidation
+            res[name] = self.cache_diag(spell, name, da, inputs, compute=compute, **kws)
+
+        if verbose: utils.p_success(f'>>> case.diags created: {list(res)}')
+        return res
 
     def plot(self, spell, t_idx=None, timespan=None, **kws):
         if spell not in self.diags:
@@ -843,11 +1361,8 @@ class Timeseries:
             'MOC': 'Meridional Ocean Circulation',
         }
 
-        for k, v in spells.items():
-            if 'zm' in v:
-                self.calc(v, timespan=None)
-            else:
-                self.calc(v, timespan=timespan)
+        self.calc_batch([v for v in spells.values() if 'zm' in v], timespan=None)
+        self.calc_batch([v for v in spells.values() if 'zm' not in v], timespan=timespan)
 
         for k, v in spells.items():
             if len(self.diags[v].dims) == 1 and self.diags[v].dims[0] == 'time':
@@ -879,47 +1394,100 @@ class Timeseries:
 
         return fig, ax
 
-    def get_climo(self, vn, comp=None, timespan=None, adjust_month=True, slicing=False, regrid=False, dlat=1, dlon=1):
+    def get_climo(self, vn, comp=None, timespan=None, adjust_month=True, slicing=False, regrid=False, dlat=1, dlon=1,
+                  streaming=False, variance=False):
         ''' Generate the climatology file for the given variable
 
         Args:
             slicing (bool): could be problematic
+            streaming (bool): if True, walk through the files one monthly slab at a time with running sums, so that the memory
+                is bounded regardless of the length of the record; only `vn` and the variables without time are kept
+            variance (bool): for `streaming=True`, also calculate the variance of each month as `{vn}_var`
         '''
         if comp is None: comp = self.get_vn_comp(vn)
         grid = self.grid_dict[comp]
         paths = self.get_paths(vn, comp=comp, timespan=timespan)
-        ds = core.open_mfdataset(paths, adjust_month=adjust_month)
+        if streaming:
+            ds_out = self.get_streaming_climo(vn, paths, timespan=timespan if slicing else None, adjust_month=adjust_month, variance=variance)
+        else:
+            ds = core.open_mfdataset(paths, adjust_month=adjust_month, mem_budget=self.mem_budget)
+            if slicing: ds = ds.sel(time=slice(timespan[0], timespan[1]))
+            ds_out = ds.x.climo
 
-        if slicing: ds = ds.sel(time=slice(timespan[0], timespan[1]))
-        ds_out = ds.x.climo
         ds_out.attrs['comp'] = comp
         ds_out.attrs['grid'] = grid
         if regrid: ds_out = ds_out.x.regrid(dlat=dlat, dlon=dlon)
         return ds_out
 
+    def get_streaming_climo(self, vn, paths, timespan=None, adjust_month=True, variance=False):
+        ''' Calculate the climatology of a variable from the files one monthly slab at a time; see `utils.ClimoAccumulator`
+
+        Args:
+            timespan (tuple): the (start_year, end_year) of the months to include; None means all
+        '''
+        acc = utils.ClimoAccumulator(variance=variance)
+        years = []
+        ds_out = None
+        for path in paths:
+            with core.open_dataset(path, adjust_month=adjust_month) as ds:
+                if ds_out is None:
+                    # the variables without time and the metadata are taken from the first file
+                    ds_out = ds.drop_vars([v for v in ds.variables if 'time' in ds[v].dims]).load()
+                    da = ds[vn]
+                    dims = [d for d in da.dims if d != 'time']
+                    coords = {k: v.load() for k, v in da.coords.items() if 'time' not in v.dims and k != 'time'}
+                    attrs, dtype = dict(da.attrs), da.dtype
+
+                for i, (year, month) in enumerate(zip(ds['time.year'].values, ds['time.month'].values)):
+                    if timespan is not None and not timespan[0] <= year <= timespan[1]: continue
+                    acc.add(month, ds[vn].isel(time=i).transpose(*dims).values)
+                    years.append(year)
+
+        if len(years) == 0: raise ValueError(f'No data of {vn} in the timespan: {timespan}')
+        dtype = dtype if np.issubdtype(dtype, np.floating) else np.float64
+        ds_out[vn] = xr.DataArray(acc.mean().astype(dtype), dims=['time', *dims], coords={'time': acc.months, **coords}, attrs=attrs)
+        if variance:
+            ds_out[f'{vn}_var'] = xr.DataArray(acc.var().astype(dtype), dims=['time', *dims], coords={'time': acc.months, **coords})
+            if 'units' in attrs: ds_out[f'{vn}_var'].attrs['units'] = f'({attrs["units"]})^2'
+
+        ds_out.attrs['path'] = [os.path.abspath(p) for p in paths]
+        ds_out.attrs['climo_period'] = (min(years), max(years))
+        return ds_out
+
     def save_climo(self, output_dirpath, vn, comp=None, timespan=None, adjust_month=True,
-                   slicing=False, regrid=False, dlat=1, dlon=1, overwrite=False):
+                   slicing=False, regrid=False, dlat=1, dlon=1, overwrite=False, streaming=False, variance=False,
+                   output_format='nc', zarr_chunks=None):
 
         output_dirpath = pathlib.Path(output_dirpath)
         if not output_dirpath.exists():
             output_dirpath.mkdir(parents=True, exist_ok=True)
             utils.p_success(f'>>> output directory created at: {output_dirpath}')
 
-        fname = f'{vn}_climo.nc' if self.casename is None else f'{self.casename}_{vn}_climo.nc'
+        ext = utils.output_exts[output_format]
+        fname = f'{vn}_climo{ext}' if self.casename is None else f'{self.casename}_{vn}_climo{ext}'
         out_path = os.path.join(output_dirpath, fname)
         if overwrite or not os.path.exists(out_path):
-            if os.path.exists(out_path): os.remove(out_path)
             if comp is None: comp = self.get_vn_comp(vn)
 
             climo = self.get_climo(
                 vn, comp=comp, timespan=timespan, adjust_month=adjust_month,
                 slicing=slicing, regrid=regrid, dlat=dlat, dlon=dlon,
+                streaming=streaming, variance=variance,
             )
-            climo.to_netcdf(out_path)
+            utils.save_dataset(climo, out_path, output_format=output_format, chunks=zarr_chunks)
             climo.close()
 
     def gen_climo(self, output_dirpath, comp=None, timespan=None, vns=None, adjust_month=True,
-                  nproc=1, slicing=False, regrid=False, dlat=1, dlon=1, overwrite=False):
+                  nproc=1, slicing=False, regrid=False, dlat=1, dlon=1, overwrite=False, streaming=False, variance=False,
+                  output_format='nc', zarr_chunks=None):
+        ''' Generate the climatology files for multiple variables
+
+        Args:
+            streaming (bool): if True, calculate each climatology with bounded memory; see `get_climo`
+            variance (bool): for `streaming=True`, also save the variance of each month
+            output_format (str): "nc" for netCDF files; "zarr" for Zarr stores with consolidated metadata
+            zarr_chunks (dict): the chunk sizes of the Zarr stores; see `utils.get_zarr_chunks`
+        '''
 
         if comp is None:
             raise ValueError('Please specify component via the argument `comp`.')
@@ -937,13 +1505,14 @@ class Timeseries:
                     output_dirpath, v, comp=comp, timespan=timespan,
                     adjust_month=adjust_month, slicing=slicing,
                     regrid=regrid, dlat=dlat, dlon=dlon,
-                    overwrite=overwrite,
+                    overwrite=overwrite, streaming=streaming, variance=variance,
+                    output_format=output_format, zarr_chunks=zarr_chunks,
                 )
         else:
             utils.p_hint(f'>>> nproc: {nproc}')
-            with mp.Pool(processes=nproc) as p:
-                arg_list = [(output_dirpath, v, comp, timespan, adjust_month, slicing, regrid, dlat, dlon, overwrite) for v in vns]
-                p.starmap(self.save_climo, tqdm(arg_list, total=len(vns), desc=f'Generating climo files'))
+            with self.handle.pool(nproc) as p:
+                arg_list = [('save_climo', output_dirpath, v, comp, timespan, adjust_month, slicing, regrid, dlat, dlon, overwrite, streaming, variance, output_format, zarr_chunks) for v in vns]
+                p.starmap(run_case_task, tqdm(arg_list, total=len(vns), desc=f'Generating climo files'))
 
         utils.p_success(f'>>> {len(vns)} climo files created in: {output_dirpath}')
 
@@ -982,7 +1551,7 @@ class Timeseries:
     def get_mean(self, vn, comp, months=list(range(1, 13)), timespan=None, adjust_month=True, slicing=False, regrid=False, dlat=1, dlon=1):
         grid = self.grid_dict[comp]
         paths = self.get_paths(vn, comp=comp, timespan=timespan)
-        ds = core.open_mfdataset(paths, adjust_month=adjust_month)
+        ds = core.open_mfdataset(paths, adjust_month=adjust_month, mem_budget=self.mem_budget)
 
         if slicing: ds = ds.sel(time=slice(timespan[0], timespan[1]))
         ds_out = ds.x.annualize(months=months)
@@ -994,7 +1563,7 @@ class Timeseries:
     def get_ts(self, vn, comp, timespan=None, adjust_month=True, slicing=False, regrid=False, dlat=1, dlon=1):
         grid = self.grid_dict[comp]
         paths = self.get_paths(vn, comp=comp, timespan=timespan)
-        ds = core.open_mfdataset(paths, adjust_month=adjust_month)
+        ds = core.open_mfdataset(paths, adjust_month=adjust_month, mem_budget=self.mem_budget)
 
         if slicing: ds = ds.sel(time=slice(timespan[0], timespan[1]))
 
@@ -1004,7 +1573,8 @@ class Timeseries:
         if regrid: ds_out = ds_out.x.regrid(dlat=dlat, dlon=dlon)
         return ds_out
 
-    def save_means(self, vn, comp, output_dirpath, timespan, adjust_month=True, slicing=False, regrid=False, dlat=1, dlon=1, overwrite=False):
+    def save_means(self, vn, comp, output_dirpath, timespan, adjust_month=True, slicing=False, regrid=False, dlat=1, dlon=1, overwrite=False,
+                   output_format='nc', zarr_chunks=None):
         output_dirpath = pathlib.Path(output_dirpath)
         if not output_dirpath.exists():
             output_dirpath.mkdir(parents=True, exist_ok=True)
@@ -1012,35 +1582,44 @@ class Timeseries:
 
         ds = self.get_ts(vn, comp, timespan=timespan, adjust_month=adjust_month, slicing=slicing, regrid=False)
 
-        sn_dict = {
-            'ANN': list(range(1, 13)),
-            'DJF': [12, 1, 2],
-            'MAM': [1, 2, 3],
-            'JJA': [6, 7, 8],
-            'SON': [9, 10, 11],
-        }
-
-        for sn, months in sn_dict.items():
+        out_paths = {}
+        for sn in utils.seasons:
             output_subdirpath = pathlib.Path(os.path.join(output_dirpath, sn))
             if not output_subdirpath.exists():
                 output_subdirpath.mkdir(parents=True, exist_ok=True)
 
-            fname = f'{timespan[0]}_{timespan[1]}_{vn}_{sn}_means.nc'
+            fname = f'{timespan[0]}_{timespan[1]}_{vn}_{sn}_means{utils.output_exts[output_format]}'
             if self.casename is not None: fname = f'{self.casename}_{fname}'
 
             out_path = os.path.join(output_subdirpath, fname)
             if overwrite or not os.path.exists(out_path):
-                # ds_ann = self.get_mean(
-                #     vn, comp, months=months, timespan=timespan, adjust_month=adjust_month, slicing=slicing,
-                #     regrid=regrid, dlat=dlat, dlon=dlon, chunk_nt=chunk_nt,
-                # )
-                ds_ann = ds.x.annualize(months=months)
-                if regrid: ds_ann = ds_ann.x.regrid(dlat=dlat, dlon=dlon)
-                ds_ann.to_netcdf(out_path)
-                ds_ann.close()
+                out_paths[sn] = out_path
+
+        if len(out_paths) == 0: return
+
+        # all the seasons are written in a single pass over the data
+        ds_means = utils.seasonal_means(ds, sns=list(out_paths))
+        if regrid:
+            ds_means = {sn: ds_ann.x.regrid(dlat=dlat, dlon=dlon) for sn, ds_ann in ds_means.items()}
+
+        if output_format == 'zarr':
+            tasks = [utils.to_zarr(ds_means[sn], f'{out_path}.tmp', chunks=zarr_chunks, compute=False) for sn, out_path in out_paths.items()]
+            dask.compute(*tasks)
+            for out_path in out_paths.values():
+                utils.remove_path(out_path)
+                os.replace(f'{out_path}.tmp', out_path)
+        else:
+            xr.save_mfdataset(list(ds_means.values()), list(out_paths.values()))
+        ds.close()
 
     def gen_means(self, output_dirpath, comp=None, vns=None, timespan=None, adjust_month=True, slicing=False,
-                  regrid=False, dlat=1, dlon=1, overwrite=False, nproc=1):
+                  regrid=False, dlat=1, dlon=1, overwrite=False, nproc=1, output_format='nc', zarr_chunks=None):
+        ''' Generate the seasonal mean files for multiple variables
+
+        Args:
+            output_format (str): "nc" for netCDF files; "zarr" for Zarr stores with consolidated metadata
+            zarr_chunks (dict): the chunk sizes of the Zarr stores; see `utils.get_zarr_chunks`
+        '''
 
         if comp is None:
             raise ValueError('Please specify component via the argument `comp`.')
@@ -1056,13 +1635,14 @@ class Timeseries:
             for vn in vns:
                 self.save_means(
                     vn, comp, output_dirpath, timespan, adjust_month=adjust_month, slicing=slicing,
-                    regrid=regrid, dlat=dlat, dlon=dlon, overwrite=overwrite, 
+                    regrid=regrid, dlat=dlat, dlon=dlon, overwrite=overwrite,
+                    output_format=output_format, zarr_chunks=zarr_chunks,
                 )
         else:
             utils.p_hint(f'>>> nproc: {nproc}')
-            with mp.Pool(processes=nproc) as p:
-                arg_list = [(vn, comp, output_dirpath, timespan, adjust_month, slicing, regrid, dlat, dlon, overwrite) for vn in vns]
-                p.starmap(self.save_means, tqdm(arg_list, total=len(vns), desc=f'Generating seasonal mean files'))
+            with self.handle.pool(nproc) as p:
+                arg_list = [('save_means', vn, comp, output_dirpath, timespan, adjust_month, slicing, regrid, dlat, dlon, overwrite, output_format, zarr_chunks) for vn in vns]
+                p.starmap(run_case_task, tqdm(arg_list, total=len(vns), desc=f'Generating seasonal mean files'))
 
     def check_timespan(self, comp, vns=None, timespan=None):
         if vns is None:
@@ -1070,15 +1650,15 @@ class Timeseries:
         elif type(vns) is str:
             vns = [vns]
 
-        paths = self.get_paths(vns[0], comp=comp, timespan=timespan)
+        comp, mdl, h_str = self.vars_info[(vns[0], comp)]
+        files = self.catalog.get_files(comp, mdl, h_str, vns[0], timespan=timespan)
         if timespan is None:
-            syr = int(paths[0].split('.')[-2].split('-')[0][:4])
-            eyr = int(paths[-1].split('.')[-2].split('-')[1][:4])
+            syr = files[0][2] // 12
+            eyr = files[-1][3] // 12
         else:
             syr, eyr = timespan
 
-        step_s = int(paths[0].split('.')[-2].split('-')[0][:4])
-        step_e = int(paths[0].split('.')[-2].split('-')[1][:4])
+        step_s, step_e = files[0][2] // 12, files[0][3] // 12
         step = step_e - step_s + 1
 
         full_list = []
@@ -1088,14 +1668,12 @@ class Timeseries:
         df = pd.DataFrame(index=vns, columns=range(1, len(full_list)+1))
 
         for irow, vn in enumerate(vns):
-            paths = self.get_paths(vn, comp=comp, timespan=timespan)
+            comp, mdl, h_str = self.vars_info[(vn, comp)]
+            timestamps = set(row[1] for row in self.catalog.get_files(comp, mdl, h_str, vn, timespan=timespan))
 
             icol = 0
             for timestamp in full_list:
-                path_elements = paths[0].split('.')
-                path_elements[-2] = timestamp
-                path = '.'.join(path_elements)
-                if os.path.exists(path):
+                if timestamp in timestamps:
                     df.iloc[irow, icol] = timestamp
                 else:
                     df.iloc[irow, icol] = f'{timestamp}!'
@@ -1126,21 +1704,43 @@ class Timeseries:
         else:
             self.ds = {}
         
-    def copy(self):
-        return deepcopy(self)
+    def copy(self, deep=True):
+        ''' Return a copy of the case
+
+        Args:
+            deep (bool): if False, the copy has its own `.ds`, `.diags` and `.diags_info` dictionaries, but shares
+                the (lazily loaded) datasets and diagnostics in them, as well as the catalog and the cache, with the case
+        '''
+        if deep: return deepcopy(self)
+
+        case = copy(self)
+        case.ds = dict(self.ds)
+        case.diags = dict(self.diags)
+        case.diags_info = dict(self.diags_info)
+        return case
 
-    def save_spell(self, spell:str, vn:str, output_path:str, timespan=None, overwrite=True, long_name=None, **kws):
-        case = self.copy()
-        case.calc(spell, timespan=timespan)
-        case.diags[spell].name = vn
+    def save_spell(self, spell:str, vn:str, output_path:str, timespan=None, overwrite=True, long_name=None, zarr_chunks=None, **kws):
+        ''' Save the diagnostic of a spell to a netCDF file, or to a Zarr store if `output_path` ends with ".zarr"
+        '''
+        # the datasets loaded for `timespan` replace the ones in `.ds` of the copy only
+        case = self.copy(deep=False)
         if overwrite or not os.path.exists(output_path):
-            da = case.diags[spell]
+            da = case.calc(spell, timespan=timespan).copy(deep=False)
+            da.name = vn
             if long_name is not None: da.attrs['long_name'] = long_name
-            if os.path.exists(output_path): os.remove(output_path)
-            da.x.to_netcdf(output_path, **kws)
+            utils.remove_path(output_path)
+            if utils.is_zarr(output_path):
+                da.x.to_zarr(output_path, chunks=zarr_chunks)
+            else:
+                da.x.to_netcdf(output_path, **kws)
     
-    def gen_ts_spell(self, spell:str, vn:str, comp:str, output_dirpath:str, long_name=None, timespan=None, timestep=50, overwrite=True, nproc=1):
+    def gen_ts_spell(self, spell:str, vn:str, comp:str, output_dirpath:str, long_name=None, timespan=None, timestep=50, overwrite=True, nproc=1,
+                     output_format='nc', zarr_chunks=None):
         ''' Generate timeseries based on a spell
+
+        Args:
+            output_format (str): "nc" for netCDF files; "zarr" for Zarr stores with consolidated metadata
+            zarr_chunks (dict): the chunk sizes of the Zarr stores; see `utils.get_zarr_chunks`
         '''
         _mdl_hstr_dict = {
             'atm': ('cam', 'h0'),
@@ -1156,6 +1756,7 @@ class Timeseries:
         output_dir.mkdir(parents=True, exist_ok=True)
 
         if timespan is None: raise ValueError('Please specify `timespan`.')
+        if output_format not in utils.output_exts: raise ValueError('`output_format` options: {"nc", "zarr"}')
 
         syr = timespan[0]
         nt = (timespan[-1] - timespan[0] + 1) // timestep
@@ -1168,18 +1769,18 @@ class Timeseries:
         if nproc == 1:
             for timespan_tmp in timespan_list:
                 utils.p_header(f'>>> Processing timespan: {timespan_tmp}')
-                filename = 'casename.mdl.h_str.vn.timespan.nc'.replace('casename', self.casename).replace('mdl', mdl).replace('h_str', hstr).replace('vn', vn).replace('timespan', f'{timespan_tmp[0]:04d}01-{timespan_tmp[1]:04d}12')
+                filename = f'casename.mdl.h_str.vn.timespan{utils.output_exts[output_format]}'.replace('casename', self.casename).replace('mdl', mdl).replace('h_str', hstr).replace('vn', vn).replace('timespan', f'{timespan_tmp[0]:04d}01-{timespan_tmp[1]:04d}12')
                 output_path = os.path.join(output_dir, filename)
-                self.save_spell(spell, vn, timespan=timespan_tmp, long_name=long_name, output_path=output_path, overwrite=overwrite)
+                self.save_spell(spell, vn, timespan=timespan_tmp, long_name=long_name, output_path=output_path, overwrite=overwrite, zarr_chunks=zarr_chunks)
         else:
             utils.p_hint(f'>>> nproc: {nproc}')
-            with mp.Pool(processes=nproc) as p:
+            with self.handle.pool(nproc) as p:
                 arg_list = []
                 for timespan_tmp in timespan_list:
-                    filename = 'casename.mdl.h_str.vn.timespan.nc'.replace('casename', self.casename).replace('mdl', mdl).replace('h_str', hstr).replace('vn', vn).replace('timespan', f'{timespan_tmp[0]:04d}01-{timespan_tmp[1]:04d}12')
+                    filename = f'casename.mdl.h_str.vn.timespan{utils.output_exts[output_format]}'.replace('casename', self.casename).replace('mdl', mdl).replace('h_str', hstr).replace('vn', vn).replace('timespan', f'{timespan_tmp[0]:04d}01-{timespan_tmp[1]:04d}12')
                     output_path = os.path.join(output_dir, filename)
-                    arg_list.append((spell, vn, output_path, timespan_tmp,  overwrite, long_name))
-                p.starmap(self.save_spell, tqdm(arg_list, total=len(arg_list), desc=f'Saving "{spell}" to files'))
+                    arg_list.append(('save_spell', spell, vn, output_path, timespan_tmp,  overwrite, long_name, zarr_chunks))
+                p.starmap(run_case_task, tqdm(arg_list, total=len(arg_list), desc=f'Saving "{spell}" to files'))
 
 class Climo:
     def __init__(self, root_dir, casename):
@@ -1217,17 +1818,10 @@ class Climo:
         if MONS_climo_path is None:
             MONS_climo_path = self.MONS_climo_path
 
-        ds = xr.open_dataset(MONS_climo_path)
-
-        sn_dict = {
-            'ANN': list(range(1, 13)),
-            'DJF': [12, 1, 2],
-            'MAM': [1, 2, 3],
-            'JJA': [6, 7, 8],
-            'SON': [9, 10, 11],
-        }
+        # the monthly climatology is read only once for all the seasons
+        ds = xr.load_dataset(MONS_climo_path)
 
-        for sn, months in sn_dict.items():
+        for sn, months in utils.seasons.items():
             output_fpath = MONS_climo_path.replace('MONS', sn)
             if os.path.exists(output_fpath):
                 os.remove(output_fpath)
@@ -1242,6 +1836,17 @@ class Means:
         self.root_dir = root_dir
         utils.p_header(f'>>> case.root_dir: {self.root_dir}')
 
+    @property
+    def handle(self):
+        ''' the `CaseHandle` to rebuild the case in a worker process '''
+        return CaseHandle('Means', (('root_dir', self.root_dir),))
+
+    @classmethod
+    def from_handle(cls, root_dir):
+        case = cls.__new__(cls)
+        case.root_dir = root_dir
+        return case
+
     def merge_means(self, sn, output_dirpath, overwrite=False, casetag=None):
         utils.p_header(f'>>> Processing season {sn}')
         paths = glob.glob(os.path.join(self.root_dir, sn, f'*_{sn}_means.nc'))
@@ -1285,9 +1890,9 @@ class Means:
                 self.merge_means(sn, output_dirpath, overwrite=overwrite)
         else:
             utils.p_hint(f'>>> nproc: {nproc}')
-            with mp.Pool(processes=nproc) as p:
-                arg_list = [(sn, output_dirpath, overwrite, casetag) for sn in sns]
-                p.starmap(self.merge_means, tqdm(arg_list, total=len(sns), desc=f'Merging mean files'))
+            with self.handle.pool(nproc) as p:
+                arg_list = [('merge_means', sn, output_dirpath, overwrite, casetag) for sn in sns]
+                p.starmap(run_case_task, tqdm(arg_list, total=len(sns), desc=f'Merging mean files'))
 
 
     # def load(self, vn, adjust_month=True, load_idx=-1, regrid=False):
@@ -1463,23 +2068,55 @@ class Means:
 class Logs:
     ''' Initialize a CESM Log case
 
+    The parsed logs are kept in a store persisted to `store_path`, so that `refresh` only parses
+    the new log files and the lines appended to the current uncompressed log.
+
     Args:
-        root_dir (str): the root directory of the CESM Timeseries output
+        dirpath (str): the directory of the log files
+        comp (str): the component of the log files
+        load_num (int): the number of the first (if positive) or last (if negative) log files to load
+        include_current (bool): if True, also include the uncompressed log files, e.g., the log of a running simulation
+        store_path (str): the path to the store of the parsed logs; defaults to `dirpath/.x4c_{comp}_logs.json`
     '''
-    def __init__(self, dirpath, comp='ocn', load_num=None):
+    def __init__(self, dirpath, comp='ocn', load_num=None, include_current=False, store_path=None):
         self.dirpath = dirpath
-        self.paths = sorted(glob.glob(os.path.join(dirpath, f'{comp}.log.*.gz')))
-        if load_num is not None:
-            if load_num < 0:
-                self.paths = self.paths[load_num:]
-            else:
-                self.paths = self.paths[:load_num]
+        self.comp = comp
+        self.load_num = load_num
+        self.include_current = include_current
+        self.store_path = os.path.join(dirpath, f'.x4c_{comp}_logs.json') if store_path is None else store_path
+        self.store = {}
+        if os.path.exists(self.store_path):
+            try:
+                with open(self.store_path) as f:
+                    store = json.load(f)
+                if isinstance(store, dict): self.store = store
+            except (OSError, ValueError):
+                # a truncated or foreign store only costs a full re-parse
+                utils.p_warning(f'>>> Failed to load the parsed logs from: {self.store_path}; re-parsing all log files')
+
+        self.paths = self.find_paths()
 
         utils.p_header(f'>>> Logs.dirpath: {self.dirpath}')
         utils.p_header(f'>>> {len(self.paths)} Logs.paths:')
         print(f'Start: {os.path.basename(self.paths[0])}')
         print(f'End: {os.path.basename(self.paths[-1])}')
 
+    def find_paths(self):
+        paths = glob.glob(os.path.join(self.dirpath, f'{self.comp}.log.*.gz'))
+        if self.include_current:
+            for path in glob.glob(os.path.join(self.dirpath, f'{self.comp}.log.*')):
+                if not path.endswith('.gz') and f'{path}.gz' not in paths:
+                    paths.append(path)
+
+        paths = sorted(paths, key=lambda p: p[:-3] if p.endswith('.gz') else p)
+        if self.load_num is not None:
+            if self.load_num < 0:
+                paths = paths[self.load_num:]
+            else:
+                paths = paths[:self.load_num]
+
+        return paths
+
     def get_vars(self, vn=[
                     'UVEL', 'UVEL2', 'VVEL', 'VVEL2', 'TEMP', 'dTEMP_POS_2D', 'dTEMP_NEG_2D', 'SALT', 'RHO', 'RHO_VINT',
                     'RESID_T', 'RESID_S', 'SU', 'SV', 'SSH', 'SSH2', 'SHF', 'SHF_QSW', 'SFWF', 'SFWF_WRST', 'TAUX', 'TAUX2', 'TAUY',
@@ -1492,53 +2129,96 @@ class Logs:
                     'VNT_SUBM', 'VNS_SUBM', 'HDIFT', 'HDIFS', 'WVEL', 'WVEL2', 'UET', 'VNT', 'WTT', 'UES', 'VNS', 'WTS', 'ADVT', 'ADVS', 'PV',
                     'Q', 'PD', 'QSW_HTP', 'QFLUX', 'HMXL', 'XMXL', 'TMXL', 'HBLT', 'XBLT', 'TBLT', 'BSF',
                     'NINO_1_PLUS_2', 'NINO_3', 'NINO_3_POINT_4', 'NINO_4',
-                ]):
+                ], nproc=1):
+        ''' Parse the variables from the log files into `.df` (monthly) and `.df_ann` (annual)
+
+        Args:
+            vn (str or list): the variable names
+            nproc (int): the number of processes to parse the log files in parallel
+        '''
 
         if not isinstance(vn, (list, tuple)):
             vn = [vn]
 
-        nf = len(self.paths)
+        self.vn = vn
+        self.update(nproc=nproc)
+
+    def refresh(self, nproc=1):
+        ''' Parse only the new log files and the lines appended to the current log since the last parsing,
+        and update `.df` and `.df_ann`
+
+        Args:
+            nproc (int): the number of processes to parse the new log files in parallel
+        '''
+        if not hasattr(self, 'vn'):
+            self.get_vars(nproc=nproc)
+        else:
+            self.paths = self.find_paths()
+            self.update(nproc=nproc)
+
+    def update(self, nproc=1):
+        full_paths, tail_paths, ids = [], [], {}
+        for path in self.paths:
+            stat = os.stat(path)
+            ids[path] = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+            record = self.store.get(path)
+            if record is not None and set(self.vn) <= set(record['state']['values']):
+                if record['id'] == ids[path]: continue
+                if not path.endswith('.gz') and record['id'][0] == stat.st_ino and stat.st_size >= record['state']['offset']:
+                    tail_paths.append(path)
+                    continue
+
+            full_paths.append(path)
+
+        if len(full_paths) > 0:
+            if nproc == 1:
+                res = [utils.parse_log(path, self.vn) for path in tqdm(full_paths, desc='Parsing log files')]
+            else:
+                with mp.Pool(processes=nproc) as p:
+                    arg_list = [(path, self.vn) for path in full_paths]
+                    res = p.starmap(utils.parse_log, tqdm(arg_list, total=len(arg_list), desc='Parsing log files'))
+
+            for path, state in zip(full_paths, res):
+                self.store[path] = {'id': ids[path], 'state': state}
+
+        for path in tail_paths:
+            state = self.store[path]['state']
+            self.store[path] = {'id': ids[path], 'state': utils.parse_log(path, list(state['values']), state=state)}
+
+        for path in list(self.store):
+            if not os.path.exists(path): self.store.pop(path)
+
+        if len(full_paths) + len(tail_paths) > 0: self.save_store()
+
         df_list = []
-        for idx_file in range(nf):
-            vars = {}
-            with gzip.open(self.paths[idx_file], mode='rt') as fp:
-                lines = fp.readlines()
-
-                # find 1st timestamp
-                for line in lines:
-                    i = lines.index(line)
-                    if line.find('This run        started from') != -1 and lines[i+1].find('date(month-day-year):') != -1:
-                        start_date = lines[i+1].split(':')[-1].strip()
-                        break
-
-                mm, dd, yyyy = start_date.split('-')
-
-                # find variable values
-                for line in lines:
-                    for v in vn:
-                        if v not in vars:
-                            vars[v] = []
-                        elif line.strip().startswith(f'{v}:'):
-                            val = float(line.strip().split(':')[-1])
-                            vars[v].append(val)
-
-            df_tmp = pd.DataFrame(vars)
+        for path in self.paths:
+            state = self.store[path]['state']
+            if state['start_date'] is None: continue
+            mm, dd, yyyy = state['start_date'].split('-')
+            values = {v: state['values'][v] for v in self.vn}
+            if not path.endswith('.gz'):
+                # a running simulation may have written only part of the variables of the latest month
+                n = min(len(vals) for vals in values.values())
+                values = {v: vals[:n] for v, vals in values.items()}
+
+            df_tmp = pd.DataFrame(values)
             dates = xr.cftime_range(start=f'{yyyy}-{mm}-{dd}', freq='MS', periods=len(df_tmp), calendar='noleap')
-            years = []
-            months = []
-            for date in dates:
-                years.append(date.year)
-                months.append(date.month)
-
-            df_tmp['Year'] = years
-            df_tmp['Month'] = months
+            df_tmp['Year'] = np.array(dates.year)
+            df_tmp['Month'] = np.array(dates.month)
             df_list.append(df_tmp)
         
         df = pd.concat(df_list, join='inner').drop_duplicates(subset=['Year', 'Month'], keep='last')
         df = df[ ['Year', 'Month'] + [ col for col in df.columns if col not in ['Year', 'Month']]]
         self.df = df
         self.df_ann = self.df.groupby(self.df.Year).mean()
-        self.vn = vn
+
+    def save_store(self):
+        try:
+            with open(f'{self.store_path}.tmp', 'w') as f:
+                json.dump(self.store, f)
+            os.replace(f'{self.store_path}.tmp', self.store_path)
+        except OSError:
+            utils.p_warning(f'>>> Failed to save the parsed logs to: {self.store_path}')
 
     def plot_vars(self, vn=None, annualize=True, xlim=None, ylim_dict=None, unit_dict=None, clr_dict=None,
                   figsize=[20, 5], ncol=4, nrow=None, wspace=0.5, hspace=0.5, kws=None, title=None):
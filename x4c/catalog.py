@@ -0,0 +1,185 @@
+import os
+import sqlite3
+import threading
+
+from . import utils
+
+class Catalog:
+    ''' A persistent index of the CESM timeseries files under a root directory
+
+    The files are indexed by (comp, mdl, h_str, vn, start, end) in a SQLite database, so that
+    path lookups do not need to glob the archive. The index is refreshed incrementally: only the
+    directories whose modification times have changed since the last scan are listed again.
+
+    Args:
+        root_dir (str): the root directory of the CESM Timeseries output
+        path (str): the path to the SQLite database; defaults to `root_dir/.x4c_catalog.db`,
+            and falls back to an in-memory database if the location is not writable
+        subdir (str): the subdirectory of the timeseries files under each component directory
+    '''
+    version = 1
+
+    def __init__(self, root_dir, path=None, subdir='proc/tseries/month_1'):
+        self.root_dir = os.path.abspath(root_dir)
+        self.path = os.path.join(self.root_dir, '.x4c_catalog.db') if path is None else path
+        self.subdir = subdir
+        self.time_indices = {}
+        self.connect()
+
+    def connect(self):
+        self.lock = threading.Lock()
+        try:
+            self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.create_tables()
+        except sqlite3.Error:
+            utils.p_warning(f'>>> Catalog not writable at: {self.path}; using an in-memory catalog instead')
+            self.path = ':memory:'
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.create_tables()
+
+    def create_tables(self):
+        with self.conn:
+            if self.conn.execute('PRAGMA user_version').fetchone()[0] != self.version:
+                # the index is derived from the filesystem, so an outdated schema is simply rebuilt
+                self.conn.execute('DROP TABLE IF EXISTS files')
+                self.conn.execute('DROP TABLE IF EXISTS dirs')
+                self.conn.execute(f'PRAGMA user_version = {self.version}')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY, dirpath TEXT, comp TEXT, mdl TEXT, h_str TEXT, vn TEXT,
+                    timespan TEXT, start INTEGER, end INTEGER, mtime INTEGER, size INTEGER
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_files ON files (comp, mdl, h_str, vn, start, end)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_dirs ON files (dirpath)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS dirs (dirpath TEXT PRIMARY KEY, mtime INTEGER)')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('conn')
+        state.pop('lock')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.connect()
+        if self.path == ':memory:': self.refresh()
+
+    def __deepcopy__(self, memo):
+        # the copies share the same database
+        return self
+
+    @staticmethod
+    def parse_fname(fname):
+        ''' Parse a timeseries filename `casename.mdl.h_str.vn.timespan.nc`, or a Zarr store `casename.mdl.h_str.vn.timespan.zarr`
+
+        Returns:
+            tuple: (mdl, h_str, vn, timespan, start, end) with `start` and `end` as month indices (year*12 + month-1); None if not matched
+        '''
+        elements = fname.split('.')
+        if len(elements) < 6 or elements[-1] not in ['nc', 'zarr']: return None
+        try:
+            start, end = utils.parse_date_range(elements[-2])
+        except ValueError:
+            return None
+        return elements[-5], elements[-4], elements[-3], elements[-2], start, end
+
+    def scan_dir(self, comp, dirpath):
+        rows = []
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                info = self.parse_fname(entry.name)
+                if info is None: continue
+                if not (entry.is_dir() if entry.name.endswith('.zarr') else entry.is_file()): continue
+                stat = entry.stat()
+                rows.append((entry.path, dirpath, comp, *info, stat.st_mtime_ns, stat.st_size))
+        return rows
+
+    def refresh(self, full=False):
+        ''' Update the index for the directories changed since the last refresh
+
+        Args:
+            full (bool): if True, rescan all the directories regardless of their modification times
+        '''
+        dirpaths = {}
+        if os.path.isdir(self.root_dir):
+            with os.scandir(self.root_dir) as it:
+                for entry in it:
+                    dirpath = os.path.join(entry.path, self.subdir)
+                    if entry.is_dir() and os.path.isdir(dirpath):
+                        dirpaths[dirpath] = entry.name
+
+        try:
+            self.update(dirpaths, full=full)
+        except sqlite3.OperationalError as err:
+            # e.g., a catalog built by another user on a read-only archive
+            if self.path == ':memory:': raise
+            utils.p_warning(f'>>> Catalog not writable at: {self.path} ({err}); using an in-memory copy instead')
+            self.to_memory()
+            self.update(dirpaths, full=full)
+
+    def to_memory(self):
+        ''' Switch to an in-memory copy of the database '''
+        with self.lock:
+            conn = sqlite3.connect(':memory:', check_same_thread=False)
+            self.conn.backup(conn)
+            self.conn.close()
+            self.conn = conn
+            self.path = ':memory:'
+
+    def update(self, dirpaths, full=False):
+        ''' Rescan the changed directories in the format of {dirpath: comp} and remove the vanished ones '''
+        with self.lock, self.conn:
+            mtimes = dict(self.conn.execute('SELECT dirpath, mtime FROM dirs'))
+            for dirpath in set(mtimes) - set(dirpaths):
+                self.time_indices = {}
+                self.conn.execute('DELETE FROM files WHERE dirpath = ?', (dirpath,))
+                self.conn.execute('DELETE FROM dirs WHERE dirpath = ?', (dirpath,))
+
+            for dirpath, comp in dirpaths.items():
+                mtime = os.stat(dirpath).st_mtime_ns
+                if not full and mtimes.get(dirpath) == mtime: continue
+                self.time_indices = {}
+                self.conn.execute('DELETE FROM files WHERE dirpath = ?', (dirpath,))
+                self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?,?,?,?)', self.scan_dir(comp, dirpath))
+                self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?,?)', (dirpath, mtime))
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def get_all_paths(self):
+        return [row[0] for row in self.query('SELECT path FROM files ORDER BY path')]
+
+    def get_vars_info(self):
+        ''' Return the dictionary of {(vn, comp): (comp, mdl, h_str)} '''
+        vars_info = {}
+        for vn, comp, mdl, h_str in self.query('SELECT vn, comp, mdl, h_str FROM files ORDER BY path'):
+            if (vn, comp) not in vars_info:
+                vars_info[(vn, comp)] = (comp, mdl, h_str)
+        return vars_info
+
+    def get_files(self, comp, mdl, h_str, vn, timespan=None):
+        ''' Return the (path, timespan, start, end) rows of a variable sorted by time
+
+        Args:
+            timespan (tuple): the (start_year, end_year) to overlap with; None means all
+        '''
+        sql = 'SELECT path, timespan, start, end FROM files WHERE comp = ? AND mdl = ? AND h_str = ? AND vn = ?'
+        params = (comp, mdl, h_str, vn)
+        if timespan is not None:
+            syr, eyr = timespan
+            sql += ' AND start <= ? AND end >= ?'
+            params += (eyr*12 + 11, syr*12)
+        return self.query(sql + ' ORDER BY start, path', params)
+
+    def get_time_index(self, comp, mdl, h_str, vn):
+        ''' Return the `utils.TimeIndex` of a variable, cached until the catalog changes '''
+        key = (comp, mdl, h_str, vn)
+        if key not in self.time_indices:
+            rows = self.get_files(comp, mdl, h_str, vn)
+            self.time_indices[key] = utils.TimeIndex([row[0] for row in rows], ranges=[row[2:] for row in rows])
+        return self.time_indices[key]
+
+    def get_paths(self, comp, mdl, h_str, vn, timespan=None):
+        return self.get_time_index(comp, mdl, h_str, vn).query(timespan)
@@ -1,7 +1,6 @@
 import xarray as xr
 xr.set_options(keep_attrs=True)
 
-import xesmf as xe
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import BoundaryNorm, Normalize, LogNorm
@@ -14,6 +13,22 @@ from . import utils, visual
 import os
 dirpath = os.path.dirname(__file__)
 
+def get_wgt_fpath(fname):
+    ''' Return the path to a regridding weight file generated by x4c
+
+    The weight files are stored along with the package if writable, otherwise in `~/.cache/x4c/regrid_wgts`.
+    '''
+    wgts_dirpath = os.path.join(dirpath, 'regrid_wgts')
+    cache_dirpath = os.path.join(os.path.expanduser('~'), '.cache', 'x4c', 'regrid_wgts')
+    for d in [wgts_dirpath, cache_dirpath]:
+        if os.path.exists(os.path.join(d, fname)): return os.path.join(d, fname)
+
+    if os.access(dirpath, os.W_OK):
+        os.makedirs(wgts_dirpath, exist_ok=True)
+        return os.path.join(wgts_dirpath, fname)
+    else:
+        return os.path.join(cache_dirpath, fname)
+
 def load_dataset(path, adjust_month=False, comp=None, grid=None, vn=None, **kws):
     ''' Load a netCDF file and form a `xarray.Dataset`
 
@@ -29,22 +44,31 @@ def load_dataset(path, adjust_month=False, comp=None, grid=None, vn=None, **kws)
     ds = utils.update_ds(ds, vn=vn, path=path, comp=comp, grid=grid, adjust_month=adjust_month)
     return ds
 
-def open_dataset(path, adjust_month=False, comp=None, grid=None, vn=None, **kws):
+def open_dataset(path, adjust_month=False, comp=None, grid=None, vn=None, nworkers=None, mem_budget=None, **kws):
     ''' Open a netCDF file and form a `xarray.Dataset` with a lazy load mode
 
     Args:
-        path (str): path to the netCDF file
+        path (str): path to the netCDF file, or to a Zarr store ending with ".zarr", which is opened with dask chunks
+            following the chunks of the store so that they are read in parallel
         adjust_month (bool): adjust the month of the `xarray.Dataset` (the default CESM output has a month shift)
         comp (str): the tag for CESM component, including "atm", "ocn", "lnd", "ice", and "rof"
         grid (str): the grid tag for the CESM output (e.g., ne16, g16)
         vn (str): variable name
+        nworkers (int): the number of workers for the chunk planning; see `utils.plan_chunks`
+        mem_budget (int): if set, open a netCDF file with the dask chunks planned under this memory budget per worker in bytes;
+            see `utils.plan_chunks`
 
     '''
+    if utils.is_zarr(path):
+        kws = {'engine': 'zarr', 'chunks': {}, **kws}
+    elif mem_budget is not None and 'chunks' not in kws:
+        kws['chunks'] = utils.plan_file_chunks(path, vn=vn, nworkers=nworkers, mem_budget=mem_budget)
+
     ds = xr.open_dataset(path, **kws)
     ds = utils.update_ds(ds, vn=vn, path=path, comp=comp, grid=grid, adjust_month=adjust_month)
     return ds
 
-def open_mfdataset(paths, adjust_month=False, comp=None, grid=None, vn=None, **kws):
+def open_mfdataset(paths, adjust_month=False, comp=None, grid=None, vn=None, nworkers=None, mem_budget=2**30, **kws):
     ''' Open multiple netCDF files and form a `xarray.Dataset` in a lazy load mode
 
     Args:
@@ -53,16 +77,17 @@ def open_mfdataset(paths, adjust_month=False, comp=None, grid=None, vn=None, **k
         comp (str): the tag for CESM component, including "atm", "ocn", "lnd", "ice", and "rof"
         grid (str): the grid tag for the CESM output (e.g., ne16, g16)
         vn (str): variable name
+        nworkers (int): the number of workers for the chunk planning; see `utils.plan_chunks`
+        mem_budget (int): the memory budget per worker in bytes, under which the dask chunks are planned from the layout
+            of the first file; see `utils.plan_chunks`
 
     '''
-    ds0 = xr.open_dataset(paths[0], decode_cf=False)
-    dims_other_than_time = list(ds0.dims)
-    try:
-        dims_other_than_time.remove('time')
-    except:
-        pass
-
-    chunk_dict = {k: -1 for k in dims_other_than_time}
+    if all(utils.is_zarr(p) for p in paths):
+        # the dask chunks follow the chunks of the stores
+        chunk_dict = {}
+        kws = {'engine': 'zarr', **kws}
+    else:
+        chunk_dict = utils.plan_file_chunks(paths[0], vn=vn, nworkers=nworkers, mem_budget=mem_budget)
 
     _kws = {
         'data_vars': 'minimal',
@@ -81,7 +106,7 @@ class XDataset:
     def __init__(self, ds=None):
         self.ds = ds
 
-    def regrid(self, dlon=1, dlat=1, weight_file=None, gs='T', method='bilinear', periodic=True):
+    def regrid(self, dlon=1, dlat=1, weight_file=None, gs='T', method='bilinear', periodic=True, engine='xesmf', renormalize=False):
         ''' Regrid the CESM output to a normal lat/lon grid
 
         Supported atmosphere regridding: ne16np4, ne16pg3, ne30np4, ne30pg3, ne120np4, ne120pg4 TO 1x1d / 2x2d.
@@ -98,19 +123,36 @@ class XDataset:
             gs (str): grid style in 'T' or 'U' for the ocean grid
             method (str): regridding method for the ocean grid
             periodic (bool): the assumption of the periodicity of the data when perform the regrid method
+            engine (str): the engine to apply the weights of a weight file (the SE grids or a user-provided `weight_file`):
+                "xesmf" for an `xesmf.Regridder`, or "sparse" for a sparse matrix product that works chunk by chunk
+            renormalize (bool): for the "sparse" engine, normalize by the weights of the valid (non-NaN) source cells;
+                this changes the values of the destination cells next to masked or NaN source cells
 
         '''
+        if engine == 'sparse':
+            regrid_wgt = lambda ds, weight_file: utils.regrid_sparse(ds, weight_file, renormalize=renormalize)
+        elif engine == 'xesmf':
+            regrid_wgt = utils.regrid_cam_se
+        else:
+            raise ValueError('`engine` options: {"sparse", "xesmf"}')
+
         comp = self.ds.attrs['comp']
         grid = self.ds.attrs['grid']
 
+        # the area weights are regridded along with the data to weight the regular grid
+        ds_src = self.ds
+        if 'gw' not in ds_src:
+            gw = utils.get_grid_metric(self.ds, 'gw')
+            if gw is not None: ds_src = ds_src.assign(gw=gw)
+
         if weight_file is not None:
             # using a user-provided weight file for any unsupported regridding
-            ds_rgd = utils.regrid_cam_se(ds, weight_file=weight_file)
+            ds_rgd = regrid_wgt(ds_src, weight_file=weight_file)
         else:
             if grid[:2] == 'ne':
                 # SE grid
                 if grid in ['ne16np4', 'ne16pg3', 'ne30np4', 'ne30pg3', 'ne120np4', 'ne120pg3']:
-                    ds = self.ds.copy()
+                    ds = ds_src.copy()
                     if comp == 'lnd':
                         ds = ds.rename_dims({'lndgrid': 'ncol'})
 
@@ -120,7 +162,7 @@ class XDataset:
                         utils.p_header(f'Downloading the weight file from: {url}')
                         utils.download(url, wgt_fpath)
 
-                    ds_rgd = utils.regrid_cam_se(ds, weight_file=wgt_fpath)
+                    ds_rgd = regrid_wgt(ds, weight_file=wgt_fpath)
                 else:
                     raise ValueError('The specified `grid` is not supported. Please specify a `weight_file`.')
 
@@ -130,11 +172,11 @@ class XDataset:
                 ds['lat'] = self.ds.lat
                 ds['lon'] = self.ds.lon
 
-                regridder = xe.Regridder(
-                    ds, xe.util.grid_global(dlon, dlat, cf=True, lon1=360),
-                    method=method, periodic=periodic,
+                regridder = utils.get_latlon_regridder(
+                    (grid, None, utils.make_coords_tag(ds), dlon, dlat, method, periodic), ds,
+                    dlon=dlon, dlat=dlat, method=method, periodic=periodic,
                 )
-                ds_rgd = regridder(self.ds, keep_attrs=True)
+                ds_rgd = regridder(ds_src, keep_attrs=True)
 
             elif comp in ['ocn', 'ice']:
                 # ocn grid
@@ -154,12 +196,16 @@ class XDataset:
                 else:
                     raise ValueError('`gs` options: {"T", "U"}.')
 
-                regridder = xe.Regridder(
-                    ds, xe.util.grid_global(dlon, dlat, cf=True, lon1=360),
-                    method=method, periodic=periodic,
+                # the bilinear weights are expensive to generate on the ocean grid, so they are saved for later sessions;
+                # a subset of the grid, or another grid with the same name, has its own coordinates and thus its own weights
+                tag = utils.make_coords_tag(ds)
+                regridder = utils.get_latlon_regridder(
+                    (grid, gs, tag, dlon, dlat, method, periodic), ds,
+                    dlon=dlon, dlat=dlat, method=method, periodic=periodic,
+                    weight_file=get_wgt_fpath(f'map_{grid}_{gs}_{tag}_TO_{dlon}x{dlat}d_{method}{"_periodic" if periodic else ""}.nc'),
                 )
 
-                ds_rgd = regridder(self.ds, keep_attrs=True)
+                ds_rgd = regridder(ds_src, keep_attrs=True)
 
             else:
                 raise ValueError(f'grid [{grid}] is not supported; please provide a corresponding `weight_file`.')
@@ -171,14 +217,24 @@ class XDataset:
 
         ds_rgd.attrs = dict(self.ds.attrs)
         # utils.p_success(f'Dataset regridded to regular grid: [dlon: {dlon} x dlat: {dlat}]')
-        if 'lat' in ds_rgd.attrs: del(ds_rgd.attrs['lat'])
-        if 'lon' in ds_rgd.attrs: del(ds_rgd.attrs['lon'])
+        for v in ['lat', 'lon', 'grid_key']:
+            if v in ds_rgd.attrs: del(ds_rgd.attrs[v])
+
+        if 'gw' in ds_rgd:
+            # the regridded area weights cannot be reloaded from the source files, so they are kept in the dataset as well
+            tag = os.path.basename(weight_file) if weight_file is not None else f'{dlon}x{dlat}d_{method}'
+            ds_rgd['gw'] = ds_rgd['gw'].fillna(0)
+            metrics = {'gw': ds_rgd['gw'], 'lat': ds_rgd['lat'], 'lon': ds_rgd['lon']}
+            prefix = utils.make_grid_key(comp, f'{grid}>{tag}', metrics['gw'])
+            ds_rgd.attrs['grid_key'] = utils.grid_metrics.register(prefix, metrics)
+
         return ds_rgd
 
     def get_plev(self, ps, vn=None, lev_mode='hybrid', **kws):
         _kws = {'lev_dim': 'lev'}
-        if 'hyam' in self.ds: _kws['hyam'] = self.ds['hyam']
-        if 'hybm' in self.ds: _kws['hybm'] = self.ds['hybm']
+        for v in ['hyam', 'hybm']:
+            metric = self.ds[v] if v in self.ds else utils.get_grid_metric(self.ds, v)
+            if metric is not None: _kws[v] = metric
 
         _kws.update(kws)
         if vn is None:
@@ -209,7 +265,8 @@ class XDataset:
         else:
             da = self.ds[vn]
 
-        da_zavg = da.sel(z_t=slice(depth_top, depth_bot)).weighted(self.ds['dz']).mean('z_t')
+        dz = self.ds['dz'] if 'dz' in self.ds else utils.get_grid_metric(self.ds, 'dz')
+        da_zavg = da.sel(z_t=slice(depth_top, depth_bot)).weighted(dz).mean('z_t')
 
         ds_zavg = self.ds.copy()
         ds_zavg[vn] = da_zavg
@@ -217,15 +274,16 @@ class XDataset:
         
 
 
-    def annualize(self, months=None):
+    def annualize(self, months=None, weighted=False):
         ''' Annualize/seasonalize a `xarray.Dataset`
 
         Args:
             months (list of int): a list of integers to represent month combinations,
                 e.g., `None` means calendar year annualization, [7,8,9] means JJA annualization, and [-12,1,2] means DJF annualization
+            weighted (bool): if True, weight the months by their numbers of days
 
         '''
-        ds_ann = utils.annualize(self.ds, months=months)
+        ds_ann = utils.annualize(self.ds, months=months, weighted=weighted)
         ds_ann.attrs = dict(self.ds.attrs)
         return ds_ann
 
@@ -236,17 +294,14 @@ class XDataset:
         if 'path' in self.ds.attrs:
             da.attrs['path'] = self.ds.attrs['path']
 
-        if 'gw' in self.ds:
-            da.attrs['gw'] = self.ds['gw'].fillna(0)
-
-        if 'lat' in self.ds:
-            da.attrs['lat'] = self.ds['lat']
-
-        if 'lon' in self.ds:
-            da.attrs['lon'] = self.ds['lon']
-
-        if 'dz' in self.ds:
-            da.attrs['dz'] = self.ds['dz']
+        # the static metrics are shared through the registry by the key of the grid; see `utils.GridMetrics`
+        utils.check_grid_key(self.ds)
+        if 'grid_key' in self.ds.attrs:
+            da.attrs['grid_key'] = self.ds.attrs['grid_key']
+            if utils.is_regridded_key(self.ds.attrs['grid_key']):
+                # the small metrics of a regular grid travel with the variable, e.g., to the cache or another process
+                for v in ['gw', 'lat', 'lon']:
+                    if v in self.ds: da.attrs[v] = self.ds[v]
 
         if 'comp' in self.ds.attrs:
             da.attrs['comp'] = self.ds.attrs['comp']
@@ -270,10 +325,10 @@ class XDataset:
 
     @property
     def climo(self):
-        ds = self.ds.groupby('time.month').mean(dim='time')
+        ds = utils.climo(self.ds)
         ds.attrs['climo_period'] = (self.ds['time.year'].values[0], self.ds['time.year'].values[-1])
-        if 'comp' in self.ds.attrs: ds.attrs['comp'] = self.ds.attrs['comp']
-        if 'grid' in self.ds.attrs: ds.attrs['grid'] = self.ds.attrs['grid']
+        for v in ['comp', 'grid', 'grid_key']:
+            if v in self.ds.attrs: ds.attrs[v] = self.ds.attrs[v]
         if 'month' in ds.coords:
             ds = ds.rename({'month': 'time'})
         return ds
@@ -283,6 +338,13 @@ class XDataset:
             if v in self.ds.attrs: del(self.ds.attrs[v])
 
         return self.ds.to_netcdf(path, **kws)
+
+    def to_zarr(self, path, chunks=None, **kws):
+        ''' Save to a Zarr store with consolidated metadata; see `utils.to_zarr` for `chunks` '''
+        for v in ['gw', 'lat', 'lon', 'dz']:
+            if v in self.ds.attrs: del(self.ds.attrs[v])
+
+        return utils.to_zarr(self.ds, path, chunks=chunks, **kws)
         
 
 @xr.register_dataarray_accessor('x')
@@ -290,15 +352,16 @@ class XDataArray:
     def __init__(self, da=None):
         self.da = da
 
-    def annualize(self, months=None):
+    def annualize(self, months=None, weighted=False):
         ''' Annualize/seasonalize a `xarray.DataArray`
 
         Args:
             months (list of int): a list of integers to represent month combinations,
                 e.g., [7,8,9] means JJA annualization, and [-12,1,2] means DJF annualization
+            weighted (bool): if True, weight the months by their numbers of days
 
         '''
-        da = utils.annualize(self.da, months=months)
+        da = utils.annualize(self.da, months=months, weighted=weighted)
         da = utils.update_attrs(da, self.da)
         return da
 
@@ -306,8 +369,6 @@ class XDataArray:
         ds_rgd = self.ds.x.regrid(**kws)
         da = ds_rgd.x.da
         da.name = self.da.name
-        if 'lat' in da.attrs: del(da.attrs['lat'])
-        if 'lon' in da.attrs: del(da.attrs['lon'])
         return da
 
     def get_plev(self, **kws):
@@ -315,13 +376,17 @@ class XDataArray:
         See: https://geocat-comp.readthedocs.io/en/v2024.04.0/user_api/generated/geocat.comp.interpolation.interp_hybrid_to_pressure.html
         '''
         _kws = {'lev_dim': 'lev'}
+        for v in ['hyam', 'hybm']:
+            metric = utils.get_grid_metric(self.da, v)
+            if metric is not None: _kws[v] = metric
+
         _kws.update(kws)
         da = gc.interpolation.interp_hybrid_to_pressure(self.da, **_kws)
         da.name = self.da.name
         return da
 
     def zavg(self, depth_top, depth_bot):
-        da_zavg = self.da.sel(z_t=slice(depth_top, depth_bot)).weighted(self.da.attrs['dz']).mean('z_t')
+        da_zavg = self.da.sel(z_t=slice(depth_top, depth_bot)).weighted(utils.get_grid_metric(self.da, 'dz')).mean('z_t')
         return da_zavg
 
     def to_netcdf(self, path, **kws):
@@ -330,15 +395,22 @@ class XDataArray:
 
         return self.da.to_netcdf(path, **kws)
 
+    def to_zarr(self, path, chunks=None, **kws):
+        ''' Save to a Zarr store with consolidated metadata; see `utils.to_zarr` for `chunks` '''
+        for v in ['gw', 'lat', 'lon', 'dz']:
+            if v in self.da.attrs: del(self.da.attrs[v])
+
+        return utils.to_zarr(self.da.to_dataset(), path, chunks=chunks, **kws)
+
     @property
     def ds(self):
         ''' get its `xarray.Dataset` version '''
         ds_tmp = self.da.to_dataset()
 
         for v in ['gw', 'lat', 'lon']:
-            if v in self.da.attrs: ds_tmp[v] = self.da.attrs[v]
+            if isinstance(self.da.attrs.get(v), xr.DataArray): ds_tmp[v] = self.da.attrs[v]
 
-        for v in ['comp', 'grid']:
+        for v in ['comp', 'grid', 'grid_key', 'path']:
             if v in self.da.attrs: ds_tmp.attrs[v] = self.da.attrs[v]
         
         ds_tmp[self.da.name] = self.da
@@ -348,8 +420,7 @@ class XDataArray:
     @property
     def gm(self):
         ''' the global area-weighted mean '''
-        gw = self.da.attrs['gw']
-        da = self.da.weighted(gw).mean(list(gw.dims))
+        da = utils.region_reduce(self.da, 'global', how='mean')
         da = utils.update_attrs(da, self.da)
         if 'long_name' in da.attrs: da.attrs['long_name'] = f'Global Mean {da.attrs["long_name"]}'
         return da
@@ -357,9 +428,7 @@ class XDataArray:
     @property
     def nhm(self):
         ''' the NH area-weighted mean '''
-        gw = self.da.attrs['gw']
-        lat = self.da.attrs['lat']
-        da = self.da.where(lat>0).weighted(gw).mean(list(gw.dims))
+        da = utils.region_reduce(self.da, 'nh', how='mean')
         da = utils.update_attrs(da, self.da)
         if 'long_name' in da.attrs: da.attrs['long_name'] = f'NH Mean {da.attrs["long_name"]}'
         return da
@@ -367,9 +436,7 @@ class XDataArray:
     @property
     def shm(self):
         ''' the SH area-weighted mean '''
-        gw = self.da.attrs['gw']
-        lat = self.da.attrs['lat']
-        da = self.da.where(lat<0).weighted(gw).mean(list(gw.dims))
+        da = utils.region_reduce(self.da, 'sh', how='mean')
         da = utils.update_attrs(da, self.da)
         if 'long_name' in da.attrs: da.attrs['long_name'] = f'SH Mean {da.attrs["long_name"]}'
         return da
@@ -377,8 +444,7 @@ class XDataArray:
     @property
     def gs(self):
         ''' the global area-weighted sum '''
-        gw = self.da.attrs['gw']
-        da = self.da.weighted(gw).sum(list(gw.dims))
+        da = utils.region_reduce(self.da, 'global', how='sum')
         da = utils.update_attrs(da, self.da)
         if 'long_name' in da.attrs: da.attrs['long_name'] = f'Global Sum {da.attrs["long_name"]}'
         return da
@@ -386,9 +452,7 @@ class XDataArray:
     @property
     def nhs(self):
         ''' the NH area-weighted sum '''
-        gw = self.da.attrs['gw']
-        lat = self.da.attrs['lat']
-        da = self.da.where(lat>0).weighted(gw).sum(list(gw.dims))
+        da = utils.region_reduce(self.da, 'nh', how='sum')
         da = utils.update_attrs(da, self.da)
         if 'long_name' in da.attrs: da.attrs['long_name'] = f'NH Sum {da.attrs["long_name"]}'
         return da
@@ -396,13 +460,25 @@ class XDataArray:
     @property
     def shs(self):
         ''' the SH area-weighted sum '''
-        gw = self.da.attrs['gw']
-        lat = self.da.attrs['lat']
-        da = self.da.where(lat<0).weighted(gw).sum(list(gw.dims))
+        da = utils.region_reduce(self.da, 'sh', how='sum')
         da = utils.update_attrs(da, self.da)
         if 'long_name' in da.attrs: da.attrs['long_name'] = f'SH Sum {da.attrs["long_name"]}'
         return da
 
+    def multi_sa(self, methods=['gm', 'nhm', 'shm']):
+        ''' Calculate several spatial averages in one pass over the data
+
+        Args:
+            methods (list): the spatial average methods (e.g., "gm", "nhs"), climate indices (e.g., "nino3.4"),
+                or (lat_min, lat_max, lon_min, lon_max) boxes; see `utils.multi_region_reduce`
+
+        Returns:
+            xarray.DataArray: the results along the dimension `region`; e.g., `da.x.multi_sa(['gm', 'nhm']).sel(region='nhm')` equals `da.x.nhm`
+        '''
+        da = utils.multi_region_reduce(self.da, methods)
+        da = utils.update_attrs(da, self.da)
+        return da
+
     @property
     def somin(self):
         ''' the Southern Ocean min'''
@@ -426,10 +502,10 @@ class XDataArray:
 
     @property
     def climo(self):
-        da = self.da.groupby('time.month').mean(dim='time')
+        da = utils.climo(self.da)
         da.attrs['climo_period'] = (self.da['time.year'].values[0], self.da['time.year'].values[-1])
-        if 'comp' in self.da.attrs: da.attrs['comp'] = self.da.attrs['comp']
-        if 'grid' in self.da.attrs: da.attrs['grid'] = self.da.attrs['grid']
+        for v in ['comp', 'grid', 'grid_key']:
+            if v in self.da.attrs: da.attrs[v] = self.da.attrs[v]
         if 'month' in da.coords:
             da = da.rename({'month': 'time'})
         return da
@@ -441,7 +517,8 @@ class XDataArray:
             latlon_range (tuple or list): the lat/lon range for lat-weighted average 
                 in format of (lat_min, lat_max, lon_min, lon_max)
 
-            ind (str): a climate index name; supported names include:
+            ind (str or list): a climate index name, or a list of names to calculate in one pass
+                along a new dimension `region`; supported names include:
             
                 * 'nino3.4'
                 * 'nino1+2'
@@ -456,33 +533,25 @@ class XDataArray:
         if ind is None:
             lat_min, lat_max, lon_min, lon_max = latlon_range
             da = utils.geo_mean(self.da, lat_min=lat_min, lat_max=lat_max, lon_min=lon_min, lon_max=lon_max, **kws)
-        elif ind == 'nino3.4':
-            da = utils.geo_mean(self.da, lat_min=-5, lat_max=5, lon_min=np.mod(-170, 360), lon_max=np.mod(-120, 360), **kws)
-        elif ind == 'nino1+2':
-            da = utils.geo_mean(self.da, lat_min=-10, lat_max=10, lon_min=np.mod(-90, 360), lon_max=np.mod(-80, 360), **kws)
-        elif ind == 'nino3':
-            da = utils.geo_mean(self.da, lat_min=-5, lat_max=5, lon_min=np.mod(-150, 360), lon_max=np.mod(-90, 360), **kws)
-        elif ind == 'nino4':
-            da = utils.geo_mean(self.da, lat_min=-5, lat_max=5, lon_min=np.mod(160, 360), lon_max=np.mod(-150, 360), **kws)
-        elif ind == 'wpi':
-            # Western Pacific Index
-            da = utils.geo_mean(self.da, lat_min=-10, lat_max=10, lon_min=np.mod(120, 360), lon_max=np.mod(150, 360), **kws)
-        elif ind == 'tpi':
-            # Tri-Pole Index
-            v1 = utils.geo_mean(self.da, lat_min=25, lat_max=45, lon_min=np.mod(140, 360), lon_max=np.mod(-145, 360), **kws)
-            v2 = utils.geo_mean(self.da, lat_min=-10, lat_max=10, lon_min=np.mod(170, 360), lon_max=np.mod(-90, 360), **kws)
-            v3 = utils.geo_mean(self.da, lat_min=-50, lat_max=-15, lon_min=np.mod(150, 360), lon_max=np.mod(-160, 360), **kws)
-            da = v2 - (v1 + v3)/2
-        elif ind == 'dmi':
-            # Indian Ocean Dipole Mode
-            dmiw = utils.geo_mean(self.da, lat_min=-10, lat_max=10, lon_min=50 ,lon_max=70, **kws)
-            dmie = utils.geo_mean(self.da,lat_min=-10,lat_max=0,lon_min=90,lon_max=110, **kws)
-            da = dmiw - dmie
-        elif ind == 'iobw':
-            # Indian Ocean Basin Wide
-            da =  utils.geo_mean(self.da, lat_min=-20, lat_max=20, lon_min=40 ,lon_max=100, **kws)
         else:
-            raise ValueError('`ind` options: {"nino3.4", "nino1+2", "nino3", "nino4", "wpi", "tpi", "dmi", "iobw"}')
+            inds = [ind] if isinstance(ind, str) else list(ind)
+            if any(i not in utils.climate_indices for i in inds):
+                raise ValueError('`ind` options: {"nino3.4", "nino1+2", "nino3", "nino4", "wpi", "tpi", "dmi", "iobw"}')
+
+            if utils.get_grid_metric(self.da, 'gw') is not None or 'gw' in kws:
+                # the boxes of all the indices are reduced together, reading the field only once
+                metric_kws = {k: kws[k] for k in ['gw', 'lat', 'lon']} if all(k in kws for k in ['gw', 'lat', 'lon']) else {}
+                da = utils.multi_region_reduce(self.da, inds, **metric_kws)
+            else:
+                das = []
+                for i in inds:
+                    da = 0
+                    for coef, (lat_min, lat_max, lon_min, lon_max) in utils.climate_indices[i]:
+                        da = da + coef * utils.geo_mean(self.da, lat_min=lat_min, lat_max=lat_max, lon_min=lon_min, lon_max=lon_max, **kws)
+                    das.append(da)
+                da = xr.concat(das, dim='region').assign_coords(region=inds)
+
+            if isinstance(ind, str): da = da.sel(region=ind, drop=True)
 
         da.attrs = dict(self.da.attrs)
         if 'comp' in da.attrs and 'time' in da.coords:
@@ -4,7 +4,13 @@ import numpy as np
 import pop_tools
 from xhistogram.xarray import histogram
 
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
 class DiagCalc:
+    ''' The legacy calculations; the derived variables are registered in `derived_vars` with `derived_var` '''
     # General calculations
     # def calc_ts(case, vn, load_idx=-1, adjust_month=True, sm_method='gm', ann_method='ann', long_name=None, units=None):
     #     ''' General timeseries calculation
@@ -286,179 +292,196 @@ class DiagCalc:
 
     #     return da
 
-    # Get specific diagnostic variables
-    def get_SST(case, **kws):
-        if ('SST', 'ocn') not in case.vars_info:
-            vn = 'TEMP'
-            case.load(vn, **kws)
-            sst = case.ds[vn].x.da.isel(z_t=0)
-        else:
-            case.load('SST', **kws)
-            sst = case.ds['SST'].x.da
-
-        sst.attrs['units'] = '°C'
-        sst.attrs['long_name'] = 'Sea Surface Temperature'
-        sst.name = 'SST'
-        return sst
-
-    def get_LST(case, **kws):
-        vn = 'TS'
-        case.load(vn, **kws)
-        ts = case.ds[vn].x.da
-
-        vn = 'LANDFRAC'
-        case.load(vn, **kws)
-        landfrac = case.ds[vn].x.da
-
-        lst = ts.where(landfrac>0.5)
-
-        lst.attrs['long_name'] = 'Land Surface Temperature'
-        lst.name = 'LST'
-        return lst
-
-    def get_MLD(case, **kws):
-        vn = 'XMXL'
-        case.load(vn, **kws)
-        da = case.ds[vn].x.da / 100
-        da.name = 'MLD'
-        da.attrs['units'] = 'm'
-        return da
-
-    def get_PRECT(case, **kws):
-        case.load('PRECC', **kws)
-        case.load('PRECL', **kws)
-        da = case.ds['PRECC'].x.da + case.ds['PRECL'].x.da
-        da.name = 'PRECT'
-        da.attrs['long_name'] = 'Total precipitation rate (convective + large-scale; liq + ice)'
-        return da
-        
-    def get_d18Op(case, **kws):
-        case.load('PRECRC_H216Or', **kws)
-        case.load('PRECSC_H216Os', **kws)
-        case.load('PRECRL_H216OR', **kws)
-        case.load('PRECSL_H216OS', **kws)
-
-        case.load('PRECRC_H218Or', **kws)
-        case.load('PRECSC_H218Os', **kws)
-        case.load('PRECRL_H218OR', **kws)
-        case.load('PRECSL_H218OS', **kws)
-
-        p16O = case.ds['PRECRC_H216Or'].x.da + case.ds['PRECSC_H216Os'].x.da + case.ds['PRECRL_H216OR'].x.da + case.ds['PRECSL_H216OS'].x.da
-        p18O = case.ds['PRECRC_H218Or'].x.da + case.ds['PRECSC_H218Os'].x.da + case.ds['PRECRL_H218OR'].x.da + case.ds['PRECSL_H218OS'].x.da
-
-        p16O = p16O.where(p16O > 1e-18, 1e-18)
-        p18O = p18O.where(p18O > 1e-18, 1e-18)
-
-        d18Op = (p18O / p16O - 1)*1000
-        d18Op.name = 'd18Op'
-        d18Op.attrs['long_name'] = 'Precipitation d18O'
-        d18Op.attrs['units'] = 'permil'
-
-        return d18Op
-
-    def get_d18Osw(case, **kws):
-        case.load('R18O', **kws)
-        R18O = case.ds['R18O'].x.da
-        d18Osw = (R18O - 1)*1e3
-        d18Osw.name = 'd18Osw'
-        d18Osw.attrs['long_name'] = 'Sea-water d18O'
-        d18Osw.attrs['units'] = 'permil'
-        return d18Osw
-
-    def get_d18Oc(case, **kws):
-        ''' Calculate d18Oc = f(TEMP, d18Osw)
-
-        Reference: Marchitoo et al. (2014)
-        '''
-        case.load('R18O', **kws)
-        case.load('TEMP', **kws)
-        R18O = case.ds['R18O'].x.da
-        d18Osw = (R18O - 1)*1e3
-        T = case.ds['TEMP'].x.da
-
-        d18Osw_PDB = d18Osw - 0.27         #VSMOW to VPDB conversion
-        d18Oc = (-0.245*T + 0.0011*T*T + 3.58) + d18Osw_PDB
-        d18Oc.name = 'd18Oc'
-        d18Oc.attrs['long_name'] = 'Calcite d18O'
-        d18Oc.attrs['units'] = 'permil'
-        return d18Oc
-
-
-    def get_RESTOM(case, **kws):
-        ''' Calculate RESTOM = FSNT - FLNT
-        '''
-        case.load('FSNT', **kws)
-        case.load('FLNT', **kws)
-
-        RESTOM = case.ds['FSNT'].x.da - case.ds['FLNT'].x.da
-        RESTOM.name = 'RESTOM'
-        RESTOM.attrs['long_name'] = 'Net Radiation Flux'
-        RESTOM.attrs['units'] = 'W/m$^2$'
-        return RESTOM
-    
-
 
+class DerivedVar:
+    ''' A derived variable calculated from its input variables by a vectorized kernel
+
+    Args:
+        name (str): the name of the derived variable
+        inputs (list or callable): the names of the input variables, either output variables or other derived variables;
+            or a function of the case returning the names, for inputs that depend on the available output
+        kernel (callable): the function of the input `xarray.DataArray`s in the order of `inputs`; it should only
+            use elementwise/xarray operations, so that the kernels of a plan stay lazy and are fused by dask
+        attrs (dict): the attributes to set on the result, e.g., `long_name` and `units`
+    '''
+    def __init__(self, name, inputs, kernel, attrs=None):
+        self.name = name
+        self.inputs = inputs
+        self.kernel = kernel
+        self.attrs = {} if attrs is None else attrs
+
+    def get_inputs(self, case):
+        return self.inputs(case) if callable(self.inputs) else list(self.inputs)
+
+# the registry of the derived variables
+derived_vars = {}
+
+def derived_var(name, inputs, **attrs):
+    ''' Register the decorated function as the kernel of a derived variable; see `DerivedVar` '''
+    def decorator(kernel):
+        derived_vars[name] = DerivedVar(name, inputs, kernel, attrs=attrs)
+        return kernel
+    return decorator
+
+def resolve(case, vns):
+    ''' Resolve derived variables into a load plan
+
+    Returns:
+        tuple: the deduplicated output variables to load, and the derived variables in the order of calculation
+    '''
+    raw, order, visiting = [], [], set()
+    def visit(vn):
+        if vn in raw or vn in order: return
+        if vn not in derived_vars:
+            raw.append(vn)
+            return
+        if vn in visiting: raise ValueError(f'Circular dependency of the derived variable: {vn}')
+
+        visiting.add(vn)
+        for v in derived_vars[vn].get_inputs(case):
+            if v == vn:
+                # an output variable of the same name
+                if v not in raw: raw.append(v)
+            else:
+                visit(v)
+        visiting.discard(vn)
+        order.append(vn)
+
+    for vn in vns: visit(vn)
+    return raw, order
+
+def calc_derived(case, vns, **kws):
+    ''' Calculate derived variables with all their inputs loaded at once and the shared inputs calculated only once
+
+    Args:
+        case (x4c.Timeseries): the case to load the inputs from
+        vns (list): the names of the derived variables
+        kws: the keyword arguments of `case.load`
+
+    Returns:
+        dict: the results keyed by the names, including the intermediate derived variables
+    '''
+    raw, order = resolve(case, vns)
+    case.load(raw, **kws)
+
+    res = {}
+    for vn in order:
+        dv = derived_vars[vn]
+        args = [res[v] if v in res and v != vn else case.ds[v].x.da for v in dv.get_inputs(case)]
+        da = dv.kernel(*args).copy(deep=False)
+        da.name = vn
+        da.attrs.update(dv.attrs)
+        res[vn] = da
+
+    return res
+
+@derived_var('SST', lambda case: ['SST'] if ('SST', 'ocn') in case.vars_info else ['TEMP'], units='°C', long_name='Sea Surface Temperature')
+def calc_SST(sst):
+    return sst.isel(z_t=0) if 'z_t' in sst.dims else sst
+
+@derived_var('LST', ['TS', 'LANDFRAC'], long_name='Land Surface Temperature')
+def calc_LST(ts, landfrac):
+    return ts.where(landfrac>0.5)
+
+@derived_var('MLD', ['XMXL'], units='m')
+def calc_MLD(xmxl):
+    return xmxl / 100
+
+@derived_var('PRECT', ['PRECC', 'PRECL'], long_name='Total precipitation rate (convective + large-scale; liq + ice)')
+def calc_PRECT(precc, precl):
+    return precc + precl
+
+def fused(expr, func, *das):
+    ''' Evaluate an elementwise expression of `xarray.DataArray`s in a single pass over each chunk
+
+    The expression is evaluated by numexpr if installed, without the full-size temporaries of the intermediate steps;
+    otherwise by `func`, which should work in place as much as possible.
+
+    Args:
+        expr (str): the numexpr expression with the inputs named as x0, x1, ...
+        func (callable): the numpy version of the expression
+    '''
+    dtype = np.result_type(*[da.dtype for da in das])
+    def kernel(*xs):
+        if ne is None: return func(*xs).astype(dtype, copy=False)
+        out = np.empty(np.broadcast_shapes(*[x.shape for x in xs]), dtype=dtype)
+        return ne.evaluate(expr, local_dict={f'x{i}': x for i, x in enumerate(xs)}, out=out, casting='unsafe')
+
+    return xr.apply_ufunc(kernel, *das, dask='parallelized', output_dtypes=[dtype], join='inner')
+
+def ratio_to_delta(p18O, p16O):
+    ''' (p18O / p16O - 1) * 1000 in place, with both floored at 1e-18 '''
+    for p in [p16O, p18O]:
+        np.copyto(p, 1e-18, where=~(p > 1e-18))
+    p18O /= p16O
+    p18O -= 1
+    p18O *= 1000
+    return p18O
+
+@derived_var(
+    'd18Op',
+    [
+        'PRECRC_H216Or', 'PRECSC_H216Os', 'PRECRL_H216OR', 'PRECSL_H216OS',
+        'PRECRC_H218Or', 'PRECSC_H218Os', 'PRECRL_H218OR', 'PRECSL_H218OS',
+    ],
+    long_name='Precipitation d18O', units='permil',
+)
+def calc_d18Op(*das):
+    p16O = '(x0 + x1 + x2 + x3)'
+    p18O = '(x4 + x5 + x6 + x7)'
+    floor = lambda p: f'where({p} > 1e-18, {p}, 1e-18)'
+    expr = f'({floor(p18O)} / {floor(p16O)} - 1) * 1000'
+    def func(rc16, sc16, rl16, sl16, rc18, sc18, rl18, sl18):
+        p16O = rc16 + sc16
+        p16O += rl16
+        p16O += sl16
+        p18O = rc18 + sc18
+        p18O += rl18
+        p18O += sl18
+        return ratio_to_delta(p18O, p16O)
+
+    return fused(expr, func, *das)
+
+@derived_var('d18Osw', ['R18O'], long_name='Sea-water d18O', units='permil')
+def calc_d18Osw(R18O):
+    return (R18O - 1)*1e3
+
+@derived_var('d18Oc', ['TEMP', 'd18Osw'], long_name='Calcite d18O', units='permil')
+def calc_d18Oc(T, d18Osw):
+    ''' Calculate d18Oc = f(TEMP, d18Osw)
+
+    Reference: Marchitoo et al. (2014)
+    '''
+    # -0.27: VSMOW to VPDB conversion
+    expr = '(-0.245*x0 + 0.0011*x0*x0 + 3.58) + (x1 - 0.27)'
+    def func(T, d18Osw):
+        d18Oc = 0.0011*T
+        d18Oc -= 0.245
+        d18Oc *= T
+        d18Oc += 3.58 - 0.27
+        d18Oc += d18Osw
+        return d18Oc
 
-    # def get_d18Oc(case, **kws):
-    #     ''' Calculate d18Oc = f(TEMP, d18Osw) based on the Eq (1) of the Ref.:
-    #     T = 16.1 - 4.64 (d18Oc - d18Osw) + 0.09 (d18Oc - d18Osw)^2
-
-    #     Reference: Hollis, C.J., Dunkley Jones, T., Anagnostou, E., Bijl, P.K., Cramwinckel, M.J., Cui, Y., Dickens, G.R., Edgar, K.M., Eley, Y., Evans, D., Foster, G.L., Frieling, J., Inglis, G.N., Kennedy, E.M., Kozdon, R., Lauretano, V., Lear, C.H., Littler, K., Lourens, L., Meckler, A.N., Naafs, B.D.A., Pälike, H., Pancost, R.D., Pearson, P.N., Röhl, U., Royer, D.L., Salzmann, U., Schubert, B.A., Seebeck, H., Sluijs, A., Speijer, R.P., Stassen, P., Tierney, J., Tripati, A., Wade, B., Westerhold, T., Witkowski, C., Zachos, J.C., Zhang, Y.G., Huber, M., Lunt, D.J., 2019. The DeepMIP contribution to PMIP4: methodologies for selection, compilation and analysis of latest Paleocene and early Eocene climate proxy data, incorporating version 0.1 of the DeepMIP database. Geoscientific Model Development 12, 3149–3206. https://doi.org/10.5194/gmd-12-3149-2019
-    #     '''
-    #     case.load('R18O', **kws)
-    #     case.load('TEMP', **kws)
-    #     R18O = case.ds['R18O'].x.da
-    #     d18Osw = (R18O - 1)*1e3
-    #     T = case.ds['TEMP'].x.da
-    #     D = 4.64**2 - 4*0.09*(16.1 - T)
-
-    #     ds = xr.Dataset()
-
-    #     d18Oc = d18Osw + (4.64 + np.sqrt(D))/0.18
-    #     d18Oc.name = 'd18Oc'
-    #     d18Oc.attrs['long_name'] = 'Calcite d18O (solution 1)'
-    #     d18Oc.attrs['units'] = 'permil'
-    #     ds['d18Oc_s1'] = d18Oc
-
-    #     d18Oc = d18Osw + (4.64 - np.sqrt(D))/0.18
-    #     d18Oc.name = 'd18Oc'
-    #     d18Oc.attrs['long_name'] = 'Calcite d18O (solution 2)'
-    #     d18Oc.attrs['units'] = 'permil'
-    #     ds['d18Oc_s2'] = d18Oc
-
-    #     utils.p_warning('>>> There are two solutions: "d18Oc_s1" and "d18Oc_s2".')
-    #     return ds
-
-    def get_MOC(case, **kws):
-        vn = 'MOC'
-        case.load(vn, **kws)
-        da = case.ds[vn].x.da.isel(transport_reg=0, moc_comp=0)
-        da['moc_z'] = da['moc_z'] / 1e5  # unit: cm -> km
-        da['moc_z'].attrs['units'] = 'km'
-        da = da.rename({'moc_z': 'z_t', 'lat_aux_grid': 'lat'})
-        da.name = 'MOC'
-        da.attrs['lon_name'] = 'Meridional Ocean Circulation'
-        return da
-
-    # def get_SOMOC(case, **kws):
-    #     vn = 'MOC'
-    #     case.load(vn, **kws)
-    #     da = case.ds[vn].x.da.isel(transport_reg=0, moc_comp=0)
-    #     da['moc_z'] = da['moc_z'] / 1e5  # unit: cm -> km
-    #     da['moc_z'].attrs['units'] = 'km'
-    #     da = da.sel(moc_z=slice(0.5, None), lat_aux_grid=slice(-90, -28)).min(('moc_z', 'lat_aux_grid'))
-    #     da.name = 'MOC'
-    #     da.attrs['lon_name'] = 'Southern Ocean (90°S-28°S) MOC'
-    #     return da
-
-    def get_ICEFRAC(case, **kws):
-        vn = 'aice'
-        case.load(vn, **kws)
-        convert_factor = 4*np.pi*6.37122**2 / case.ds[vn].gw.sum().values / 100  # 1e6 km^2
-        da = case.ds[vn].x.da * convert_factor
-        da.attrs['units'] = '10$^6$ km$^2$'
-        da.attrs['long_name'] = 'Sea Ice Area'
-        return da
+    return fused(expr, func, T, d18Osw)
+
+@derived_var('RESTOM', ['FSNT', 'FLNT'], long_name='Net Radiation Flux', units='W/m$^2$')
+def calc_RESTOM(FSNT, FLNT):
+    ''' Calculate RESTOM = FSNT - FLNT
+    '''
+    return FSNT - FLNT
+
+@derived_var('MOC', ['MOC'], lon_name='Meridional Ocean Circulation')
+def calc_MOC(moc):
+    da = moc.isel(transport_reg=0, moc_comp=0)
+    da['moc_z'] = da['moc_z'] / 1e5  # unit: cm -> km
+    da['moc_z'].attrs['units'] = 'km'
+    da = da.rename({'moc_z': 'z_t', 'lat_aux_grid': 'lat'})
+    return da
+
+@derived_var('ICEFRAC', ['aice'], units='10$^6$ km$^2$', long_name='Sea Ice Area')
+def calc_ICEFRAC(aice):
+    convert_factor = 4*np.pi*6.37122**2 / utils.get_grid_total(aice, 'gw') / 100  # 1e6 km^2
+    return aice * convert_factor
 
 
 class DiagPlot:
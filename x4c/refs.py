@@ -0,0 +1,109 @@
+import os
+import json
+import hashlib
+import xarray as xr
+
+from . import utils
+
+class RefStore:
+    ''' Persistent kerchunk references that aggregate the timeseries files of a variable into one virtual dataset
+
+    The references record the byte ranges of the chunks in each file and the concatenated coordinates, so that
+    the whole record is opened with the Zarr engine without reading the header of each file. A reference file is
+    named by the fingerprint of its files, i.e., their (path, mtime, size), so it is rebuilt only when the files change.
+    Requires `kerchunk` (and `zarr`); see `Timeseries.load` for the fallback without them.
+
+    Args:
+        ref_dir (str): the directory of the reference files
+    '''
+    def __init__(self, ref_dir):
+        self.ref_dir = os.path.abspath(ref_dir)
+        os.makedirs(self.ref_dir, exist_ok=True)
+
+    @staticmethod
+    def get_fingerprint(paths):
+        fingerprints = []
+        for path in paths:
+            stat = os.stat(path)
+            fingerprints.append((os.path.abspath(path), stat.st_mtime_ns, stat.st_size))
+        return hashlib.sha1(json.dumps(fingerprints).encode()).hexdigest()
+
+    @staticmethod
+    def get_prefix(vn, paths):
+        ''' The prefix of the reference files of a variable over the same paths, regardless of their versions '''
+        paths_key = hashlib.sha1(json.dumps([os.path.abspath(p) for p in paths]).encode()).hexdigest()
+        return f'{vn}.{paths_key[:16]}.'
+
+    def get_path(self, vn, paths):
+        return os.path.join(self.ref_dir, f'{self.get_prefix(vn, paths)}{self.get_fingerprint(paths)[:16]}.json')
+
+    @staticmethod
+    def translate(path):
+        ''' Return the references of a single netCDF file, either in the netCDF4 (HDF5) or the classic format '''
+        with open(path, 'rb') as f:
+            magic = f.read(4)
+
+        if magic[:3] == b'CDF':
+            from kerchunk.netCDF3 import NetCDF3ToZarr
+            return NetCDF3ToZarr(path, inline_threshold=1000).translate()
+        else:
+            from kerchunk.hdf import SingleHdf5ToZarr
+            return SingleHdf5ToZarr(path, inline_threshold=1000).translate()
+
+    def build(self, vn, paths):
+        ''' Generate the reference file of a variable over `paths`, sorted by time '''
+        from kerchunk.combine import MultiZarrToZarr
+
+        with xr.open_dataset(paths[0], decode_cf=False) as ds0:
+            identical_dims = [v for v in ds0.variables if 'time' not in ds0[v].dims]
+
+        refs = [self.translate(path) for path in paths]
+        if len(refs) == 1:
+            out = refs[0]
+        else:
+            mzz = MultiZarrToZarr(refs, concat_dims=['time'], identical_dims=identical_dims, coo_map={'time': 'cf:time'})
+            out = mzz.translate()
+
+        ref_path = self.get_path(vn, paths)
+        with open(f'{ref_path}.tmp', 'w') as f:
+            json.dump(out, f)
+        os.replace(f'{ref_path}.tmp', ref_path)
+
+        # remove the outdated versions
+        prefix = self.get_prefix(vn, paths)
+        for fname in os.listdir(self.ref_dir):
+            path = os.path.join(self.ref_dir, fname)
+            if fname.startswith(prefix) and fname.endswith('.json') and path != ref_path: os.remove(path)
+
+        return ref_path
+
+    def open(self, paths, vn, adjust_month=False, comp=None, grid=None, **kws):
+        ''' Open the files of a variable as one dataset from its references, which are generated if missing or outdated
+
+        Args:
+            paths (list): the paths to the files
+            vn (str): variable name
+            kws: the other keyword arguments of `xarray.open_dataset`
+        '''
+        ref_path = self.get_path(vn, paths)
+        if not os.path.exists(ref_path):
+            utils.p_hint(f'>>> Generating the references of {vn} over {len(paths)} files')
+            self.build(vn, paths)
+
+        _kws = {
+            'engine': 'zarr',
+            'chunks': {},
+            'backend_kwargs': {
+                'consolidated': False,
+                'storage_options': {'fo': ref_path, 'remote_protocol': 'file'},
+            },
+        }
+        _kws.update(kws)
+        ds = xr.open_dataset('reference://', **_kws)
+        ds = utils.update_ds(ds, vn=vn, path=paths, comp=comp, grid=grid, adjust_month=adjust_month)
+        return ds
+
+    def clear(self):
+        ''' Remove all the reference files '''
+        for fname in os.listdir(self.ref_dir):
+            if fname.endswith('.json'): os.remove(os.path.join(self.ref_dir, fname))
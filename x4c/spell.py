@@ -15,6 +15,10 @@ class Spell:
     - "|plev": to interpolate the data from the model z levels to the pressure levels
     - "|regrid": to regrid the data from the model grid to the regular lat/lon grid
 
+    The steps are summarized in `ops` as (name, argument) tuples in the order of execution:
+    load → slice → plev → ann → sa → regrid → zavg.
+    Two spells share the result of a step if their `ops` share the prefix up to that step.
+
     '''
     def __init__(self, sentence:str):
         self.sentence = sentence
@@ -83,4 +87,25 @@ class Spell:
             if match:
                 self.zavg = match.group(0)
             else:
-                self.zavg = 'zavg()'
\ No newline at end of file
+                self.zavg = 'zavg()'
+
+    @property
+    def ops(self):
+        ''' The list of (name, argument) tuples of the processing steps in the order of execution '''
+        ops = [('load', self.vn.split('.')[0])]
+        for op, arg in [
+            ('slice', self.slicing),
+            ('plev', self.plev),
+            ('ann', self.ann_method),
+            ('sa', self.sa_method),
+            ('regrid', self.regrid),
+            ('zavg', self.zavg),
+        ]:
+            if arg is not None: ops.append((op, arg))
+        return ops
+
+    @property
+    def plan(self):
+        ''' The keys of the intermediate results, each being the prefix of `ops` up to a step '''
+        ops = self.ops
+        return [tuple(ops[:i+1]) for i in range(len(ops))]
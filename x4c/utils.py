@@ -2,14 +2,28 @@ import os
 import glob
 import numpy as np
 import xarray as xr
+import dask
 import xesmf as xe
+import scipy.sparse
 import colorama as ca
 import requests
 from tqdm import tqdm
 import datetime
+import collections
 import collections.abc
 import cartopy.util
 import shutil
+import netCDF4
+import json
+import hashlib
+import heapq
+import bisect
+import itertools
+import queue
+import multiprocessing as mp
+import threading
+import gzip
+import warnings
 
 def p_header(text):
     print(ca.Fore.CYAN + ca.Style.BRIGHT + text + ca.Style.RESET_ALL)
@@ -26,10 +40,89 @@ def p_fail(text):
 def p_warning(text):
     print(ca.Fore.YELLOW + ca.Style.BRIGHT + text + ca.Style.RESET_ALL)
 
+class LRUCache:
+    ''' A thread-safe cache of objects that are expensive to build, evicting the least recently used ones
+
+    Args:
+        maxsize (int): the maximum number of cached objects
+    '''
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        ''' Return the cached object of `key`, calling `build()` to create it if missing '''
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+
+        obj = build()
+        with self.lock:
+            self.items[key] = obj
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+        return obj
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+# the regridders shared by all the datasets in a process
+regridders = LRUCache(maxsize=8)
+
+def get_cam_se_regridder(weight_file):
+    ''' Build (or get from the cache) the regridder for CAM-SE output from an existing ESMF weights file '''
+    def build():
+        weights = xr.open_dataset(weight_file)
+
+        # input variable shape
+        in_shape = weights.src_grid_dims.load().data
+
+        # Since xESMF expects 2D vars, we'll insert a dummy dimension of size-1
+        if len(in_shape) == 1:
+            in_shape = [1, in_shape.item()]
+
+        # output variable shapew
+        out_shape = weights.dst_grid_dims.load().data.tolist()[::-1]
+
+        # construct a regridder
+        # use empty variables to tell xesmf the right shape
+        # https://github.com/pangeo-data/xESMF/issues/202
+        dummy_in = xr.Dataset(
+            {
+                "lat": ("lat", np.empty((in_shape[0],))),
+                "lon": ("lon", np.empty((in_shape[1],))),
+            }
+        )
+        dummy_out = xr.Dataset(
+            {
+                "lat": ("lat", weights.yc_b.data.reshape(out_shape)[:, 0]),
+                "lon": ("lon", weights.xc_b.data.reshape(out_shape)[0, :]),
+            }
+        )
+
+        regridder = xe.Regridder(
+            dummy_in,
+            dummy_out,
+            weights=weight_file,
+            method="bilinear",
+            reuse_weights=True,
+            periodic=True,
+        )
+        weights.close()
+        return regridder
+
+    return regridders.get(('se', os.path.abspath(weight_file)), build)
+
 def regrid_cam_se(ds, weight_file):
     """
     Regrid CAM-SE output using an existing ESMF weights file.
 
+    The regridder built from the weights file is cached, so the file is read only once per process.
+
     Parameters
     ----------
     ds: xarray.Dataset
@@ -49,19 +142,6 @@ def regrid_cam_se(ds, weight_file):
     """
     dataset = ds.copy()
     assert isinstance(dataset, xr.Dataset)
-    weights = xr.open_dataset(weight_file)
-
-    # input variable shape
-    in_shape = weights.src_grid_dims.load().data
-
-    # Since xESMF expects 2D vars, we'll insert a dummy dimension of size-1
-    if len(in_shape) == 1:
-        in_shape = [1, in_shape.item()]
-
-    # output variable shapew
-    out_shape = weights.dst_grid_dims.load().data.tolist()[::-1]
-
-    # print(f"Regridding from {in_shape} to {out_shape}")
 
     # Insert dummy dimension
     vars_with_ncol = [name for name in dataset.variables if "ncol" in dataset[name].dims]
@@ -69,30 +149,7 @@ def regrid_cam_se(ds, weight_file):
         dataset[vars_with_ncol].transpose(..., "ncol").expand_dims("dummy", axis=-2)
     )
 
-    # construct a regridder
-    # use empty variables to tell xesmf the right shape
-    # https://github.com/pangeo-data/xESMF/issues/202
-    dummy_in = xr.Dataset(
-        {
-            "lat": ("lat", np.empty((in_shape[0],))),
-            "lon": ("lon", np.empty((in_shape[1],))),
-        }
-    )
-    dummy_out = xr.Dataset(
-        {
-            "lat": ("lat", weights.yc_b.data.reshape(out_shape)[:, 0]),
-            "lon": ("lon", weights.xc_b.data.reshape(out_shape)[0, :]),
-        }
-    )
-
-    regridder = xe.Regridder(
-        dummy_in,
-        dummy_out,
-        weights=weight_file,
-        method="bilinear",
-        reuse_weights=True,
-        periodic=True,
-    )
+    regridder = get_cam_se_regridder(weight_file)
 
     # Actually regrid, after renaming
     regridded = regridder(updated.rename({"dummy": "lat", "ncol": "lon"}), keep_attrs=True)
@@ -102,17 +159,289 @@ def regrid_cam_se(ds, weight_file):
 
     return ds_out
 
-def annualize(ds, months=None):
-    months = list(range(1, 13)) if months is None else np.abs(months)
+def get_sparse_weights(weight_file):
+    ''' Load (or get from the cache) the weights in an ESMF weights file as a `scipy.sparse` CSR matrix
+
+    Returns:
+        dict: the CSR matrix `W` of shape (n_b, n_a), and the `lat`/`lon` of the destination grid
+    '''
+    def build():
+        with xr.open_dataset(weight_file) as weights:
+            S = weights['S'].values
+            row = weights['row'].values - 1
+            col = weights['col'].values - 1
+            n_a, n_b = weights.sizes['n_a'], weights.sizes['n_b']
+            out_shape = weights.dst_grid_dims.values.tolist()[::-1]
+            lat = weights.yc_b.values.reshape(out_shape)[:, 0]
+            lon = weights.xc_b.values.reshape(out_shape)[0, :]
+
+        W = scipy.sparse.csr_matrix((S, (row, col)), shape=(n_b, n_a))
+        return {'W': W, 'lat': lat, 'lon': lon}
+
+    return regridders.get(('sparse', os.path.abspath(weight_file)), build)
+
+def apply_sparse_weights(x, W, out_shape, renormalize=True):
+    ''' Apply the sparse weights `W` to the last axis of `x` as a single sparse-dense matrix product
+
+    Args:
+        x (numpy.ndarray): the data with the source grid as the last axis
+        W (scipy.sparse.csr_matrix): the weights of shape (n_b, n_a)
+        out_shape (tuple): the shape of the destination grid
+        renormalize (bool): if True, normalize by the weights of the valid (non-NaN) source cells,
+            so that masked cells are excluded instead of propagating NaNs
+    '''
+    lead_shape = x.shape[:-1]
+    x2d = x.reshape(-1, x.shape[-1]).T
+    valid = ~np.isnan(x2d)
+    y = W @ np.where(valid, x2d, 0)
+    if renormalize:
+        wsum = W @ valid.astype(W.dtype)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            y = np.where(wsum > 0, y / wsum, np.nan)
+    else:
+        y[(W @ (~valid).astype(W.dtype)) > 0] = np.nan
+
+    if np.issubdtype(x.dtype, np.floating): y = y.astype(x.dtype, copy=False)
+    return y.T.reshape(*lead_shape, *out_shape)
+
+def regrid_sparse(ds, weight_file, renormalize=True):
+    ''' Regrid CAM-SE output by applying the weights in an ESMF weights file as a sparse matrix
+
+    Unlike `regrid_cam_se`, no `xesmf.Regridder` is constructed and no dummy dimension is inserted.
+    Dask-backed variables are regridded chunk by chunk along the dimensions other than `ncol`.
+
+    Args:
+        ds (xarray.Dataset): the dataset with the `ncol` dimension
+        weight_file (str): path to the ESMF weights file
+        renormalize (bool): if True, normalize by the weights of the valid (non-NaN) source cells
+    '''
+    wgts = get_sparse_weights(weight_file)
+    out_shape = (len(wgts['lat']), len(wgts['lon']))
+
+    ds_out = ds.drop_vars([vn for vn in ds.variables if 'ncol' in ds[vn].dims])
+    for vn in ds.data_vars:
+        da = ds[vn]
+        if 'ncol' not in da.dims or vn in ['lat', 'lon']: continue
+        if da.chunks is not None: da = da.chunk({'ncol': -1})
+        ds_out[vn] = xr.apply_ufunc(
+            apply_sparse_weights, da,
+            kwargs={'W': wgts['W'], 'out_shape': out_shape, 'renormalize': renormalize},
+            input_core_dims=[['ncol']], output_core_dims=[['lat', 'lon']],
+            dask='parallelized', output_dtypes=[da.dtype if np.issubdtype(da.dtype, np.floating) else np.float64],
+            dask_gufunc_kwargs={'output_sizes': {'lat': out_shape[0], 'lon': out_shape[1]}},
+            keep_attrs=True,
+        )
+
+    ds_out = ds_out.assign_coords(lat=('lat', wgts['lat']), lon=('lon', wgts['lon']))
+    return ds_out
+
+def make_coords_tag(ds_in):
+    ''' Identify the source coordinates of a regridding by the shape and a hash of the values of `lat` and `lon` '''
+    shape = 'x'.join(str(n) for n in ds_in['lat'].shape)
+    return f'{shape}_{fingerprint_metrics({"lat": ds_in["lat"], "lon": ds_in["lon"]})}'
+
+def get_latlon_regridder(key, ds_in, dlon=1, dlat=1, method='bilinear', periodic=True, weight_file=None):
+    ''' Build (or get from the cache) the regridder from a curvilinear grid to a regular lat/lon grid
+
+    Args:
+        key (tuple): the cache key identifying the source grid, its coordinates (see `make_coords_tag`), and the regridding options
+        ds_in (xarray.Dataset): the dataset with the `lat` and `lon` of the source grid
+        weight_file (str): if provided, the weights are read from this file if existing,
+            or saved to it after being generated so that later sessions reuse them
+    '''
+    def build():
+        ds_out = xe.util.grid_global(dlon, dlat, cf=True, lon1=360)
+        if weight_file is not None and os.path.exists(weight_file):
+            return xe.Regridder(ds_in, ds_out, method=method, periodic=periodic, weights=weight_file, reuse_weights=True)
+
+        regridder = xe.Regridder(ds_in, ds_out, method=method, periodic=periodic)
+        if weight_file is not None:
+            try:
+                os.makedirs(os.path.dirname(weight_file), exist_ok=True)
+                regridder.to_netcdf(f'{weight_file}.tmp')
+                os.replace(f'{weight_file}.tmp', weight_file)
+            except OSError:
+                p_warning(f'>>> Failed to save the weight file: {weight_file}')
+        return regridder
+
+    return regridders.get(key, build)
+
+def get_month_index(time):
+    ''' Return the month indices (year*12 + month-1) of a time coordinate '''
+    return time.dt.year.values*12 + time.dt.month.values - 1
+
+def is_consecutive_months(time):
+    ''' Check if a time coordinate is monthly without gaps or duplicates '''
+    try:
+        mi = get_month_index(time)
+    except (AttributeError, TypeError):
+        return False
+    return len(mi) > 0 and bool(np.all(np.diff(mi) == 1))
+
+def split_numeric_vars(ds):
+    ''' Return the names of the numeric and the other (e.g., cftime) data variables with the time dimension '''
+    numeric, others = [], []
+    for v in ds.data_vars:
+        if 'time' not in ds[v].dims: continue
+        if ds[v].dtype.kind in 'fiu':
+            numeric.append(v)
+        else:
+            others.append(v)
+    return numeric, others
+
+def fold_months(ds, m_end=12):
+    ''' View monthly data with consecutive months as (year, month) blocks
+
+    The time axis is padded with NaNs so that each block runs from month `m_end`+1 to month `m_end`
+    (e.g., Mar to Feb for `m_end=2`), and then reshaped without copying the data in each time chunk.
+
+    Args:
+        ds (xarray.Dataset or xarray.DataArray): the monthly data; see `is_consecutive_months`
+        m_end (int): the last month of each block
+
+    Returns:
+        tuple: the data with `time` replaced by dims (year, month), where `month` is the position in the block,
+            and the (year, month) boolean mask of the months not padded
+    '''
+    nt = ds.sizes['time']
+    front = (get_month_index(ds['time'])[0] - m_end) % 12
+    nyr = (front + nt + 11) // 12
+    x = ds.drop_vars([c for c in ds.coords if 'time' in ds[c].dims])
+    x = x.pad(time=(front, nyr*12-front-nt))
+    if 'time' in x.chunksizes:
+        # align the time chunks to whole blocks, so that the reshape is done within each chunk
+        x = x.chunk(time=max(12, max(x.chunksizes['time'])//12*12))
+
+    x = x.coarsen(time=12).construct(time=('year', 'month'))
+    mask = np.zeros(nyr*12, dtype=bool)
+    mask[front:front+nt] = True
+    return x, mask.reshape(nyr, 12)
+
+def annualize_resample(ds, months, weighted=False):
+    ''' Annualize with `resample`, which works with any time axis '''
     sds = ds.sel(time=ds['time.month'].isin(months))
     anchor = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
     idx = months[-1]-1
     try:
-        ds_ann = sds.resample(time=f'YE-{anchor[idx]}').mean()  # new version
+        freq = f'YE-{anchor[idx]}'  # new version
+        sds.time[:1].resample(time=freq)
     except:
-        ds_ann = sds.resample(time=f'A-{anchor[idx]}').mean()   # old version
+        freq = f'A-{anchor[idx]}'   # old version
+
+    if not weighted:
+        return sds.resample(time=freq).mean()
+
+    wgts = sds.time.dt.days_in_month
+    wgt_mean = lambda x: (x * wgts).resample(time=freq).sum() / (x.notnull() * wgts).resample(time=freq).sum()
+    if isinstance(sds, xr.Dataset):
+        # only the numeric variables are weighted
+        numeric, _ = split_numeric_vars(sds)
+        ds_ann = sds.drop_vars(numeric).resample(time=freq).mean()
+        ds_ann.update(wgt_mean(sds[numeric]))
+    else:
+        ds_ann = wgt_mean(sds)
+    return ds_ann
+
+def annualize(ds, months=None, weighted=False):
+    ''' Annualize/seasonalize monthly data
+
+    For monthly data with consecutive months, the time axis is folded into (year, month) blocks that end with
+    the last month of the season (see `fold_months`) and averaged over the months of the season, which needs only a few
+    tasks per time chunk. Otherwise, it falls back to `resample`. Either way, a season crossing the year
+    (e.g., DJF) is labeled by the end of its last month, and a partial season at the ends of the record is
+    averaged over the available months.
+
+    Args:
+        months (list of int): the months to average, e.g., `None` means calendar year annualization, [7,8,9] means JJA annualization, and [-12,1,2] means DJF annualization
+        weighted (bool): if True, weight the months by their numbers of days
+    '''
+    months = list(range(1, 13)) if months is None else [int(m) for m in np.abs(months)]
+    if not is_consecutive_months(ds['time']):
+        return annualize_resample(ds, months, weighted=weighted)
+
+    if isinstance(ds, xr.Dataset):
+        numeric, others = split_numeric_vars(ds)
+    elif ds.dtype.kind in 'fiu':
+        numeric, others = None, []
+    else:
+        return annualize_resample(ds, months, weighted=weighted)
+
+    # the labels are the same as `resample`, which only needs the time coordinate
+    labels = annualize_resample(xr.DataArray(np.zeros(ds.sizes['time']), coords={'time': ds['time']}), months)['time']
+
+    m_end = months[-1]
+    pos = sorted({(m-m_end-1) % 12 for m in months})
+    x, mask = fold_months(ds if numeric is None else ds.drop_vars(others), m_end=m_end)
+    x = x.isel(month=pos)
+    keep = mask[:, pos].any(axis=1)
+    if keep.sum() != len(labels):
+        return annualize_resample(ds, months, weighted=weighted)
+
+    if weighted:
+        days = np.zeros(mask.size)
+        days[mask.ravel()] = ds['time'].dt.days_in_month.values
+        wgts = xr.DataArray(days.reshape(mask.shape)[:, pos], dims=('year', 'month'))
+        ds_ann = x.weighted(wgts).mean('month')
+    else:
+        ds_ann = x.mean('month')
+
+    ds_ann = ds_ann.isel(year=keep).rename({'year': 'time'}).assign_coords(time=labels)
+    if others:
+        ds_ann.update(annualize_resample(ds[others], months))
     return ds_ann
 
+# the standard seasons as the lists of their months
+seasons = {
+    'ANN': list(range(1, 13)),
+    'DJF': [12, 1, 2],
+    'MAM': [3, 4, 5],
+    'JJA': [6, 7, 8],
+    'SON': [9, 10, 11],
+}
+
+def seasonal_means(ds, sns=None, weighted=False):
+    ''' Annualize/seasonalize the same data for several seasons at once
+
+    The results are lazy and share the reads of `ds`, so they should be computed (or written, e.g., by `xarray.save_mfdataset`)
+    together to read each time chunk only once.
+
+    Args:
+        sns (list): the names in `seasons`; None means all
+        weighted (bool): if True, weight the months by their numbers of days
+
+    Returns:
+        dict: the results keyed by the season names
+    '''
+    sns = list(seasons) if sns is None else sns
+    ds_means = {}
+    for sn in sns:
+        ds_means[sn] = annualize(ds, months=seasons[sn], weighted=weighted)
+        ds_means[sn].attrs = dict(ds.attrs)
+    return ds_means
+
+def climo(ds):
+    ''' The monthly climatology along the dimension `month`
+
+    For monthly data with consecutive months, the time axis is folded into calendar years (see `fold_months`)
+    and averaged over the years; otherwise, it falls back to `groupby`.
+    '''
+    if isinstance(ds, xr.Dataset):
+        numeric, others = split_numeric_vars(ds)
+    elif ds.dtype.kind in 'fiu':
+        numeric, others = None, []
+    else:
+        numeric = []
+
+    if numeric == [] or not is_consecutive_months(ds['time']):
+        return ds.groupby('time.month').mean(dim='time')
+
+    x, mask = fold_months(ds if numeric is None else ds.drop_vars(others))
+    keep = mask.any(axis=0)
+    ds_climo = x.mean('year').isel(month=keep).assign_coords(month=np.arange(1, 13)[keep])
+    if others:
+        ds_climo.update(ds[others].groupby('time.month').mean(dim='time'))
+    return ds_climo
+
 def monthly2annual(ds):
     month_length = ds.time.dt.days_in_month
     wgts_mon = month_length.groupby('time.year') / month_length.groupby('time.year').mean()
@@ -125,6 +454,279 @@ def monthly2season(ds):
     ds_season = (ds * wgts).groupby('time.season').mean('time')
     return ds_season
 
+# the regions in (lat_min, lat_max, lon_min, lon_max) and the climate indices as linear combinations of regional means
+regions = {
+    'global': None,
+    # open-ended so that the cells at the poles are included as by lat > 0 and lat < 0
+    'nh': (0, np.inf, -np.inf, np.inf),
+    'sh': (-np.inf, 0, -np.inf, np.inf),
+}
+
+climate_indices = {
+    'nino3.4': [(1, (-5, 5, np.mod(-170, 360), np.mod(-120, 360)))],
+    'nino1+2': [(1, (-10, 10, np.mod(-90, 360), np.mod(-80, 360)))],
+    'nino3': [(1, (-5, 5, np.mod(-150, 360), np.mod(-90, 360)))],
+    'nino4': [(1, (-5, 5, np.mod(160, 360), np.mod(-150, 360)))],
+    # Western Pacific Index
+    'wpi': [(1, (-10, 10, np.mod(120, 360), np.mod(150, 360)))],
+    # Tri-Pole Index
+    'tpi': [
+        (-0.5, (25, 45, np.mod(140, 360), np.mod(-145, 360))),
+        (1, (-10, 10, np.mod(170, 360), np.mod(-90, 360))),
+        (-0.5, (-50, -15, np.mod(150, 360), np.mod(-160, 360))),
+    ],
+    # Indian Ocean Dipole Mode
+    'dmi': [(1, (-10, 10, 50, 70)), (-1, (-10, 0, 90, 110))],
+    # Indian Ocean Basin Wide
+    'iobw': [(1, (-20, 20, 40, 100))],
+}
+
+class GridMetrics:
+    ''' A thread-safe registry of the static metrics of the model grids, shared read-only by all the variables on a grid
+
+    The metrics (the area weights `gw`, `lat`, `lon`, the layer thickness `dz`, and the hybrid coefficients) are loaded
+    into memory once per grid, and the attributes of a variable hold only the key of its grid (`grid_key`).
+    '''
+    names = ['gw', 'lat', 'lon', 'dz', 'hyam', 'hybm', 'hyai', 'hybi']
+    fingerprint_names = ['gw', 'lat', 'lon']
+
+    def __init__(self):
+        self.items = {}
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def register(self, prefix, metrics):
+        ''' Add the metrics in the format of {name: xarray.DataArray} to their grid, and return the key of the grid
+
+        The key is `prefix` followed by a fingerprint of the horizontal metrics (`gw`, `lat`, `lon`), so that two grids
+        with the same name and shape but different areas or masks never share an entry.
+        '''
+        loaded = {k: metrics[k].compute() for k in self.fingerprint_names if k in metrics}
+        key = f'{prefix}.{fingerprint_metrics(loaded)}'
+        with self.lock:
+            known = self.items.get(key, {})
+            missing = {k: v for k, v in metrics.items() if k not in known and k not in loaded}
+
+        loaded.update({k: v.compute() for k, v in missing.items()})
+        with self.lock:
+            items = self.items.setdefault(key, {})
+            for k, v in loaded.items():
+                items.setdefault(k, v)
+
+        return key
+
+    def get(self, key, name):
+        with self.lock:
+            return self.items.get(key, {}).get(name)
+
+    def total(self, key, name):
+        ''' The sum of a metric over the grid, e.g., the total area, computed once '''
+        with self.lock:
+            if (key, name) in self.totals: return self.totals[(key, name)]
+
+        metric = self.get(key, name)
+        if metric is None: return None
+        total = float(metric.sum())
+        with self.lock:
+            self.totals[(key, name)] = total
+        return total
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.totals.clear()
+
+# the grid metrics shared by all the datasets in a process
+grid_metrics = GridMetrics()
+
+def make_grid_key(comp, grid, metric):
+    ''' The prefix of the key of a grid: the component, the grid name, and the sizes of its horizontal metric '''
+    sizes = '.'.join(f'{d}{n}' for d, n in metric.sizes.items())
+    return f'{comp}.{grid}.{sizes}'
+
+def fingerprint_metrics(metrics):
+    ''' A short hash of the values of the metrics in the format of {name: xarray.DataArray} '''
+    h = hashlib.sha1()
+    for name in sorted(metrics):
+        values = np.ascontiguousarray(metrics[name].values)
+        h.update(f'{name}{values.dtype.str}{values.shape}'.encode())
+        h.update(values.tobytes())
+    return h.hexdigest()[:12]
+
+def is_regridded_key(key):
+    ''' Check if a grid key refers to a grid regridded by `XDataset.regrid`, whose metrics cannot be reloaded from the source files '''
+    return '>' in str(key)
+
+def load_grid_metrics(attrs):
+    ''' Register the metrics of a grid again from the source file, e.g., in a new process or for a cached result '''
+    if 'path' not in attrs or is_regridded_key(attrs.get('grid_key')): return
+    path = attrs['path'][0] if type(attrs['path']) in (list, tuple) else attrs['path']
+    if not os.path.exists(path): return
+    with xr.open_dataset(path, engine='zarr' if is_zarr(path) else None, decode_times=False) as ds:
+        update_ds(ds, path, comp=attrs.get('comp'), grid=attrs.get('grid'))
+
+def get_grid_metric(obj, name):
+    ''' Return a static metric of the grid of a `xarray.DataArray` or `xarray.Dataset`; None if unknown
+
+    A metric attached to the attributes explicitly takes precedence over the registry.
+
+    Args:
+        name (str): a name in `GridMetrics.names`
+    '''
+    if isinstance(obj.attrs.get(name), xr.DataArray): return obj.attrs[name]
+    if isinstance(obj, xr.Dataset): check_grid_key(obj)
+    key = obj.attrs.get('grid_key')
+    if key is None: return None
+    if key not in grid_metrics: load_grid_metrics(obj.attrs)
+    return grid_metrics.get(key, name)
+
+def get_grid_total(obj, name='gw'):
+    ''' Return the sum of a static metric over the grid of `obj`, e.g., the total area; None if unknown '''
+    if isinstance(obj, xr.Dataset): check_grid_key(obj)
+    key = obj.attrs.get('grid_key')
+    if key is None or isinstance(obj.attrs.get(name), xr.DataArray):
+        metric = get_grid_metric(obj, name)
+        return None if metric is None else float(metric.sum())
+
+    if key not in grid_metrics: load_grid_metrics(obj.attrs)
+    return grid_metrics.total(key, name)
+
+# the masked area weights shared by all the reductions in a process
+region_weights = LRUCache(maxsize=64)
+
+def get_grid_key(da, gw):
+    ''' Identify the grid of `da` to cache the weights; None if the grid is unknown '''
+    if 'grid_key' in da.attrs: return da.attrs['grid_key']
+    if 'comp' not in da.attrs or 'grid' not in da.attrs: return None
+    return (da.attrs['comp'], da.attrs['grid'], tuple(gw.dims), gw.shape)
+
+def get_region_weights(gw, lat, lon, region, grid_key=None):
+    ''' Return the area weights masked by a region, with zeros outside the region
+
+    Args:
+        gw (xarray.DataArray): the area weight of each gridcell
+        lat, lon (xarray.DataArray): the lat/lon of each gridcell
+        region (str or tuple): a name in `regions`, or (lat_min, lat_max, lon_min, lon_max) with the bounds excluded
+        grid_key (tuple): if provided, the weights are cached with this key
+    '''
+    if isinstance(region, str): region = regions[region]
+    def build():
+        if region is None: return gw.fillna(0).load()
+        lat_min, lat_max, lon_min, lon_max = region
+        mask = (lat > lat_min) & (lat < lat_max) & (lon > lon_min) & (lon < lon_max)
+        return gw.where(mask, 0).fillna(0).load()
+
+    if grid_key is None: return build()
+    return region_weights.get((grid_key, region), build)
+
+def weighted_reduce(da, wgts, how='mean'):
+    ''' Reduce `da` over the dims of `wgts` with dot products instead of a masked copy of `da`
+
+    NaNs in `da` are skipped as in `xarray.DataArray.weighted`, i.e., the mean is renormalized by the weights of the valid values.
+
+    Args:
+        wgts (xarray.DataArray): the weights, e.g., from `get_region_weights`
+        how (str): "mean" or "sum"
+    '''
+    dims = list(wgts.dims)
+    num = xr.dot(da.fillna(0), wgts, dim=dims)
+    if how == 'sum':
+        return num
+    elif how == 'mean':
+        den = xr.dot(da.notnull().astype(wgts.dtype), wgts, dim=dims)
+        return num / den.where(den != 0)
+    else:
+        raise ValueError('`how` options: {"mean", "sum"}')
+
+def get_reduce_metrics(da, gw=None, lat=None, lon=None, latlon=True):
+    ''' The (gw, lat, lon, grid_key) to reduce `da`, taken from the grid metrics of `da` by default '''
+    grid_key = None
+    if gw is None:
+        gw = get_grid_metric(da, 'gw')
+        if gw is None: raise KeyError('the area weights `gw` of the grid of `da` are unknown')
+        grid_key = get_grid_key(da, gw)
+
+    if latlon:
+        lat = get_grid_metric(da, 'lat') if lat is None else lat
+        lon = get_grid_metric(da, 'lon') if lon is None else lon
+
+    return gw, lat, lon, grid_key
+
+def region_reduce(da, region, how='mean', gw=None, lat=None, lon=None):
+    ''' The area-weighted mean or sum of `da` over a region, with the weights taken from the grid metrics of `da` by default '''
+    gw, lat, lon, grid_key = get_reduce_metrics(da, gw=gw, lat=lat, lon=lon, latlon=region not in ['global', None])
+    wgts = get_region_weights(gw, lat, lon, region, grid_key=grid_key)
+    return weighted_reduce(da, wgts, how=how)
+
+# the spatial average methods as (region, how, long_name prefix)
+sa_methods = {
+    'gm': ('global', 'mean', 'Global Mean'),
+    'nhm': ('nh', 'mean', 'NH Mean'),
+    'shm': ('sh', 'mean', 'SH Mean'),
+    'gs': ('global', 'sum', 'Global Sum'),
+    'nhs': ('nh', 'sum', 'NH Sum'),
+    'shs': ('sh', 'sum', 'SH Sum'),
+}
+
+def multi_region_reduce(da, methods, gw=None, lat=None, lon=None):
+    ''' Reduce `da` over several regions at once
+
+    The masked weights of all the regions are stacked into a single (region, gridcell) matrix, so that
+    `da` is read only once for all the regions.
+
+    Args:
+        methods (list): each item is a name in `sa_methods` (e.g., "gm", "nhs"), a name in `climate_indices` (e.g., "nino3.4"),
+            a name in `regions` for the mean, or a (lat_min, lat_max, lon_min, lon_max) box for the mean
+
+    Returns:
+        xarray.DataArray: the results along a new dimension `region` labeled by `methods`
+    '''
+    # the outputs as linear combinations of the (region, how) rows
+    outputs = []
+    for m in methods:
+        if isinstance(m, str) and m in sa_methods:
+            region, how, _ = sa_methods[m]
+            outputs.append([(1, region, how)])
+        elif isinstance(m, str) and m in climate_indices:
+            outputs.append([(coef, region, 'mean') for coef, region in climate_indices[m]])
+        elif (isinstance(m, str) and m in regions) or (isinstance(m, tuple) and len(m) == 4):
+            outputs.append([(1, m, 'mean')])
+        else:
+            raise ValueError(f'`methods` options: {list(sa_methods) + list(climate_indices) + list(regions)} or (lat_min, lat_max, lon_min, lon_max)')
+
+    rows = list(dict.fromkeys(region for terms in outputs for _, region, _ in terms))
+    latlon = any(region not in ['global', None] for region in rows)
+    gw, lat, lon, grid_key = get_reduce_metrics(da, gw=gw, lat=lat, lon=lon, latlon=latlon)
+    def build():
+        wgts = [get_region_weights(gw, lat, lon, region, grid_key=grid_key) for region in rows]
+        return xr.concat(wgts, dim='region', coords='minimal', compat='override').load()
+
+    if grid_key is None:
+        wgts = build()
+    else:
+        wgts = region_weights.get((grid_key, tuple(rows)), build)
+
+    dims = [d for d in wgts.dims if d != 'region']
+    num = xr.dot(da.fillna(0), wgts, dim=dims)
+    if any(how == 'mean' for terms in outputs for _, _, how in terms):
+        den = xr.dot(da.notnull().astype(wgts.dtype), wgts, dim=dims)
+        mean = num / den.where(den != 0)
+
+    res = []
+    for terms in outputs:
+        v = 0
+        for coef, region, how in terms:
+            i = rows.index(region)
+            v = v + coef * (num if how == 'sum' else mean).isel(region=i)
+        res.append(v)
+
+    labels = [m if isinstance(m, str) else str(m) for m in methods]
+    return xr.concat(res, dim='region', coords='minimal', compat='override').assign_coords(region=labels)
+
 def geo_mean(da, lat_min=-90, lat_max=90, lon_min=0, lon_max=360, lat_name='lat', lon_name='lon', **kws):
     ''' Calculate the geographical mean value of the climate field.
 
@@ -137,7 +739,8 @@ def geo_mean(da, lat_min=-90, lat_max=90, lon_min=0, lon_max=360, lat_name='lat'
         lat (optional): lat of each gridcell
         lon (optional): lon of each gridcell
     '''
-    if 'gw' not in da.attrs and 'gw' not in kws:
+    region = (lat_min, lat_max, lon_min, lon_max)
+    if get_grid_metric(da, 'gw') is None and 'gw' not in kws:
         # calculation
         mask_lat = (da[lat_name] >= lat_min) & (da[lat_name] <= lat_max)
         mask_lon = (da[lon_name] >= lon_min) & (da[lon_name] <= lon_max)
@@ -147,16 +750,10 @@ def geo_mean(da, lat_min=-90, lat_max=90, lon_min=0, lon_max=360, lat_name='lat'
             })
         wgts = np.cos(np.deg2rad(dac[lat_name]))
         m = dac.weighted(wgts).mean((lon_name, lat_name))
-    elif 'gw' in da.attrs and 'lat' in da.attrs and 'lon' in da.attrs:
-        gw = da.attrs['gw']
-        lat = da.attrs['lat']
-        lon = da.attrs['lon']
-        m = da.where((lat>lat_min) & (lat<lat_max) & (lon>lon_min) & (lon<lon_max)).weighted(gw).mean(list(gw.dims))
     elif 'gw' in kws and 'lat' in kws and 'lon' in kws:
-        gw = kws['gw']
-        lat = kws['lat']
-        lon = kws['lon']
-        m = da.where((lat>lat_min) & (lat<lat_max) & (lon>lon_min) & (lon<lon_max)).weighted(gw).mean(list(gw.dims))
+        m = region_reduce(da, region, gw=kws['gw'], lat=kws['lat'], lon=kws['lon'])
+    else:
+        m = region_reduce(da, region)
     return m
 
 def update_attrs(da, da_src):
@@ -180,6 +777,12 @@ def update_ds(ds, path, vn=None, comp=None, grid=None, adjust_month=False,
     if comp is not None: ds.attrs['comp'] = comp
     if grid is not None: ds.attrs['grid'] = grid
 
+    key = register_grid(ds, gw_name=gw_name, lat_name=lat_name, lon_name=lon_name)
+    if key is not None: ds.attrs['grid_key'] = key
+    return ds
+
+def register_grid(ds, gw_name=None, lat_name=None, lon_name=None):
+    ''' Register the static metrics of the grid of a dataset once, and return the key of the grid; None if no metrics found '''
     if 'comp' in ds.attrs:
         grid_weight_dict = {
             'atm': 'area',
@@ -206,11 +809,99 @@ def update_ds(ds, path, vn=None, comp=None, grid=None, adjust_month=False,
         lat_name = lat_dict[ds.attrs['comp']] if lat_name is None else lat_name
         lon_name = lon_dict[ds.attrs['comp']] if lon_name is None else lon_name
 
-    if gw_name is not None and gw_name in ds: ds['gw'] = ds[gw_name]
-    if lat_name is not None and lat_name in ds: ds['lat'] = ds[lat_name]
-    if lon_name is not None and lon_name in ds: ds['lon'] = ds[lon_name]
+    metrics = {}
+    src_names = {'gw': gw_name, 'lat': lat_name, 'lon': lon_name}
+    for name in GridMetrics.names:
+        src_name = src_names.get(name)
+        if src_name is None or src_name not in ds: src_name = name
+        if src_name in ds: metrics[name] = ds[src_name]
 
-    return ds
+    if 'gw' in metrics: metrics['gw'] = metrics['gw'].fillna(0)
+
+    # the metrics are static, even if concatenated along time
+    metrics = {k: v.isel(time=0, drop=True) if 'time' in v.dims else v for k, v in metrics.items()}
+    hmetric = metrics['gw'] if 'gw' in metrics else metrics.get('lat')
+    if hmetric is None: return None
+    prefix = make_grid_key(ds.attrs.get('comp'), ds.attrs.get('grid'), hmetric)
+    return grid_metrics.register(prefix, metrics)
+
+def check_grid_key(ds):
+    ''' Register the grid of a dataset again if it is a subset (e.g., by `isel`) of the grid its key refers to '''
+    key = ds.attrs.get('grid_key')
+    if key is None or is_regridded_key(key): return
+    if key not in grid_metrics: load_grid_metrics(ds.attrs)
+    for name in ['gw', 'lat', 'dz']:
+        metric = grid_metrics.get(key, name)
+        if metric is not None and any(d in ds.sizes and ds.sizes[d] != n for d, n in metric.sizes.items()):
+            # a subset by `isel` shares the attributes with the whole dataset, so they are replaced instead of updated
+            key = register_grid(ds)
+            if key is not None: ds.attrs = dict(ds.attrs, grid_key=key)
+            return
+
+# the dimensions of the horizontal grids, which are never split into chunks
+horizontal_dims = ['lat', 'lon', 'nlat', 'nlon', 'ni', 'nj', 'ncol', 'lndgrid']
+
+def plan_chunks(sizes, dtype, nworkers=1, mem_budget=2**30, disk_chunks=None, copies=4):
+    ''' Plan the dask chunks of a variable under a per-worker memory budget
+
+    The horizontal dimensions are kept whole. The time dimension is split first, and then the vertical dimensions
+    if a single record is still too large, with the chunk sizes as multiples of the on-disk (HDF5) chunks so that
+    each on-disk chunk is decompressed by a single task. A chunk is sized to leave room for `copies` chunk-sized
+    temporaries per worker, and is shrunk (down to the on-disk chunks or 16 MiB) so that every worker has a chunk to work on.
+
+    Args:
+        sizes (dict): the dimension sizes of the variable in the format of {dim: size}
+        dtype (numpy.dtype): the data type of the variable
+        nworkers (int): the number of workers computing the chunks concurrently
+        mem_budget (int): the memory budget per worker in bytes
+        disk_chunks (dict): the on-disk chunk sizes in the format of {dim: size}; None for contiguous storage
+        copies (int): the number of chunk-sized arrays a worker holds at a time
+
+    Returns:
+        dict: the chunk sizes in the format of {dim: size}
+    '''
+    disk_chunks = {} if disk_chunks is None else disk_chunks
+    itemsize = np.dtype(dtype).itemsize
+    target = mem_budget // copies
+    if nworkers > 1:
+        # but not smaller than 16 MiB, below which the overhead of the tasks dominates
+        target = min(target, max(itemsize*int(np.prod(list(sizes.values()))) // nworkers, 2**24))
+
+    hdims = [d for d in sizes if d in horizontal_dims]
+    if len(hdims) == 0: hdims = list(sizes)[-2:]
+    split_dims = [d for d in sizes if d == 'time'] + [d for d in sizes if d != 'time' and d not in hdims]
+
+    chunks = dict(sizes)
+    for dim in split_dims:
+        nbytes = itemsize * int(np.prod(list(chunks.values())))
+        if nbytes <= target: break
+        unit = min(disk_chunks.get(dim, 1), sizes[dim])
+        size = target // (nbytes // chunks[dim])
+        chunks[dim] = min(max(size // unit * unit, unit), sizes[dim])
+
+    return chunks
+
+def plan_file_chunks(path, vn=None, nworkers=None, mem_budget=2**30):
+    ''' Plan the dask chunks of a netCDF file with `plan_chunks` from the layout of a variable
+
+    Args:
+        vn (str): the variable to plan for; the largest variable of the file if None or not in the file
+        nworkers (int): defaults to the number of workers of the dask scheduler
+
+    Returns:
+        dict: the chunk sizes of all the dimensions in the file, with -1 for the dimensions not used by the variable
+    '''
+    if nworkers is None: nworkers = dask.config.get('num_workers', None) or os.cpu_count()
+
+    with netCDF4.Dataset(path) as nc:
+        var = nc.variables[vn] if vn in nc.variables else max(nc.variables.values(), key=lambda v: v.size)
+        sizes = dict(zip(var.dimensions, var.shape))
+        chunking = var.chunking()
+        disk_chunks = dict(zip(var.dimensions, chunking)) if isinstance(chunking, list) else None
+        chunk_dict = {d: -1 for d in nc.dimensions}
+
+    chunk_dict.update(plan_chunks(sizes, var.dtype, nworkers=nworkers, mem_budget=mem_budget, disk_chunks=disk_chunks))
+    return chunk_dict
 
 def infer_months_char(months):
     char_list = ['J', 'F', 'M', 'A', 'M', 'J', 'J', 'A', 'S', 'O', 'N', 'D']
@@ -305,6 +996,168 @@ def find_paths(root_dir, path_pattern='comp/proc/tseries/month_1/casename.mdl.h_
         paths = paths_new
     return paths
 
+def parse_date_range(date_str):
+    ''' Parse the date or date range stamped in a CESM filename into a (start, end) range of month indices (year*12 + month-1)
+
+    Supported formats: YYYYMM-YYYYMM, YYYYMMDD-YYYYMMDD, YYYY-YYYY, YYYY, YYYY-MM, YYYY-MM-DD, and YYYY-MM-DD-SSSSS
+    '''
+    dates = date_str.split('-')
+    if not all(d.isdigit() for d in dates) or len(dates[0]) < 4:
+        raise ValueError(f'Unknown date format: {date_str}')
+
+    if len(dates[0]) > 4 and len(dates) == 2:
+        # compact dates, e.g., YYYYMM-YYYYMM
+        s, e = dates
+        start = int(s[:4])*12 + (int(s[4:6])-1 if len(s) >= 6 else 0)
+        end = int(e[:4])*12 + (int(e[4:6])-1 if len(e) >= 6 else 11)
+    elif len(dates[0]) == 4 and len(dates) >= 2 and len(dates[1]) == 2:
+        # a single date, e.g., YYYY-MM or YYYY-MM-DD
+        start = end = int(dates[0])*12 + int(dates[1])-1
+    elif len(dates[0]) == 4 and len(dates) <= 2:
+        # years, e.g., YYYY or YYYY-YYYY
+        start, end = int(dates[0])*12, int(dates[-1])*12 + 11
+    else:
+        raise ValueError(f'Unknown date format: {date_str}')
+
+    return start, end
+
+class TimeIndex:
+    ''' An index of files by the time ranges stamped in their names
+
+    The filenames are parsed only once; the files are sorted by their start months along with the running maximum
+    of the end months, so that an overlap query takes a binary search plus the matched files.
+
+    Args:
+        paths (list): the file paths with the date or date range as the second last dot-separated element
+        ranges (list): the precomputed (start, end) month indices of the paths; parsed from the filenames if None
+    '''
+    def __init__(self, paths, ranges=None):
+        if ranges is None:
+            ranges = [parse_date_range(os.path.basename(path).split('.')[-2]) for path in paths]
+
+        order = sorted(range(len(paths)), key=lambda i: (ranges[i][0], paths[i]))
+        self.paths = [paths[i] for i in order]
+        self.starts = [ranges[i][0] for i in order]
+        self.ends = [ranges[i][1] for i in order]
+        self.max_ends = list(itertools.accumulate(self.ends, max))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def overlap(self, start, end):
+        ''' Return the paths whose month ranges overlap with [start, end] '''
+        i0 = bisect.bisect_left(self.max_ends, start)
+        i1 = bisect.bisect_right(self.starts, end)
+        return [self.paths[i] for i in range(i0, i1) if self.ends[i] >= start]
+
+    def query(self, timespan=None):
+        ''' Return the paths overlapping with the (start_year, end_year) timespan; all the paths if None '''
+        if timespan is None: return list(self.paths)
+        syr, eyr = timespan
+        return self.overlap(syr*12, eyr*12+11)
+
+class ClimoAccumulator:
+    ''' Running per-month statistics of monthly slabs for an out-of-core climatology
+
+    Only the sums and the counts (or, with `variance=True`, the Welford mean and sum of squared deviations)
+    of each calendar month are kept, so the memory does not grow with the length of the record.
+    NaNs are skipped gridcell by gridcell.
+
+    Args:
+        variance (bool): if True, also accumulate the variance with Welford's algorithm
+    '''
+    def __init__(self, variance=False):
+        self.variance = variance
+        self.counts = {}
+        self.sums = {}
+        self.m2s = {}
+
+    def add(self, month, x):
+        ''' Add a slab `x` (numpy.ndarray) of a calendar month '''
+        x = np.asarray(x, dtype=np.float64)
+        valid = ~np.isnan(x)
+        if month not in self.counts:
+            self.counts[month] = np.zeros(x.shape, dtype=np.int64)
+            self.sums[month] = np.zeros(x.shape)
+            if self.variance: self.m2s[month] = np.zeros(x.shape)
+
+        n = self.counts[month]
+        n += valid
+        if self.variance:
+            # `sums` holds the running mean
+            mean = self.sums[month]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                delta = np.where(valid, x - mean, 0)
+                mean += np.where(valid, delta / n, 0)
+            self.m2s[month] += np.where(valid, delta * (x - mean), 0)
+        else:
+            self.sums[month] += np.where(valid, x, 0)
+
+    @property
+    def months(self):
+        return sorted(self.counts)
+
+    def mean(self):
+        ''' Return the (month, ...) array of the means; NaN where no valid values '''
+        res = []
+        for m in self.months:
+            n = self.counts[m]
+            v = self.sums[m] if self.variance else self.sums[m] / np.where(n > 0, n, 1)
+            res.append(np.where(n > 0, v, np.nan))
+        return np.stack(res)
+
+    def var(self, ddof=1):
+        ''' Return the (month, ...) array of the variances; NaN where fewer than `ddof`+1 valid values '''
+        if not self.variance: raise ValueError('The variance is not accumulated; set `variance=True`.')
+        res = []
+        for m in self.months:
+            n = self.counts[m]
+            res.append(np.where(n > ddof, self.m2s[m] / np.where(n > ddof, n - ddof, 1), np.nan))
+        return np.stack(res)
+
+def parse_log(path, vns, state=None):
+    ''' Parse the start date and the values of the variables from a CESM log file in a single streaming pass
+
+    For an uncompressed log that is still being written, pass the state returned by the previous call
+    to parse only the lines appended since then; an incomplete last line is left for the next call.
+
+    Args:
+        path (str): path to the log file, gzipped if ending with ".gz"
+        vns (list): the variable names to match the lines in the form "NAME: value"
+        state (dict): the state returned by the previous call on the same file
+
+    Returns:
+        dict: the state, including the start date string in "mm-dd-yyyy" as `start_date`,
+            the dictionary of the lists of values as `values`, and the byte offset parsed up to as `offset`
+    '''
+    if state is None:
+        state = {'start_date': None, 'values': {v: [] for v in vns}, 'offset': 0, 'prev_line': '', 'nlines': 0}
+
+    values = state['values']
+    gzipped = path.endswith('.gz')
+    with (gzip.open(path, mode='rb') if gzipped else open(path, 'rb')) as fp:
+        if not gzipped: fp.seek(state['offset'])
+        for bline in fp:
+            if not gzipped and not bline.endswith(b'\n'): break
+            state['offset'] += len(bline)
+            state['nlines'] += 1
+            line = bline.decode(errors='replace')
+
+            if state['start_date'] is None and line.find('date(month-day-year):') != -1 and state['prev_line'].find('This run        started from') != -1:
+                state['start_date'] = line.split(':')[-1].strip()
+            state['prev_line'] = line
+
+            # the first line is never a variable line
+            if state['nlines'] == 1: continue
+            name, sep, _ = line.strip().partition(':')
+            if sep and name in values:
+                values[name].append(float(line.strip().split(':')[-1]))
+
+    if gzipped and state['start_date'] is None:
+        raise ValueError(f'Start date not found in: {path}')
+
+    return state
+
 def download(url: str, fname: str, chunk_size=1024, show_bar=True):
     os.makedirs(os.path.dirname(fname), exist_ok=True)
     resp = requests.get(url, stream=True)
@@ -330,7 +1183,455 @@ def move_with_overwrite(src, dst_dir):
     # Construct the full destination path
     dst = os.path.join(dst_dir, os.path.basename(src))
     
-    if os.path.exists(dst):
-        os.remove(dst)
+    # move to a temporary file first since a move across filesystems is a copy
+    shutil.move(src, f'{dst}.tmp')
+    os.replace(f'{dst}.tmp', dst)
+
+def split_nc(in_path, out_paths, exclude_vns=None, slab_size=1):
+    ''' Split a netCDF file into per-variable files, reading the input file only once
+
+    Variables not listed in `out_paths` or `exclude_vns` (e.g., coordinates, time bounds)
+    are read once and copied to every output file, while each split variable is streamed
+    into its output file hyperslab by hyperslab along its leading dimension.
+
+    Args:
+        in_path (str): path to the input netCDF file
+        out_paths (dict): the output paths in the format of {vn: out_path}
+        exclude_vns (list): variables to be excluded from all the output files
+        slab_size (int): the number of records along the leading dimension to copy at a time
+    '''
+    exclude_vns = set(out_paths) if exclude_vns is None else set(exclude_vns) | set(out_paths)
+
+    with netCDF4.Dataset(in_path) as src:
+        src.set_auto_maskandscale(False)
+        shared_vns = [v for v in src.variables if v not in exclude_vns]
+        shared_data = {v: src.variables[v][...] for v in shared_vns}
+        gattrs = {k: src.getncattr(k) for k in src.ncattrs()}
+
+        for vn, out_path in out_paths.items():
+            if os.path.exists(out_path): os.remove(out_path)
+            with netCDF4.Dataset(out_path, 'w', format=src.data_model) as dst:
+                dst.setncatts(gattrs)
+                for v in shared_vns + [vn]:
+                    for dim in src.variables[v].dimensions:
+                        if dim not in dst.dimensions:
+                            dst.createDimension(dim, None if src.dimensions[dim].isunlimited() else len(src.dimensions[dim]))
+
+                    copy_nc_var(src.variables[v], dst)
+
+                for v in shared_vns:
+                    if dst.variables[v].ndim == 0:
+                        dst.variables[v].assignValue(shared_data[v])
+                    else:
+                        dst.variables[v][:] = shared_data[v]
+
+                var = src.variables[vn]
+                if var.ndim == 0:
+                    dst.variables[vn].assignValue(var.getValue())
+                else:
+                    for i in range(0, var.shape[0], slab_size):
+                        dst.variables[vn][i:i+slab_size] = var[i:i+slab_size]
+
+def copy_nc_var(var, dst, **kws):
+    ''' Create a variable in `dst` with the same name, type, dimensions, attributes, and storage settings of `var`
+    '''
+    attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+    _kws = {'fill_value': attrs.pop('_FillValue', None)}
+    filters = var.filters()
+    if filters is not None and dst.data_model.startswith('NETCDF4'):
+        _kws.update({k: filters[k] for k in ['zlib', 'complevel', 'shuffle'] if k in filters})
+        chunking = var.chunking()
+        if chunking == 'contiguous':
+            _kws['contiguous'] = True
+        elif chunking is not None:
+            _kws['chunksizes'] = chunking
+
+    _kws.update(kws)
+    if _kws.get('zlib'): _kws.pop('contiguous', None)
+    dst_var = dst.createVariable(var.name, var.datatype, var.dimensions, **_kws)
+    dst_var.set_auto_maskandscale(False)
+    dst_var.setncatts(attrs)
+    return dst_var
+
+def transpose_nc(in_paths, out_paths, exclude_vns=None, record_dim='time', compression=1):
+    ''' Concatenate a block of netCDF files along the record dimension into per-variable files
+
+    Each input file is opened only once; the slab of every variable is appended directly
+    into its output file at the record offset of the input file, so no intermediate per-variable
+    files are needed. Variables not listed in `out_paths` or `exclude_vns` are copied to every output file.
+
+    Args:
+        in_paths (list): paths to the input netCDF files, in the order of the record dimension
+        out_paths (dict): the output paths in the format of {vn: out_path}
+        exclude_vns (list): variables to be excluded from all the output files
+        record_dim (str): the name of the record dimension
+        compression (int): the deflate level of the output files; 0 means no compression
+    '''
+    exclude_vns = set(out_paths) if exclude_vns is None else set(exclude_vns) | set(out_paths)
+    _kws = {'zlib': compression > 0, 'complevel': compression, 'shuffle': compression > 0}
+
+    # write to temporary files first so that an interrupted run never leaves truncated outputs
+    tmp_paths = {vn: f'{out_path}.tmp' for vn, out_path in out_paths.items()}
+    dsts = {}
+    try:
+        with netCDF4.Dataset(in_paths[0]) as src:
+            src.set_auto_maskandscale(False)
+            shared_vns = [v for v in src.variables if v not in exclude_vns]
+            gattrs = {k: src.getncattr(k) for k in src.ncattrs()}
+            for vn, tmp_path in tmp_paths.items():
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+                dst = netCDF4.Dataset(tmp_path, 'w', format='NETCDF4')
+                dst.setncatts(gattrs)
+                for v in shared_vns + [vn]:
+                    for dim in src.variables[v].dimensions:
+                        if dim not in dst.dimensions:
+                            dst.createDimension(dim, None if dim == record_dim else len(src.dimensions[dim]))
+
+                    copy_nc_var(src.variables[v], dst, **_kws)
+                    if record_dim not in src.variables[v].dimensions:
+                        if src.variables[v].ndim == 0:
+                            dst.variables[v].assignValue(src.variables[v].getValue())
+                        else:
+                            dst.variables[v][:] = src.variables[v][:]
+
+                dsts[vn] = dst
+
+            record_shared_vns = [v for v in shared_vns if record_dim in src.variables[v].dimensions]
+
+        i0 = 0
+        for path in in_paths:
+            with netCDF4.Dataset(path) as src:
+                src.set_auto_maskandscale(False)
+                nr = len(src.dimensions[record_dim])
+                for v in record_shared_vns:
+                    data = src.variables[v][:]
+                    for dst in dsts.values():
+                        dst.variables[v][i0:i0+nr] = data
+
+                for vn, dst in dsts.items():
+                    dst.variables[vn][i0:i0+nr] = src.variables[vn][:]
+
+            i0 += nr
+
+    finally:
+        for dst in dsts.values():
+            dst.close()
+
+    for vn, out_path in out_paths.items():
+        os.replace(tmp_paths[vn], out_path)
+
+
+def checksum(path, chunk_size=2**24):
+    ''' Calculate the MD5 checksum of a file '''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+class Manifest:
+    ''' A persistent record of the completed (component, variable, timespan) units and their output files
+
+    Args:
+        path (str): path to the JSON file of the manifest
+        reset (bool): if True, start with an empty manifest even if the file exists
+    '''
+    def __init__(self, path, reset=False):
+        self.path = path
+        self.records = {}
+        if not reset and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.records = json.load(f)
+
+    def get_key(self, comp, vn, timespan):
+        return f'{comp}.{vn}.{timespan[0]}-{timespan[1]}'
+
+    def is_done(self, comp, vn, timespan, path, verify=False):
+        key = self.get_key(comp, vn, timespan)
+        if key not in self.records: return False
+
+        record = self.records[key]
+        if record['path'] != os.path.abspath(path) or not os.path.exists(path): return False
+        # a Zarr store is shared by the timespans appended to it, so it has no size or checksum of its own
+        if record['size'] is None: return True
+        if os.path.getsize(path) != record['size']: return False
+        if verify and checksum(path) != record['checksum']: return False
+        return True
+
+    def add(self, comp, vn, timespan, path, md5=None):
+        is_store = os.path.isdir(path)
+        self.records[self.get_key(comp, vn, timespan)] = {
+            'comp': comp,
+            'vn': vn,
+            'timespan': list(timespan),
+            'path': os.path.abspath(path),
+            'size': None if is_store else os.path.getsize(path),
+            'checksum': None if is_store else checksum(path) if md5 is None else md5,
+        }
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(f'{self.path}.tmp', 'w') as f:
+            json.dump(self.records, f, indent=2)
+        os.replace(f'{self.path}.tmp', self.path)
+
+def finalize_output(src_path, dst_dirpath=None):
+    ''' Move a generated file to its destination directory (if any) and return the destination path and its MD5 checksum
+    '''
+    if not os.path.exists(src_path):
+        p_warning(f'>>> File not generated: {src_path}')
+        return None
+
+    if dst_dirpath is None or os.path.abspath(os.path.dirname(src_path)) == os.path.abspath(dst_dirpath):
+        dst_path = src_path
+    else:
+        move_with_overwrite(src_path, dst_dirpath)
+        dst_path = os.path.join(dst_dirpath, os.path.basename(src_path))
+
+    return dst_path, checksum(dst_path)
+
+output_exts = {
+    'nc': '.nc',
+    'zarr': '.zarr',
+}
+
+def is_zarr(path):
+    ''' Check if a path refers to a Zarr store by its `.zarr` suffix '''
+    return str(path).rstrip('/').endswith('.zarr')
+
+def remove_path(path):
+    ''' Remove a file or a Zarr store (a directory) if it exists '''
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def get_zarr_chunks(ds, chunks=None):
+    ''' Return the chunk sizes of each variable of a dataset in the format of {vn: {dim: size}}
+
+    Args:
+        chunks (dict): either {dim: size} shared by all the variables or {vn: {dim: size}} per variable,
+            where -1 means the full length; the dimensions not specified are stored in a single chunk,
+            except for "time" that defaults to 12 records so that the store can be appended by years
+    '''
+    chunks = {} if chunks is None else chunks
+    chunks_dict = {}
+    for vn, v in ds.variables.items():
+        if v.ndim == 0: continue
+        spec = chunks[vn] if isinstance(chunks.get(vn), dict) else chunks
+        chunks_dict[vn] = {}
+        for dim in v.dims:
+            size = spec.get(dim, 12 if dim == 'time' else -1)
+            chunks_dict[vn][dim] = v.sizes[dim] if size == -1 else size
+
+    return chunks_dict
+
+def to_zarr(ds, path, chunks=None, append_dim=None, compute=True):
+    ''' Write a dataset into a Zarr store with consolidated metadata and the chunk layout of `get_zarr_chunks`
+
+    The dask arrays are rechunked to the chunks of the store, so that each dask task writes whole chunks
+    and the tasks can run concurrently without locks.
+
+    Args:
+        append_dim (str): if set, append `ds` to the existing store along this dimension
+        compute (bool): if False, return a `dask.delayed.Delayed` object to compute the writing later
+    '''
+    chunks_dict = get_zarr_chunks(ds, chunks=chunks)
+    ds = ds.copy()
+    for vn, v in ds.variables.items():
+        if vn in chunks_dict and v.chunks is not None:
+            ds[vn] = ds[vn].chunk({d: s for d, s in chunks_dict[vn].items() if d in ds[vn].dims})
+
+    # the attributes are stored as JSON
+    for obj in [ds, *ds.variables.values()]:
+        attrs = {k: v for k, v in obj.attrs.items() if not isinstance(v, xr.DataArray)}
+        obj.attrs = json.loads(json.dumps(attrs, default=lambda o: o.tolist() if hasattr(o, 'tolist') else str(o)))
+
+    kws = {'consolidated': True, 'compute': compute}
+    if append_dim is None:
+        kws['mode'] = 'w'
+        kws['encoding'] = {vn: {'chunks': tuple(c.values())} for vn, c in chunks_dict.items()}
+    else:
+        kws['append_dim'] = append_dim
+
+    with warnings.catch_warnings():
+        # consolidated metadata is not a part of the Zarr v3 specification yet
+        warnings.filterwarnings('ignore', message='Consolidated metadata')
+        return ds.to_zarr(path, **kws)
+
+def save_dataset(ds, path, output_format='nc', chunks=None, **kws):
+    ''' Save a dataset to a netCDF file or a Zarr store, written to a temporary path first and then renamed
+
+    Args:
+        output_format (str): "nc" or "zarr"
+        chunks (dict): the chunk sizes of the Zarr store; see `get_zarr_chunks`
+        kws: the other keyword arguments of `xarray.Dataset.to_netcdf`
+    '''
+    if output_format not in output_exts: raise ValueError('`output_format` options: {"nc", "zarr"}')
+    tmp_path = f'{path}.tmp'
+    remove_path(tmp_path)
+    if output_format == 'zarr':
+        to_zarr(ds, tmp_path, chunks=chunks)
+    else:
+        ds.to_netcdf(tmp_path, **kws)
+
+    remove_path(path)
+    os.replace(tmp_path, path)
+
+def truncate_zarr(path, dim, n):
+    ''' Truncate the variables of a Zarr store along `dim` to the first `n` records '''
+    import zarr
+
+    with xr.open_zarr(path) as ds:
+        dims_dict = {vn: ds[vn].dims for vn in ds.variables if dim in ds[vn].dims}
+
+    group = zarr.open_group(path, mode='r+')
+    for vn, dims in dims_dict.items():
+        shape = list(group[vn].shape)
+        shape[dims.index(dim)] = n
+        group[vn].resize(tuple(shape))
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='Consolidated metadata')
+        zarr.consolidate_metadata(path)
+
+def append_zarr(src_path, store_path, dim='time', chunks=None, remove_src=True):
+    ''' Append the records of a netCDF file to a Zarr store along `dim`, creating the store if missing
+
+    The records of the store at or beyond the first record of the file (e.g., left by an interrupted run)
+    are dropped first, so that appending the same file again is harmless.
+
+    Returns:
+        tuple: (store_path, None) to be recorded in a `Manifest`; None if the file does not exist
+    '''
+    if not os.path.exists(src_path):
+        p_warning(f'>>> File not generated: {src_path}')
+        return None
+
+    with xr.open_dataset(src_path) as ds:
+        if not os.path.exists(store_path):
+            to_zarr(ds, store_path, chunks=chunks)
+        else:
+            with xr.open_zarr(store_path) as ds_store:
+                n = int((ds_store[dim] < ds[dim].values[0]).sum())
+                if n < ds_store.sizes[dim]: truncate_zarr(store_path, dim, n)
+            to_zarr(ds, store_path, append_dim=dim)
+
+    if remove_src: os.remove(src_path)
+    return store_path, None
+
+def reset_dask_pool():
+    ''' Drop the thread pools of the dask threaded scheduler inherited from the parent process
+
+    After a fork, the pools look full of threads that do not exist in the child, so a computation in a worker
+    process of a `multiprocessing.Pool` would hang once the parent has computed anything with dask.
+    '''
+    import dask.threaded
+    dask.threaded.pools_lock = threading.Lock()
+    dask.threaded.default_pool = None
+    dask.threaded.pools.clear()
+
+class TaskGraph:
+    ''' A task graph executed on a single long-lived process pool
+
+    A task is submitted once all its dependencies are completed. Among the ready tasks, the ones
+    with lower `priority` are submitted first, so that later stages of earlier chunks are preferred
+    over earlier stages of later chunks, which pipelines the stages.
+    '''
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, key, func, args=(), deps=None, priority=0, io=True, callback=None):
+        ''' Add a task
+
+        Args:
+            key (hashable): the unique key of the task
+            func (callable): the function to call with `args`; must be picklable
+            deps (list): the keys of the tasks that need to be completed before this one
+            priority (tuple or int): tasks with lower values are submitted first
+            io (bool): if True, the task counts towards the cap of concurrent I/O tasks
+            callback (callable): called in the main process with the returned value of the task
+        '''
+        self.tasks[key] = {
+            'func': func, 'args': args, 'deps': [] if deps is None else list(deps),
+            'priority': priority, 'io': io, 'callback': callback,
+        }
+        return key
+
+    def run(self, nproc=1, max_io=None, desc='Running tasks', initializer=reset_dask_pool, initargs=()):
+        ''' Run all the tasks
+
+        Args:
+            nproc (int): the number of worker processes; 1 means running in the main process
+            max_io (int): the maximum number of I/O tasks running concurrently; None means `nproc`
+            initializer (callable): called with `initargs` once in each worker process
+        '''
+        if max_io is None: max_io = nproc
+        ndeps = {key: len(task['deps']) for key, task in self.tasks.items()}
+        children = {key: [] for key in self.tasks}
+        for key, task in self.tasks.items():
+            for dep in task['deps']:
+                children[dep].append(key)
+
+        ready = []
+        for seq, key in enumerate(self.tasks):
+            if ndeps[key] == 0:
+                heapq.heappush(ready, (self.tasks[key]['priority'], seq, key))
+
+        seq = len(self.tasks)
+        def complete(key, res):
+            nonlocal seq
+            task = self.tasks[key]
+            if task['callback'] is not None: task['callback'](res)
+            for child in children[key]:
+                ndeps[child] -= 1
+                if ndeps[child] == 0:
+                    seq += 1
+                    heapq.heappush(ready, (self.tasks[child]['priority'], seq, child))
+
+        with tqdm(total=len(self.tasks), desc=desc) as pbar:
+            if nproc == 1:
+                while len(ready) > 0:
+                    _, _, key = heapq.heappop(ready)
+                    task = self.tasks[key]
+                    try:
+                        res = task['func'](*task['args'])
+                    except Exception as err:
+                        raise RuntimeError(f'Task failed: {key}') from err
+                    complete(key, res)
+                    pbar.update(1)
+            else:
+                results = queue.Queue()
+                running = {}
+                with mp.Pool(processes=nproc, initializer=initializer, initargs=initargs) as p:
+                    while len(ready) > 0 or len(running) > 0:
+                        n_io = sum(running.values())
+                        skipped = []
+                        while len(ready) > 0 and len(running) < nproc:
+                            item = heapq.heappop(ready)
+                            task = self.tasks[item[-1]]
+                            if task['io'] and n_io >= max_io:
+                                skipped.append(item)
+                                continue
+
+                            key = item[-1]
+                            running[key] = task['io']
+                            n_io += task['io']
+                            p.apply_async(
+                                task['func'], task['args'],
+                                callback=lambda res, key=key: results.put((key, res, None)),
+                                error_callback=lambda err, key=key: results.put((key, None, err)),
+                            )
+
+                        for item in skipped:
+                            heapq.heappush(ready, item)
+
+                        if len(running) == 0: break
+                        key, res, err = results.get()
+                        if err is not None: raise RuntimeError(f'Task failed: {key}') from err
+                        running.pop(key)
+                        complete(key, res)
+                        pbar.update(1)
 
-    shutil.move(src, dst)
\ No newline at end of file
+        if pbar.n < len(self.tasks):
+            raise ValueError('Some tasks have unresolvable dependencies.')